@@ -0,0 +1,127 @@
+import vtk
+
+from Utilities import polydata_to_numpy, numpy_to_polydata
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+import threading
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+
+from timeit import default_timer as timer
+import logging
+
+
+class ChunkDecimator(object):
+    """
+    Simplify chunks of the world mesh in a worker thread
+
+    A job gathers the points, triangles and colors of a chunk in the worker from
+    arrays the owner does not change in place, so submitting costs nothing on the
+    owner's thread and the worker never sees a half changed chunk. The worker runs
+    vtkDecimatePro (VTK releases the python lock while it runs) with the boundary
+    vertices kept in place so the chunk still meets its neighbors. The owner collects
+    the results between frames with get_results() and swaps them in, see
+    FilterWorldMesh. The worker does not hold the decimator, it stops on close() or
+    when the decimator is garbage collected.
+    """
+
+    def __init__(self):
+        self._jobs = Queue()
+        self._results = Queue()
+        self._pending = set()
+        self._thread = threading.Thread(target=ChunkDecimator._work, args=(self._jobs, self._results))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __del__(self):
+        # no join, this can run while the interpreter shuts down
+        self._jobs.put(None)
+
+    def close(self):
+        """
+        Stop the worker once it finished the jobs submitted so far, submit() must not
+        be called after this.
+        """
+        if self._thread.is_alive():
+            self._jobs.put(None)
+            self._thread.join()
+
+    def submit(self, chunk_id, version, gather, target):
+        """
+        :param chunk_id: passed back with the result
+        :param version: passed back with the result, to check the chunk did not change
+        :param gather: function called in the worker that returns the points (npts, 3),
+          triangles (ntri, 3) and colors (ntri, ncomponents) or None of the chunk
+        :param target: number of triangles to reduce the chunk to
+        """
+        self._pending.add(chunk_id)
+        self._jobs.put((chunk_id, version, gather, target))
+
+    def is_pending(self, chunk_id):
+        return chunk_id in self._pending
+
+    def get_results(self):
+        """
+        Never blocks.
+        :return: list of (chunk_id, version, points, triangles, colors) of the jobs
+          that finished since the last call, the arrays are None if the job failed
+        """
+        results = []
+        while True:
+            try:
+                result = self._results.get_nowait()
+            except Empty:
+                break
+            self._pending.discard(result[0])
+            results.append(result)
+        return results
+
+    @staticmethod
+    def _work(jobs, results):
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+            (chunk_id, version, gather, target) = job
+            try:
+                (points, triangles, colors) = gather()
+                result = _decimate(points, triangles, colors, target)
+            except Exception:
+                # no arrays, the owner keeps the chunk as it is
+                logging.exception('Decimation of chunk {} failed'.format(chunk_id))
+                result = (None, None, None)
+            results.put((chunk_id, version) + result)
+
+
+def _decimate(points, triangles, colors, target):
+    """
+    :return: points, triangles and colors of the simplified mesh, every new triangle
+      takes the color of the closest old triangle
+    """
+    start = timer()
+
+    decimate = vtk.vtkDecimatePro()
+    decimate.SetInputData(numpy_to_polydata(points, triangles))
+    decimate.SetTargetReduction(1.0 - float(target) / triangles.shape[0])
+    decimate.PreserveTopologyOn()
+    decimate.SplittingOff()
+    decimate.BoundaryVertexDeletionOff()
+    decimate.Update()
+    new_points, new_triangles = polydata_to_numpy(decimate.GetOutput())
+    new_points = new_points.astype(points.dtype)
+
+    new_colors = None
+    if colors is not None and new_triangles.shape[0]:
+        tree = cKDTree(points[triangles].mean(axis=1))
+        _, nearest = tree.query(new_points[new_triangles].mean(axis=1))
+        new_colors = colors[nearest]
+
+    end = timer()
+    logging.debug('Decimated {} to {} triangles in {:.4f} seconds'.format(
+        triangles.shape[0], new_triangles.shape[0], end - start))
+
+    return new_points, new_triangles.copy(), new_colors
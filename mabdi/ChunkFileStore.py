@@ -0,0 +1,303 @@
+import vtk
+
+from MeshStore import MeshStore
+from Utilities import numpy_to_polydata
+
+import numpy as np
+
+import os
+import json
+from collections import OrderedDict
+
+from timeit import default_timer as timer
+import logging
+
+
+class ChunkFileStore(object):
+    """
+    Spatial chunks of a mesh kept out of core
+
+    Every chunk is a MeshStore while it is resident in memory. When the resident
+    chunks take more than the memory budget the least recently used ones are written
+    to .npy files in a folder and dropped, a chunk that is needed again is read back
+    from memory-mapped files. A manifest.json in the folder lists the chunks so the
+    mesh can be opened again with ChunkFileStore.open() without reading the chunks.
+    """
+
+    def __init__(self, path, chunk_size, dtype=np.float64, resident_budget_mb=256,
+                 weld_tolerance=None):
+        """
+        :param path: folder for the chunk files, created if needed
+        :param chunk_size: edge length of the cubes the world is partitioned into
+        :param dtype: default=np.float64
+          Type of the points.
+        :param resident_budget_mb: default=256
+          Memory that the resident chunks can take before chunks are spilled to disk.
+        :param weld_tolerance: default=None
+          See MeshStore.
+        """
+        self._path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._chunk_size = chunk_size
+        self._dtype = np.dtype(dtype)
+        self._budget = int(resident_budget_mb * 1024 * 1024)
+        self._weld_tolerance = weld_tolerance
+        self._read_only = False
+
+        # per chunk: key, bounds, number of triangles and the store if resident
+        self._keys = []
+        self._index = {}
+        self._bounds = np.zeros((0, 6))
+        self._ntriangles = []
+        self._stores = []
+        self._dirty = set()
+
+        # resident chunks, least recently used first
+        self._lru = OrderedDict()
+        self._nspilled = 0
+        self._nloaded = 0
+
+    @staticmethod
+    def open(path):
+        """
+        Open the chunks written by a ChunkFileStore for reading, the chunk files are
+        only memory mapped.
+        :param path: folder with a manifest.json
+        :return: ChunkFileStore that can not be added to
+        """
+        with open(os.path.join(path, 'manifest.json')) as f:
+            manifest = json.load(f)
+        store = ChunkFileStore(path, manifest['chunk_size'], dtype=manifest['dtype'])
+        store._read_only = True
+        for chunk in manifest['chunks']:
+            key = tuple(chunk['key'])
+            store._index[key] = len(store._keys)
+            store._keys.append(key)
+            store._ntriangles.append(chunk['ntriangles'])
+            store._stores.append(None)
+        store._bounds = np.array([c['bounds'] for c in manifest['chunks']]).reshape(-1, 6)
+        return store
+
+    def add(self, key, points, triangles, colors=None):
+        """
+        Append triangles to a chunk, the chunk is created or read back if needed.
+        :param key: integer (i, j, k) of the chunk
+        :param points: (npts, 3) array
+        :param triangles: (ntri, 3) array of indices into points
+        :param colors: default=None, (ntri, ncomponents) array
+        :return: index of the chunk
+        """
+        if self._read_only:
+            raise RuntimeError('ChunkFileStore opened for reading')
+
+        if key not in self._index:
+            self._index[key] = len(self._keys)
+            self._keys.append(key)
+            self._ntriangles.append(0)
+            self._stores.append(MeshStore(dtype=self._dtype, capacity=256,
+                                          weld_tolerance=self._weld_tolerance))
+            self._bounds = np.vstack((self._bounds, [[np.inf, -np.inf] * 3]))
+        c = self._index[key]
+
+        store = self._resident(c)
+        store.append(points, triangles, colors)
+        self._ntriangles[c] = store.get_number_of_triangles()
+        self._dirty.add(c)
+
+        corners = points[triangles.reshape(-1)]
+        self._bounds[c, 0::2] = np.minimum(self._bounds[c, 0::2], corners.min(axis=0))
+        self._bounds[c, 1::2] = np.maximum(self._bounds[c, 1::2], corners.max(axis=0))
+
+        return c
+
+    def get_chunk_arrays(self, c, copy=True):
+        """
+        :param copy: default=True
+          False returns the arrays of the chunk itself (memory mapped if it is not
+          resident), they must not be changed and are only valid until the chunk is.
+        :return: points, triangles and colors (or None) of chunk c
+        """
+        if not copy:
+            return self._arrays(c)
+        return tuple(None if a is None else np.array(a) for a in self._arrays(c))
+
+    def replace(self, c, points, triangles, colors=None):
+        """
+        Replace all the triangles of chunk c, e.g. with a simplified version.
+        """
+        if self._read_only:
+            raise RuntimeError('ChunkFileStore opened for reading')
+        store = MeshStore(dtype=self._dtype, capacity=max(256, points.shape[0], triangles.shape[0]),
+                          weld_tolerance=self._weld_tolerance)
+        store.append(points, triangles, colors)
+        self._stores[c] = store
+        self._ntriangles[c] = store.get_number_of_triangles()
+        self._dirty.add(c)
+        self._lru.pop(c, None)
+        self._lru[c] = True
+
+    def evict(self, budget_nbytes=None):
+        """
+        Spill the least recently used chunks until the resident chunks fit the budget.
+        The most recently used chunk is always kept.
+        :param budget_nbytes: default=None
+          Memory the resident chunks can take, None is resident_budget_mb. An owner
+          that keeps other copies of the resident chunks gives a part of the budget.
+        """
+        budget = self._budget if budget_nbytes is None else budget_nbytes
+        nbytes = self.get_resident_nbytes()
+        while nbytes > budget and len(self._lru) > 1:
+            c, _ = self._lru.popitem(last=False)
+            nbytes -= self._stores[c].get_nbytes()
+            self._spill(c)
+            self._stores[c] = None
+
+    def flush(self):
+        """
+        Write every chunk that changed since it was last written and the manifest.
+        """
+        for c in list(self._dirty):
+            self._spill(c)
+        self._write_manifest()
+
+    def get_chunk_bounds(self):
+        """
+        :return: (nchunks, 6) array with the bounds of every chunk
+        """
+        return self._bounds
+
+    def get_number_of_triangles(self, chunk_ids=None):
+        """
+        :param chunk_ids: default=None, chunks to count, None is all of them
+        """
+        if chunk_ids is None:
+            return sum(self._ntriangles)
+        return sum(self._ntriangles[c] for c in chunk_ids)
+
+    def get_resident_chunks(self):
+        """
+        :return: indices of the chunks in memory, least recently used first
+        """
+        return list(self._lru)
+
+    def get_resident_nbytes(self):
+        """
+        :return: memory taken by the resident chunks
+        """
+        return sum(self._stores[c].get_nbytes() for c in self._lru)
+
+    def get_stats(self):
+        """
+        :return: dictionary with
+          * 'chunks' - number of chunks
+          * 'resident' - number of chunks in memory
+          * 'resident_mb' - memory taken by the resident chunks
+          * 'spilled' - number of times a chunk was written out
+          * 'loaded' - number of times a chunk was read back
+        """
+        return {'chunks': len(self._keys),
+                'resident': len(self._lru),
+                'resident_mb': self.get_resident_nbytes() / 1024.0 / 1024.0,
+                'spilled': self._nspilled,
+                'loaded': self._nloaded}
+
+    def get_polydata(self, chunk_ids=None):
+        """
+        Resident chunks come from memory and the others from their memory-mapped files
+        without making them resident.
+        :param chunk_ids: default=None, chunks to include, None is all of them
+        :return: vtkPolyData with the triangles of the chunks
+        """
+        chunk_ids = range(len(self._keys)) if chunk_ids is None else chunk_ids
+        pieces = [self._arrays(c) for c in chunk_ids]
+        pieces = [p for p in pieces if p[1].shape[0]]
+        if not pieces:
+            return vtk.vtkPolyData()
+
+        # concatenate with the triangles moved past the points of the previous chunks
+        offsets = np.cumsum([0] + [p[0].shape[0] for p in pieces[:-1]])
+        points = np.concatenate([p[0] for p in pieces])
+        triangles = np.concatenate([p[1] + o for p, o in zip(pieces, offsets)])
+        colors = None
+        if all(p[2] is not None for p in pieces):
+            colors = np.concatenate([p[2] for p in pieces])
+        return numpy_to_polydata(points, triangles, colors)
+
+    def touch(self, chunk_ids):
+        """
+        Mark chunks as used, spilled ones are read back into memory.
+        """
+        for c in chunk_ids:
+            self._resident(c)
+
+    def _resident(self, c):
+        """
+        :return: the MeshStore of chunk c, read back from its files if it was spilled
+        """
+        if self._stores[c] is None:
+            start = timer()
+            (points, triangles, colors) = self._arrays(c)
+            store = MeshStore(dtype=self._dtype, capacity=max(256, points.shape[0], triangles.shape[0]),
+                              weld_tolerance=self._weld_tolerance)
+            store.append(points, triangles, colors)
+            self._stores[c] = store
+            self._nloaded += 1
+            end = timer()
+            logging.debug('Chunk {} read back in {:.4f} seconds'.format(self._keys[c], end - start))
+        if not self._read_only:
+            self._lru.pop(c, None)
+            self._lru[c] = True
+        return self._stores[c]
+
+    def _arrays(self, c):
+        """
+        :return: points, triangles and colors (or None) of chunk c, memory mapped if
+          the chunk is not resident
+        """
+        store = self._stores[c]
+        if store is not None:
+            return store.get_points(), store.get_triangles(), store.get_colors()
+        points = np.load(self._file(c, 'points'), mmap_mode='r')
+        triangles = np.load(self._file(c, 'triangles'), mmap_mode='r')
+        colors = None
+        if os.path.exists(self._file(c, 'colors')):
+            colors = np.load(self._file(c, 'colors'), mmap_mode='r')
+        return points, triangles, colors
+
+    def _spill(self, c):
+        """
+        Write chunk c to its files if it changed.
+        """
+        if c in self._dirty:
+            store = self._stores[c]
+            self._save(self._file(c, 'points'), store.get_points())
+            self._save(self._file(c, 'triangles'), store.get_triangles())
+            if store.get_colors() is not None:
+                self._save(self._file(c, 'colors'), store.get_colors())
+            self._dirty.discard(c)
+            self._nspilled += 1
+
+    @staticmethod
+    def _save(filename, array):
+        """
+        Write a new file in place of the old one, arrays still memory mapped from the
+        old file (e.g. by a decimation job) keep reading it.
+        """
+        with open(filename + '.tmp', 'wb') as f:
+            np.save(f, array)
+        os.rename(filename + '.tmp', filename)
+
+    def _file(self, c, name):
+        return os.path.join(self._path, 'chunk_{}_{}_{}_{}.npy'.format(self._keys[c][0], self._keys[c][1],
+                                                                      self._keys[c][2], name))
+
+    def _write_manifest(self):
+        manifest = {'chunk_size': self._chunk_size,
+                    'dtype': self._dtype.name,
+                    'chunks': [{'key': [int(k) for k in key],
+                                'bounds': self._bounds[c].tolist(),
+                                'ntriangles': int(self._ntriangles[c])}
+                               for c, key in enumerate(self._keys)]}
+        with open(os.path.join(self._path, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=1)
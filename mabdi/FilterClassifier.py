@@ -2,6 +2,8 @@ import vtk
 from vtk.util.vtkAlgorithm import VTKPythonAlgorithmBase
 from vtk.util import numpy_support
 
+import numpy as np
+
 from timeit import default_timer as timer
 import logging
 
@@ -11,13 +13,24 @@ class FilterClassifier(VTKPythonAlgorithmBase):
     vtkAlgorithm with 2 inputs of vtkImageData and an output of vtkImageData
     Input: Depth images
     Output: Classified depth image
+
+    The output also tells which blocks of pixels have a novel pixel (out.novel_blocks,
+    the block size and a boolean array), so FilterDepthImageToSurface only
+    triangulates those.
     """
 
-    def __init__(self, param_classifier_threshold=0.01):
+    def __init__(self, param_classifier_threshold=0.01, param_block_size=16, precision='float64'):
         """
         :param param_classifier_threshold: default=0.01
           Threshold to determine when the difference in the depth images is too big
-          and is therefore a novel measurement.
+          and is therefore a novel measurement. In metres when the depth images are in
+          the 'metric' depth mode (see FilterDepthImage).
+        :param param_block_size: default=16
+          Size in pixels of the blocks of out.novel_blocks, None does not output it.
+        :param precision: default='float64'
+          'float64' or 'float32'. With 'float32' depth images of any other type are
+          converted to float32 so the output is float32, 'float64' keeps the type of
+          the input.
         :return:
         """
 
@@ -26,6 +39,11 @@ class FilterClassifier(VTKPythonAlgorithmBase):
                                         nOutputPorts=1, outputType='vtkImageData')
 
         self._param_classifier_threshold = param_classifier_threshold
+        self._param_block_size = param_block_size
+
+        if precision not in ('float64', 'float32'):
+            raise ValueError('Unknown precision {}'.format(precision))
+        self._precision = precision
 
         self._postprocess = []
         self._postprocess_im1 = []
@@ -78,20 +96,26 @@ class FilterClassifier(VTKPythonAlgorithmBase):
         dim = inp1.GetDimensions()
         im2 = numpy_support.vtk_to_numpy(inp2.GetPointData().GetScalars())\
             .reshape(dim[1], dim[0])
+        if self._precision == 'float32':
+            im1 = im1.astype(np.float32, copy=False)
+            im2 = im2.astype(np.float32, copy=False)
 
         # difference in the images
         # im1 is assumed to be from the actual sensor
         # im2 is what we expect to see based on the world mesh
         # Anywhere the difference is small, throw those measurements away
-        # by setting them to one. By doing this FilterDepthImageToSurface
-        # will assume they lie on the clipping plane and will remove them
+        # by setting them to one (zero for metric depth). By doing this
+        # FilterDepthImageToSurface will assume they lie on the clipping plane
+        # (were not seen) and will remove them
         difim = abs(im1 - im2) < self._param_classifier_threshold
         if self._postprocess:
             self._postprocess_im1 = im1.copy()
             self._postprocess_im2 = im2.copy()
             self._postprocess_difim = difim.copy()
-        imout = im1
-        imout[difim] = 1.0
+        # a new image, the actual depth image is still used after this (see
+        # FilterWorldMesh carving_depth_image)
+        depth_mode = getattr(inp1, 'depth_mode', 'zbuffer')
+        imout = np.where(difim, im1.dtype.type(0.0 if depth_mode == 'metric' else 1.0), im1)
 
         info = outInfo.GetInformationObject(0)
         ue = info.Get(vtk.vtkStreamingDemandDrivenPipeline.UPDATE_EXTENT())
@@ -101,9 +125,23 @@ class FilterClassifier(VTKPythonAlgorithmBase):
         out.SetExtent(ue)
         (out.sizex, out.sizey, out.tmat, out.viewport) = \
             (inp1.sizex, inp1.sizey, inp1.tmat, inp1.viewport)
+        (out.depth_mode, out.view_angle, out.clipping_range, out.camtoworld) = \
+            (depth_mode, inp1.view_angle, inp1.clipping_range, inp1.camtoworld)
         out.GetPointData().SetScalars(
             numpy_support.numpy_to_vtk(imout.reshape(-1)))
 
+        # blocks with at least one novel pixel, from the number of known pixels of
+        # every block (the padding of the last blocks is known)
+        out.novel_blocks = None
+        if self._param_block_size:
+            b = self._param_block_size
+            (h, w) = difim.shape
+            (nby, nbx) = (-(-h // b), -(-w // b))
+            known = np.ones((nby * b, nbx * b), dtype=bool)
+            known[:h, :w] = difim
+            nknown = known.view(np.uint8).reshape(nby, b, nbx * b).sum(axis=1, dtype=np.uint16)
+            out.novel_blocks = (b, nknown.reshape(nby, nbx, b).sum(axis=2) < b * b)
+
         end = timer()
         logging.info('Execution time {:.4f} seconds'.format(end - start))
 
@@ -3,8 +3,15 @@ from vtk.util.vtkAlgorithm import VTKPythonAlgorithmBase
 from vtk.util import numpy_support
 from vtk.numpy_interface import dataset_adapter as dsa
 
+from RayCastDepthBackend import RayCastDepthBackend
+from KinectNoiseModel import KinectNoiseModel
+from Utilities import NoiseBank
+
 import numpy as np
 
+import functools
+from collections import OrderedDict
+
 from timeit import default_timer as timer
 import logging
 
@@ -21,7 +28,14 @@ class FilterDepthImage(VTKPythonAlgorithmBase):
                  name='none',
                  offscreen=False,
                  noise=0.0,
-                 depth_image_size=(640, 480)):
+                 depth_image_size=(640, 480),
+                 backend='opengl',
+                 buffer_pool=0,
+                 depth_mode='zbuffer',
+                 render_context=None,
+                 cache_size_mb=0,
+                 noise_seed=None,
+                 precision='float64'):
         """
         :param name: default='none'
           Used for the logging statements.
@@ -29,8 +43,45 @@ class FilterDepthImage(VTKPythonAlgorithmBase):
           Create the render window that is used to produce the depth image offscreen.
         :param noise:
           Noise to add to depth image.
+          * a number - standard deviation of gaussian noise added to the z-buffer
+          values, True is 0.002
+          * 'kinect' - depth dependent axial and lateral noise, see KinectNoiseModel
+          The samples of both are drawn for every frame ahead of time by a background
+          thread, see NoiseBank.
         :param depth_image_size:
           Size of the depth image.
+        :param backend: default='opengl'
+          How the depth image is produced.
+          * 'opengl' - render in a vtkRenderWindow and read the z-buffer
+          * 'raycast' - ray cast on the CPU, see RayCastDepthBackend, no OpenGL
+          context is needed (offscreen is ignored)
+        :param buffer_pool: default=0
+          Number of depth buffers in a ring that is reused frame after frame. The
+          z-buffer is read directly into numpy owned float32 buffers that the output
+          wraps without a copy and noise is added in place. 0 allocates new arrays on
+          every frame. The output of a frame stays valid for buffer_pool frames.
+        :param depth_mode: default='zbuffer'
+          Encoding of the depth values of the output.
+          * 'zbuffer' - nonlinear z-buffer values, 0.0 on the near clipping plane and
+          1.0 on the far clipping plane and where nothing was seen
+          * 'metric' - linear depth along the optical axis in metres, 0.0 where nothing
+          was seen. See Utilities.get_ray_table() for the unprojection.
+        :param render_context: default=None
+          Utilities.SharedRenderContext to render in instead of a render window owned
+          by this filter (opengl backend only). The filters sharing the context also
+          share the sensor orientation. offscreen and depth_image_size are taken from
+          the context.
+        :param cache_size_mb: default=0
+          Memory cap of a least recently used cache of output depth images keyed on the
+          sensor pose, the intrinsic parameters, the modification time of the input
+          and the noise seed. When set_sensor_orientation() hits the cache nothing is
+          rendered. With noise the cache is only used when noise_seed is given. 0
+          disables the cache, see get_cache_stats(). Not used with a render_context.
+        :param noise_seed: default=None
+          Seed of the random generator of the noise.
+        :param precision: default='float64'
+          'float64' or 'float32'. The depth values are float32 either way (like the
+          z-buffer), with 'float32' the tmat and camtoworld meta data are float32 too.
         """
 
         VTKPythonAlgorithmBase.__init__(self,
@@ -43,42 +94,120 @@ class FilterDepthImage(VTKPythonAlgorithmBase):
                 noise = 0.002
             else:
                 noise = 0.0
+        if isinstance(noise, str) and noise != 'kinect':
+            raise ValueError('Unknown noise model {}'.format(noise))
         self._noise = noise
 
-        # vtk render objects
-        self._ren = vtk.vtkRenderer()
-        self._renWin = vtk.vtkRenderWindow()
-        self._iren = vtk.vtkRenderWindowInteractor()
-
-        # wire them up
-        self._renWin.AddRenderer(self._ren)
-        self._iren.SetRenderWindow(self._renWin)
-
-        # offscreen rendering
-        if offscreen:
-            self._renWin.SetOffScreenRendering(1)
+        if backend not in ('opengl', 'raycast'):
+            raise ValueError('Unknown depth backend {}'.format(backend))
+        self._backend = backend
+        self._size = tuple(depth_image_size)
+
+        if depth_mode not in ('zbuffer', 'metric'):
+            raise ValueError('Unknown depth mode {}'.format(depth_mode))
+        self._depth_mode = depth_mode
+
+        if precision not in ('float64', 'float32'):
+            raise ValueError('Unknown precision {}'.format(precision))
+        self._dtype = np.dtype(precision)
+
+        # the sensor
+        self._camera = vtk.vtkCamera()
+
+        self._render_context = render_context
+        if render_context is not None:
+            if self._backend != 'opengl':
+                raise ValueError('A render context can only be used with the opengl backend')
+            self._size = render_context.get_depth_image_size()
+            self._camera = render_context.camera
+
+            # a slot of the shared render window
+            self._ren = render_context.add_renderer()
+            self._renWin = render_context.renWin
+            self._iren = render_context.iren
+            self._actors = []
+        elif self._backend == 'opengl':
+            # vtk render objects
+            self._ren = vtk.vtkRenderer()
+            self._renWin = vtk.vtkRenderWindow()
+            self._iren = vtk.vtkRenderWindowInteractor()
+
+            # wire them up
+            self._renWin.AddRenderer(self._ren)
+            self._iren.SetRenderWindow(self._renWin)
+            self._ren.SetActiveCamera(self._camera)
+            self._actors = []
+
+            # offscreen rendering
+            if offscreen:
+                self._renWin.SetOffScreenRendering(1)
+
+            self._renWin.SetSize(self._size)
+            self._iren.GetInteractorStyle().SetAutoAdjustCameraClippingRange(0)
+        else:
+            self._raycast = RayCastDepthBackend(depth_image_size=self._size)
+            self._raycast_depth = np.ones((self._size[1], self._size[0]), dtype=np.float32)
 
         # kinect intrinsic parameters
         # https://msdn.microsoft.com/en-us/library/hh438998.aspx
-        self._renWin.SetSize(depth_image_size)
-        self._ren.GetActiveCamera().SetViewAngle(60.0)
-        self._ren.GetActiveCamera().SetClippingRange(0.8, 4.0)
-        self._iren.GetInteractorStyle().SetAutoAdjustCameraClippingRange(0)
+        self._camera.SetViewAngle(60.0)
+        self._camera.SetClippingRange(0.8, 4.0)
 
         # have it looking down and underneath the "floor"
         # so that it will produce a blank vtkImageData until
         # set_sensor_orientation() is called
-        self._ren.GetActiveCamera().SetPosition(0.0, -20.0, 0.0)
-        self._ren.GetActiveCamera().SetFocalPoint(0.0, -25.0, 0.0)
-
-        # calculate image bounds
-        self._imageBounds = [0, 0, 0, 0]
-        viewport = self._ren.GetViewport()
-        size = self._renWin.GetSize()
-        self._imageBounds[0] = int(viewport[0] * size[0])
-        self._imageBounds[1] = int(viewport[1] * size[1])
-        self._imageBounds[2] = int(viewport[2] * size[0] + 0.5) - 1
-        self._imageBounds[3] = int(viewport[3] * size[1] + 0.5) - 1
+        self._camera.SetPosition(0.0, -20.0, 0.0)
+        self._camera.SetFocalPoint(0.0, -25.0, 0.0)
+
+        # ring of preallocated depth buffers, see get_buffer_pool_stats()
+        self._buffer_pool = []
+        self._buffer_pool_index = 0
+        self._buffer_pool_frames = 0
+        self._buffer_pool_allocations_saved = 0
+        if buffer_pool:
+            npixels = self._size[0] * self._size[1]
+            for i in range(buffer_pool):
+                buf = np.ones(npixels, dtype=np.float32)
+                self._buffer_pool.append((buf, numpy_support.numpy_to_vtk(buf)))
+
+        # noise
+        self._noise_seed = noise_seed
+        self._noise_model = None
+        if self._noise == 'kinect':
+            self._noise_model = KinectNoiseModel(depth_image_size=self._size, seed=noise_seed)
+        elif self._noise != 0.0:
+            # new unit normal samples for every frame
+            self._noise_model = NoiseBank(functools.partial(_unit_normals, self._size[0] * self._size[1]),
+                                          seed=noise_seed)
+
+        # cache of output depth images, see get_cache_stats()
+        self._cache = OrderedDict()
+        if cache_size_mb and render_context is not None:
+            # the context moves the sensor, set_sensor_orientation() is not called
+            logging.warning('cache_size_mb ignored, it needs a filter without a render context')
+            cache_size_mb = 0
+        self._cache_size = int(cache_size_mb * 1024 * 1024)
+        self._cache_nbytes = 0
+        self._cache_hits = 0
+        self._cache_misses = 0
+        self._cache_frame = None
+        self._cache_pending_key = None
+        self._in_algorithm = None
+        self._in_polydata = None
+
+        # depth images rendered ahead of time by precompute_poses()
+        self._precomputed = {}
+        self._precomputed_frame = None
+
+        # calculate image bounds (the slot of a shared render window)
+        if self._backend == 'opengl':
+            self._imageBounds = [0, 0, 0, 0]
+            viewport = self._ren.GetViewport()
+            size = self._renWin.GetSize()
+            self._imageBounds[0] = int(viewport[0] * size[0])
+            self._imageBounds[1] = int(viewport[1] * size[1])
+            self._imageBounds[2] = int(viewport[2] * size[0] + 0.5) - 1
+            self._imageBounds[3] = int(viewport[3] * size[1] + 0.5) - 1
 
     def set_polydata(self, in_polydata):
         """
@@ -87,6 +216,12 @@ class FilterDepthImage(VTKPythonAlgorithmBase):
         """
         logging.info('')
 
+        self._in_algorithm = in_polydata
+        if self._backend == 'raycast':
+            self._raycast.set_input_connection(in_polydata)
+            self._render()
+            return
+
         mapper = vtk.vtkPolyDataMapper()
         mapper.SetInputConnection(in_polydata.GetOutputPort())
 
@@ -94,9 +229,10 @@ class FilterDepthImage(VTKPythonAlgorithmBase):
         actor.SetMapper(mapper)
 
         self._ren.AddActor(actor)
+        self._actors.append(actor)
 
         self._iren.Initialize()
-        self._iren.Render()
+        self._render()
 
     def set_polydata_empty(self):
         """
@@ -105,6 +241,12 @@ class FilterDepthImage(VTKPythonAlgorithmBase):
         logging.info('')
 
         polydata = vtk.vtkPolyData()
+        self._in_polydata = polydata
+
+        if self._backend == 'raycast':
+            self._raycast.set_input_data(polydata)
+            self._render()
+            return
 
         mapper = vtk.vtkPolyDataMapper()
         mapper.SetInputDataObject(polydata)
@@ -113,9 +255,10 @@ class FilterDepthImage(VTKPythonAlgorithmBase):
         actor.SetMapper(mapper)
 
         self._ren.AddActor(actor)
+        self._actors.append(actor)
 
         self._iren.Initialize()
-        self._iren.Render()
+        self._render()
 
     def set_sensor_orientation(self, in_position, in_lookat):
         """
@@ -124,29 +267,309 @@ class FilterDepthImage(VTKPythonAlgorithmBase):
         """
         logging.info('position{} lookat{}'.format(in_position, in_lookat))
 
-        self._ren.GetActiveCamera().SetPosition(in_position)
-        self._ren.GetActiveCamera().SetFocalPoint(in_lookat)
-        self._iren.Render()
+        self._camera.SetPosition(in_position)
+        self._camera.SetFocalPoint(in_lookat)
+
+        # no need to render if the depth image for this pose is already available
+        self._precomputed_frame = self._precomputed.get(self._pose_key(in_position, in_lookat))
+        self._cache_frame = self._cache_lookup()
+        if self._precomputed_frame is None and self._cache_frame is None:
+            self._render()
+
+    def render_poses(self, positions, lookats, max_window_size=4096):
+        """
+        Render the depth images of many sensor poses at once. With the opengl backend
+        the poses are rendered as tiles of a single large offscreen window, so there is
+        one render and one z-buffer read for every batch of tiles that fit in the window.
+        The orientation of this filter's sensor is not changed.
+        :param positions: (N, 3) array, position of the sensor in world coordinates
+        :param lookats: (N, 3) array, where the sensor is looking in world coordinates
+        :param max_window_size: default=4096
+          Maximum width and height in pixels of the window holding the tiles.
+        :return: depth images (N, height, width) with noise added and encoded like in
+          RequestData and the tmat (N, 4, 4) of every pose
+        """
+        depths, tmats, camtoworlds = self._render_poses(positions, lookats, max_window_size)
+        for depth in depths:
+            self._add_noise(depth)
+            self._to_depth_mode(depth)
+        return depths, tmats
+
+    def precompute_poses(self, positions, lookats, max_window_size=4096):
+        """
+        Render the depth images of a sensor path ahead of time with render_poses(). When
+        set_sensor_orientation() is then called with one of these poses the image is
+        taken from memory instead of being rendered. Only valid while the input polydata
+        does not change, pass empty arrays to clear.
+        :param positions: (N, 3) array, position of the sensor in world coordinates
+        :param lookats: (N, 3) array, where the sensor is looking in world coordinates
+        :param max_window_size: default=4096
+          See render_poses().
+        """
+        logging.info('{} poses'.format(len(positions)))
+        self._precomputed = {}
+        if len(positions) == 0:
+            return
+        depths, tmats, camtoworlds = self._render_poses(positions, lookats, max_window_size)
+        for pos, lka, depth, tmat, c2w in zip(positions, lookats, depths, tmats, camtoworlds):
+            self._precomputed[self._pose_key(pos, lka)] = (depth, tmat, c2w)
 
     def get_vtk_camera(self):
-        return self._ren.GetActiveCamera()
+        return self._camera
 
     def get_width_by_height_ratio(self):
-        return float(self._renWin.GetSize()[0]) / float(self._renWin.GetSize()[1])
+        return float(self._size[0]) / float(self._size[1])
+
+    def get_buffer_pool_stats(self):
+        """
+        :return: dictionary
+          * 'size' - number of buffers in the ring
+          * 'frames' - number of frames that went through the ring, frames taken from
+          the cache do not
+          * 'allocations_saved' - number of frames written into a buffer that an
+          earlier frame already used
+        """
+        return {'size': len(self._buffer_pool),
+                'frames': self._buffer_pool_frames,
+                'allocations_saved': self._buffer_pool_allocations_saved}
+
+    def get_cache_stats(self):
+        """
+        :return: dictionary
+          * 'hits' - number of poses that were taken from the cache
+          * 'misses' - number of poses that had to be rendered
+          * 'entries' - number of depth images in the cache
+          * 'nbytes' - memory used by the cache
+        """
+        return {'hits': self._cache_hits,
+                'misses': self._cache_misses,
+                'entries': len(self._cache),
+                'nbytes': self._cache_nbytes}
 
     def kill_render_window(self):
         """
-        Kill render window that this instance owns. Only to be used when the user
-        is sure the filter will not be run again.
+        Kill render window that this instance owns and stop the threads of the ray
+        casting backend and of the kinect noise. Only to be used when the user is sure
+        the filter will not be run again.
         """
+        if self._noise_model is not None:
+            self._noise_model.close()
+        if self._backend == 'raycast':
+            self._raycast.close()
+        if self._backend != 'opengl' or self._render_context is not None:
+            return
+
         # http://stackoverflow.com/questions/15639762/close-vtk-window-python
         self._renWin.Finalize()
         self._iren.TerminateApp()
         del self._renWin, self._iren
 
+    def _cache_lookup(self):
+        """
+        Look for the current pose in the cache.
+        :return: (depth, tmat, camtoworld) or None
+        """
+        self._cache_pending_key = None
+        if self._cache_size == 0 or (self._noise != 0.0 and self._noise_seed is None):
+            return None
+
+        # the input has to be up to date to know if it was modified, rendering
+        # would update it anyway
+        if self._in_algorithm is not None:
+            self._in_algorithm.Update()
+            mtime = self._in_algorithm.GetOutputDataObject(0).GetMTime()
+        elif self._in_polydata is not None:
+            mtime = self._in_polydata.GetMTime()
+        else:
+            return None
+
+        c = self._camera
+        key = (c.GetPosition(), c.GetFocalPoint(), c.GetViewUp(),
+               c.GetViewAngle(), c.GetClippingRange(), self._size, self._depth_mode,
+               mtime, self._noise, self._noise_seed)
+
+        if key in self._cache:
+            frame = self._cache.pop(key)
+            self._cache[key] = frame  # most recently used
+            self._cache_hits += 1
+            return frame
+
+        self._cache_misses += 1
+        self._cache_pending_key = key
+        return None
+
+    def _cache_store(self, depth, tmat, camtoworld):
+        frame = (depth.copy(), tmat, camtoworld)
+        self._cache[self._cache_pending_key] = frame
+        self._cache_nbytes += frame[0].nbytes
+        self._cache_pending_key = None
+
+        # evict the least recently used
+        while self._cache_nbytes > self._cache_size and self._cache:
+            (key, old) = self._cache.popitem(last=False)
+            self._cache_nbytes -= old[0].nbytes
+
+    @staticmethod
+    def _pose_key(position, lookat):
+        return tuple(np.round(position, 9)) + tuple(np.round(lookat, 9))
+
+    def _render_poses(self, positions, lookats, max_window_size):
+        """
+        See render_poses(), without the noise and always as z-buffer values. The
+        camtoworld (N, 4, 4) of every pose is returned as well.
+        """
+        start = timer()
+
+        (w, h) = self._size
+        n = len(positions)
+        depths = np.ones((n, h, w), dtype=np.float32)
+        tmats = np.zeros((n, 4, 4), dtype=self._dtype)
+        camtoworlds = np.zeros((n, 4, 4), dtype=self._dtype)
+
+        # one camera per pose with the intrinsic parameters of the sensor
+        cameras = []
+        for i, (pos, lka) in enumerate(zip(positions, lookats)):
+            camera = vtk.vtkCamera()
+            camera.SetViewAngle(self._camera.GetViewAngle())
+            camera.SetClippingRange(self._camera.GetClippingRange())
+            camera.SetPosition(pos)
+            camera.SetFocalPoint(lka)
+            tmats[i], camtoworlds[i] = self._camera_matrices(camera,
+                                                             self.get_width_by_height_ratio())
+            cameras.append(camera)
+
+        if self._backend == 'raycast':
+            for i, camera in enumerate(cameras):
+                depths[i] = self._raycast.render(camera)
+        elif self._actors:
+            # layout of the tiles in the batch window
+            ncols = max(1, min(n, max_window_size // w))
+            nrows = max(1, min(int(np.ceil(float(n) / ncols)), max_window_size // h))
+            ntiles = ncols * nrows
+
+            renWin = vtk.vtkRenderWindow()
+            renWin.SetOffScreenRendering(1)
+            renWin.SetMultiSamples(self._renWin.GetMultiSamples())
+            renWin.SetSize(ncols * w, nrows * h)
+            renderers = []
+            for t in range(ntiles):
+                (c, r) = (t % ncols, t // ncols)
+                ren = vtk.vtkRenderer()
+                ren.SetViewport(float(c) / ncols, float(r) / nrows,
+                                float(c + 1) / ncols, float(r + 1) / nrows)
+                for actor in self._actors:
+                    ren.AddActor(actor)
+                renWin.AddRenderer(ren)
+                renderers.append(ren)
+
+            vfa = vtk.vtkFloatArray()
+            for b in range(0, n, ntiles):
+                nb = min(ntiles, n - b)
+                for t, ren in enumerate(renderers):
+                    ren.SetDraw(t < nb)
+                    if t < nb:
+                        ren.SetActiveCamera(cameras[b + t])
+                renWin.Render()
+                renWin.GetZbufferData(0, 0, ncols * w - 1, nrows * h - 1, vfa)
+                zbuffer = numpy_support.vtk_to_numpy(vfa).reshape(nrows * h, ncols * w)
+                for t in range(nb):
+                    (c, r) = (t % ncols, t // ncols)
+                    depths[b + t] = zbuffer[r * h:(r + 1) * h, c * w:(c + 1) * w]
+
+            renWin.Finalize()
+            del renWin
+
+        end = timer()
+        logging.info('{} poses in {:.4f} seconds'.format(n, end - start))
+
+        return depths, tmats, camtoworlds
+
+    def _camera_matrices(self, camera, aspect):
+        """
+        :return: tmat, the transform from normalized display coordinates (depth in the
+          z-buffer range) to world coordinates, and camtoworld, the rigid transform from
+          camera coordinates to world coordinates
+        """
+        vtktmat = camera.GetCompositeProjectionTransformMatrix(aspect, 0.0, 1.0)
+        vtktmat.Invert()
+        camtoworld = vtk.vtkMatrix4x4()
+        camtoworld.DeepCopy(camera.GetViewTransformMatrix())
+        camtoworld.Invert()
+        return (self._vtkmatrix_to_numpy(vtktmat).astype(self._dtype),
+                self._vtkmatrix_to_numpy(camtoworld).astype(self._dtype))
+
+    def _to_depth_mode(self, depth):
+        """
+        Convert z-buffer values in place to the depth mode of the output.
+        :param depth: numpy array of z-buffer values
+        """
+        if self._depth_mode == 'zbuffer':
+            return
+
+        # invert the perspective depth mapping d = f (z - n) / (z (f - n))
+        (n, f) = self._camera.GetClippingRange()
+        background = depth >= 1.0
+        np.multiply(depth, -(f - n), out=depth)
+        depth += f
+        np.divide(n * f, depth, out=depth)
+        depth[background] = 0.0
+
+    def _add_noise(self, depth):
+        """
+        Add noise in place.
+        :param depth: numpy array of depth values
+        """
+        if self._noise == 0.0:
+            return
+        if self._noise == 'kinect':
+            self._noise_model.add_noise(depth, self._camera.GetClippingRange())
+        else:
+            samples = self._noise_model.get()
+            samples *= self._noise
+            depth += samples.reshape(depth.shape)
+
+    def _next_pool_buffer(self):
+        """
+        Fill the next buffer of the ring with the depth values.
+        :return: the vtkFloatArray wrapping the buffer
+        """
+        buf, vfa = self._buffer_pool[self._buffer_pool_index]
+        self._buffer_pool_index = (self._buffer_pool_index + 1) % len(self._buffer_pool)
+
+        if self._precomputed_frame is not None:
+            buf[:] = self._precomputed_frame[0].reshape(-1)
+        elif self._backend == 'opengl':
+            # the array already has the right size so the z-buffer is written
+            # straight into the numpy memory
+            ib = self._imageBounds
+            self._renWin.GetZbufferData(ib[0], ib[1], ib[2], ib[3], vfa)
+        else:
+            buf[:] = self._raycast_depth.reshape(-1)
+        self._add_noise(buf)
+        self._to_depth_mode(buf)
+        vfa.Modified()
+
+        # a new vtkFloatArray would have been allocated otherwise, the first lap of
+        # the ring uses the buffers allocated up front
+        self._buffer_pool_frames += 1
+        if self._buffer_pool_frames > len(self._buffer_pool):
+            self._buffer_pool_allocations_saved += 1
+
+        return vfa
+
+    def _render(self):
+        """
+        Produce the depth image for the current sensor orientation. The z-buffer is
+        read later in RequestData.
+        """
+        if self._backend == 'opengl':
+            self._iren.Render()
+        else:
+            self._raycast_depth = self._raycast.render(self._camera)
+
     def RequestInformation(self, request, inInfo, outInfo):
         logging.info('')
-        size = self._renWin.GetSize()
+        size = self._size
         extent = (0, size[0] - 1, 0, size[1] - 1, 0, 0)
         info = outInfo.GetInformationObject(0)
         info.Set(vtk.vtkStreamingDemandDrivenPipeline.WHOLE_EXTENT(),
@@ -158,16 +581,30 @@ class FilterDepthImage(VTKPythonAlgorithmBase):
         start = timer()
 
         # get the depth values
-        vfa = vtk.vtkFloatArray()
-        ib = self._imageBounds
-        self._renWin.GetZbufferData(ib[0], ib[1], ib[2], ib[3], vfa)
+        cached = self._cache_frame is not None
+        if cached:
+            vfa = numpy_support.numpy_to_vtk(self._cache_frame[0], deep=1)
+        elif self._buffer_pool:
+            vfa = self._next_pool_buffer()
+        elif self._precomputed_frame is not None:
+            vfa = numpy_support.numpy_to_vtk(self._precomputed_frame[0].reshape(-1), deep=1)
+        elif self._backend == 'opengl':
+            vfa = vtk.vtkFloatArray()
+            ib = self._imageBounds
+            self._renWin.GetZbufferData(ib[0], ib[1], ib[2], ib[3], vfa)
+        else:
+            vfa = numpy_support.numpy_to_vtk(self._raycast_depth.reshape(-1), deep=1)
 
         # add noise
-        if self._noise is not 0.0:
+        if self._noise is not 0.0 and not self._buffer_pool and not cached:
             nvfa = numpy_support.vtk_to_numpy(vfa)
-            nvfa += self._noise * np.random.normal(0.0, 1.0, nvfa.shape)
+            self._add_noise(nvfa)
             vfa = dsa.numpyTovtkDataArray(nvfa)
 
+        # linear depth along the optical axis
+        if self._depth_mode == 'metric' and not self._buffer_pool and not cached:
+            self._to_depth_mode(numpy_support.vtk_to_numpy(vfa))
+
         # pack the depth values into the output vtkImageData
         info = outInfo.GetInformationObject(0)
         ue = info.Get(vtk.vtkStreamingDemandDrivenPipeline.UPDATE_EXTENT())
@@ -176,14 +613,30 @@ class FilterDepthImage(VTKPythonAlgorithmBase):
         out.SetExtent(ue)
 
         # append meta data to the vtkImageData containing intrinsic parameters
-        out.sizex = self._renWin.GetSize()[0]
-        out.sizey = self._renWin.GetSize()[1]
-        out.viewport = self._ren.GetViewport()
-        vtktmat = self._ren.GetActiveCamera().GetCompositeProjectionTransformMatrix(
-            self._ren.GetTiledAspectRatio(),
-            0.0, 1.0)
-        vtktmat.Invert()
-        out.tmat = self._vtkmatrix_to_numpy(vtktmat)
+        out.sizex = self._size[0]
+        out.sizey = self._size[1]
+        out.depth_mode = self._depth_mode
+        out.view_angle = self._camera.GetViewAngle()
+        out.clipping_range = self._camera.GetClippingRange()
+        if self._backend == 'opengl' and self._render_context is None:
+            out.viewport = self._ren.GetViewport()
+            aspect = self._ren.GetTiledAspectRatio()
+        elif self._backend == 'opengl':
+            # the depth image covers the whole slot
+            out.viewport = (0.0, 0.0, 1.0, 1.0)
+            aspect = self._ren.GetTiledAspectRatio()
+        else:
+            out.viewport = (0.0, 0.0, 1.0, 1.0)
+            aspect = self.get_width_by_height_ratio()
+        frame = self._cache_frame if cached else self._precomputed_frame
+        if frame is not None:
+            out.viewport = (0.0, 0.0, 1.0, 1.0)
+            (out.tmat, out.camtoworld) = frame[1:3]
+        else:
+            (out.tmat, out.camtoworld) = self._camera_matrices(self._camera, aspect)
+
+        if self._cache_pending_key is not None:
+            self._cache_store(numpy_support.vtk_to_numpy(vfa), out.tmat, out.camtoworld)
 
         end = timer()
         logging.info('Execution time {:.4f} seconds'.format(end - start))
@@ -203,3 +656,10 @@ class FilterDepthImage(VTKPythonAlgorithmBase):
             for j in range(4):
                 m[i, j] = matrix.GetElement(i, j)
         return m
+
+
+def _unit_normals(npixels, rng):
+    """
+    One frame of gaussian noise, called by the NoiseBank thread.
+    """
+    return rng.standard_normal(npixels, dtype=np.float32)
@@ -1,12 +1,11 @@
 import vtk
 from vtk.util.vtkAlgorithm import VTKPythonAlgorithmBase
 from vtk.util import numpy_support
-from vtk.numpy_interface import dataset_adapter as dsa
 
-from Utilities import DebugTimeVTKFilter
+from Utilities import get_ray_table
+from Utilities import numpy_to_cell_array
 
 import numpy as np
-from scipy import ndimage
 
 from timeit import default_timer as timer
 import logging
@@ -18,22 +17,46 @@ class FilterDepthImageToSurface(VTKPythonAlgorithmBase):
     This filter first defines a connectivity on the depth image that is like a
     checkerboard but with two triangles in each square. It then throws away all points
     farther than the param_farplane_threshold and all points with a large difference
-    between neighbors (controlled with param_convolution_theshold)
+    between neighbors (controlled with param_convolution_theshold). Only the triangles
+    with three valid points and the points they use are projected and output.
+    Optionally planar regions are meshed with a quadtree of large squares instead of
+    two triangles for every pixel. When the input comes from FilterClassifier only
+    the blocks with novel pixels are triangulated, the known pixels are thrown away
+    anyway.
     Input: Depth image
     Output: Mesh created by projecting depth image
     """
 
+    # above this fraction of novel blocks testing the whole image is faster
+    _block_fraction = 0.25
+
     def __init__(self,
                  param_farplane_threshold=1.0,
-                 param_convolution_threshold=0.01):
+                 param_convolution_threshold=0.01,
+                 param_quadtree_max_block_size=None,
+                 param_quadtree_tolerance=0.0005,
+                 precision='float64'):
         """
         Algorithm setup and define parameters.
         :param param_farplane_threshold: default=1.0
           Values on the depth image range from 0.0-1.0. Points with depth values greater
-          than param_farplane_threshold will be thrown away.
+          than param_farplane_threshold will be thrown away. For depth images in the
+          'metric' depth mode (see FilterDepthImage) the threshold is in metres.
         :param param_convolution_threshold: default=0.01
           Convolution is used to determine pixel neighbors with a large difference. If
           there is one, the point will be thrown away. This threshold controls sensitivity.
+          In metres for 'metric' depth images.
+        :param param_quadtree_max_block_size: default=None
+          Size in pixels (a power of two, e.g. 32) of the largest square of the
+          adaptive meshing. Squares of valid pixels are split in four until the depth
+          values of the square fit a plane within param_quadtree_tolerance, a square
+          that fits is output as two triangles. None outputs two triangles for every
+          square of neighboring pixels.
+        :param param_quadtree_tolerance: default=0.0005
+          Largest distance of a depth value from the plane fit of its square, in
+          z-buffer units (metres for 'metric' depth images).
+        :param precision: default='float64'
+          'float64' or 'float32', type of the projection and of the output points.
         """
 
         VTKPythonAlgorithmBase.__init__(self,
@@ -43,6 +66,16 @@ class FilterDepthImageToSurface(VTKPythonAlgorithmBase):
         self._param_farplane_threshold = param_farplane_threshold
         self.param_convolution_theshold = param_convolution_threshold
 
+        if param_quadtree_max_block_size and \
+                param_quadtree_max_block_size & (param_quadtree_max_block_size - 1):
+            raise ValueError('The quadtree block size has to be a power of two')
+        self._param_quadtree_max_block_size = param_quadtree_max_block_size
+        self._param_quadtree_tolerance = param_quadtree_tolerance
+
+        if precision not in ('float64', 'float32'):
+            raise ValueError('Unknown precision {}'.format(precision))
+        self._dtype = np.dtype(precision)
+
         self._sizex = []
         self._sizey = []
         self._viewport = []
@@ -50,20 +83,7 @@ class FilterDepthImageToSurface(VTKPythonAlgorithmBase):
         self._display_pts = []
         self._viewport_pts = []
         self._world_pts = []
-
-        self._points = vtk.vtkPoints()
-        self._polys = vtk.vtkCellArray()
-        self._polydata = vtk.vtkPolyData()
-        self._polydata.SetPoints(self._points)
-        self._polydata.SetPolys(self._polys)
-
-        self._extract = vtk.vtkExtractPolyDataGeometry()
-        DebugTimeVTKFilter(self._extract)
-        self._extract.SetInputData(self._polydata)
-        planefunc = vtk.vtkPlane()
-        planefunc.SetNormal(0.0, -1.0, 0.0)
-        planefunc.SetOrigin(0.0, -1.0, 0.0)
-        self._extract.SetImplicitFunction(planefunc)
+        self._triangles = []
 
     def RequestData(self, request, inInfo, outInfo):
 
@@ -83,109 +103,275 @@ class FilterDepthImageToSurface(VTKPythonAlgorithmBase):
         # the incoming depth image
         di = numpy_support.vtk_to_numpy(inp.GetPointData().GetScalars())\
             .reshape((self._sizey, self._sizex))
+        metric = getattr(inp, 'depth_mode', 'zbuffer') == 'metric'
+
+        """ Keep the triangles with three valid points """
+
+        # the classifier tells which blocks have novel pixels, the others are all
+        # thrown away so only the squares of pixels near novel ones are tested
+        novel_blocks = getattr(inp, 'novel_blocks', None)
+        if novel_blocks is not None and novel_blocks[1].mean() < self._block_fraction:
+            valid_tri = self._valid_triangles_in_blocks(di, metric, *novel_blocks)
+        else:
+            valid_tri = self._valid_triangles(di, metric)
+        if self._param_quadtree_max_block_size:
+            # planar squares, their pixels are no longer triangulated one by one
+            blocks = self._quadtree(di, metric, valid_tri)
+            triangles = np.vstack((blocks, self._triangles[np.flatnonzero(valid_tri)]))
+        else:
+            triangles = self._triangles[np.flatnonzero(valid_tri)]
+
+        # only the points used by the triangles, renumbered
+        used_mask = np.zeros(di.size, dtype=bool)
+        used_mask[triangles] = True
+        used = np.flatnonzero(used_mask)
+        renumber = np.cumsum(used_mask) - 1
+        triangles = renumber[triangles]
+
+        """ Project the points """
+
+        if metric:
+            # linear depth, scale the ray of every pixel and move it into the world
+            rays = get_ray_table(self._sizex, self._sizey, inp.view_angle, self._viewport, self._dtype)
+            camtoworld = inp.camtoworld.astype(self._dtype, copy=False)
+            self._world_pts = np.dot(camtoworld[0:3, 0:3], rays[:, used] * di.reshape(-1)[used]) + \
+                camtoworld[0:3, 3:4]
+        else:
+            # add z values to viewport_pts based on incoming depth image
+            viewport_pts = self._viewport_pts[:, used]
+            viewport_pts[2, :] = di.reshape(-1)[used]
+
+            # project to world coordinates
+            self._world_pts = np.dot(inp.tmat.astype(self._dtype, copy=False), viewport_pts)
+            self._world_pts = self._world_pts[0:3] / self._world_pts[3]
+
+        """ Set filter output """
+
+        points = vtk.vtkPoints()
+        points.SetData(numpy_support.numpy_to_vtk(np.ascontiguousarray(self._world_pts.T), deep=0))
 
-        # add z values to viewport_pts based on incoming depth image
-        self._viewport_pts[2, :] = di.reshape(-1)
+        out = vtk.vtkPolyData.GetData(outInfo)
+        out.Initialize()
+        out.SetPoints(points)
+        out.SetPolys(numpy_to_cell_array(triangles, deep=0))
+        logging.info('Number of triangles: {}'.format(triangles.shape[0]))
 
-        # project to world coordinates
-        self._world_pts = np.dot(inp.tmat, self._viewport_pts)
-        self._world_pts = self._world_pts / self._world_pts[3]
+        end = timer()
+        logging.info('Execution time {:.4f} seconds'.format(end - start))
 
-        """ Remove invalid points """
+        return 1
 
+    def _valid_pixels(self, di, metric, left, up):
+        """
+        :param di: depth values
+        :param left: depth values of the pixels to the left of di (the same at the
+          left border)
+        :param up: depth values of the pixels above di (the same at the top border)
+        :return: boolean array, True for the pixels that are in range and have no
+          large difference with the pixel to the left or above
+        """
         # index to pts outside sensor range (defined by vtkCamera clipping range)
         outside_range = ~(di < self._param_farplane_threshold)
+        if metric:
+            outside_range |= ~(di > 0.0)  # nothing was seen
 
-        # find pixel neighbors with large differences in value
-        # http://docs.scipy.org/doc/scipy/reference/tutorial/ndimage.html
-        kh = np.array([[1, -1], [0, 0]])
-        edges_h = abs(ndimage.convolve(di,
-                                       kh,
-                                       mode='nearest',
-                                       origin=-1)) > self.param_convolution_theshold
-        kv = np.array([[1, 0], [-1, 0]])
-        edges_v = abs(ndimage.convolve(di,
-                                       kv,
-                                       mode='nearest',
-                                       origin=-1)) > self.param_convolution_theshold
+        # pixel neighbors with large differences in value
+        edges_h = abs(di - left) > self.param_convolution_theshold
+        edges_v = abs(di - up) > self.param_convolution_theshold
 
         # combine all the points found to be invalid
-        # and set them to a value underneath the "floor of the environment"
-        # http://stackoverflow.com/a/20528566/4068274
-        invalid_index = np.logical_or.reduce((outside_range.reshape(-1),
-                                              edges_h.reshape(-1),
-                                              edges_v.reshape(-1)))
-        self._world_pts[0:3, invalid_index] = np.array([[0.0], [-2.0], [0.0]])
+        return ~(outside_range | edges_h | edges_v)
 
-        """ Update and set filter output """
-
-        # update vtkPoints
-        vtkarray = dsa.numpyTovtkDataArray(self._world_pts[0:3, :].T)
-        self._points.SetData(vtkarray)
-
-        # update output (vtkPolyData)
-        out = vtk.vtkPolyData.GetData(outInfo)
-        self._extract.Update()
-        logging.info('Number of triangles: {}'.format(self._extract.GetOutput().GetNumberOfCells()))
-        out.ShallowCopy(self._extract.GetOutput())
-
-        end = timer()
-        logging.info('Execution time {:.4f} seconds'.format(end - start))
+    @staticmethod
+    def _valid_squares(valid):
+        """
+        :param valid: (..., n+1, m+1) valid pixels
+        :return: (..., n, m, 2) the two triangles of each square of pixels, in the
+          order of self._triangles, True if their three points are valid
+        """
+        (v00, v01, v10, v11) = (valid[..., :-1, :-1], valid[..., :-1, 1:],
+                                valid[..., 1:, :-1], valid[..., 1:, 1:])
+        valid_tri = np.empty(v00.shape + (2,), dtype=bool)
+        np.logical_and(v00 & v01, v10, out=valid_tri[..., 0])
+        np.logical_and(v01 & v11, v10, out=valid_tri[..., 1])
+        return valid_tri
+
+    def _valid_triangles(self, di, metric):
+        """
+        :return: (h-1, w-1, 2) valid triangles of every square of neighboring pixels
+        """
+        # neighbors to the left and above, the border is its own neighbor
+        left = np.concatenate((di[:, :1], di[:, :-1]), axis=1)
+        up = np.concatenate((di[:1], di[:-1]), axis=0)
+        return self._valid_squares(self._valid_pixels(di, metric, left, up))
 
-        return 1
+    def _valid_triangles_in_blocks(self, di, metric, block_size, novel):
+        """
+        Same as _valid_triangles() but only the squares of pixels whose pixels are in
+        novel blocks are tested, the others are not valid.
+        :param block_size: size in pixels of the blocks
+        :param novel: (ceil(h/block_size), ceil(w/block_size)) boolean array, False
+          for the blocks whose pixels are all thrown away (e.g. known, see
+          FilterClassifier)
+        :return: (h-1, w-1, 2) valid triangles of every square of neighboring pixels
+        """
+        (w, h, b) = (self._sizex, self._sizey, block_size)
+
+        # a block of squares uses the pixels of its block and of the next ones
+        (nby, nbx) = (-(-(h - 1) // b), -(-(w - 1) // b))
+        padded = np.zeros((nby + 1, nbx + 1), dtype=bool)
+        padded[:novel.shape[0], :novel.shape[1]] = novel[:nby + 1, :nbx + 1]
+        active = padded[:-1, :-1] | padded[1:, :-1] | padded[:-1, 1:] | padded[1:, 1:]
+        (iy, ix) = np.nonzero(active)
+
+        valid_tri = np.zeros((nby * b, nbx * b, 2), dtype=bool)
+        if iy.size:
+            # the (b+2) x (b+2) pixels of every active block with the row above and the
+            # column to the left, clamped to the image
+            offsets = np.arange(-1, b + 1)
+            rows = np.clip(iy[:, None] * b + offsets, 0, h - 1)
+            cols = np.clip(ix[:, None] * b + offsets, 0, w - 1)
+            windows = di[rows[:, :, None], cols[:, None, :]]
+
+            valid = self._valid_pixels(windows[:, 1:, 1:], metric, windows[:, 1:, :-1], windows[:, :-1, 1:])
+            valid_tri.reshape(nby, b, nbx, b, 2)[iy, :, ix] = self._valid_squares(valid)
+
+        return valid_tri[:h - 1, :w - 1]
+
+    def _quadtree(self, di, metric, valid_tri):
+        """
+        Find the squares of pixels that are planar, from the largest size down to 2x2
+        squares of pixel neighbors. The z-buffer value (or 1 / depth for metric depth)
+        of a plane is affine in the pixel coordinates, so a least squares plane is fit
+        to every candidate square with a precomputed pseudo inverse.
+        :param di: depth image
+        :param metric: True if di is in metres
+        :param valid_tri: (h-1, w-1, 2) valid triangles of every square of neighboring
+          pixels, the triangles covered by a planar square are set to False
+        :return: (n, 3) triangles of the planar squares
+        """
+        (w, h) = (self._sizex, self._sizey)
+        tol = self._param_quadtree_tolerance
+
+        # squares of neighboring pixels with both triangles valid and not yet covered
+        full = valid_tri.all(axis=2)
+        free = full.copy()
+
+        # the plane is fit to values that are affine for a plane
+        if metric:
+            with np.errstate(divide='ignore'):
+                fit = 1.0 / di.astype(self._dtype)
+        else:
+            fit = di.astype(self._dtype)
+
+        blocks = []
+        s = self._param_quadtree_max_block_size
+        while s >= 2:
+            (nby, nbx) = ((h - 1) // s, (w - 1) // s)
+            if nby and nbx:
+                # a block is a candidate if all its squares are free
+                cand = free[:nby * s, :nbx * s].reshape(nby, s, nbx, s).all(axis=(1, 3))
+                (iy, ix) = np.nonzero(cand)
+                if iy.size:
+                    # the (s+1) x (s+1) pixels of every candidate block
+                    (r, c) = fit.strides
+                    windows = np.lib.stride_tricks.as_strided(
+                        fit, shape=(nby, nbx, s + 1, s + 1), strides=(s * r, s * c, r, c))
+                    vals = windows[iy, ix].reshape(iy.size, -1)
+
+                    (design, pinv) = _get_plane_fit(s, self._dtype)
+                    plane = np.dot(np.dot(vals, pinv.T), design.T)
+                    if metric:
+                        resid = np.abs(1.0 / vals - 1.0 / plane)
+                    else:
+                        resid = np.abs(vals - plane)
+                    planar = resid.max(axis=1) <= tol
+                    (iy, ix) = (iy[planar], ix[planar])
+
+                    # two triangles over the corners of every planar block
+                    p00 = iy * s * w + ix * s
+                    (p01, p10, p11) = (p00 + s, p00 + s * w, p00 + s * w + s)
+                    blocks.append(np.column_stack((p00, p01, p10)))
+                    blocks.append(np.column_stack((p01, p11, p10)))
+
+                    # the squares of neighboring pixels that are now covered
+                    covered = np.zeros((nby, nbx), dtype=bool)
+                    covered[iy, ix] = True
+                    covered = np.repeat(np.repeat(covered, s, axis=0), s, axis=1)
+                    free[:nby * s, :nbx * s] &= ~covered
+            s //= 2
+
+        valid_tri[full & ~free] = False
+
+        if not blocks:
+            return np.zeros((0, 3), dtype=self._triangles.dtype)
+        return np.vstack(blocks).astype(self._triangles.dtype)
 
     def _init_containers(self):
         logging.info('Initializing arrays for projection calculation.')
         tstart = timer()
 
-        # helper variables (width, height)
-        (w, h) = (self._sizex, self._sizey)
+        (self._display_pts, self._viewport_pts, self._triangles) = \
+            _get_topology(self._sizex, self._sizey, self._viewport, self._dtype)
 
-        """ display points (list of all pixel coordinates) """
+        # time me
+        tend = timer()
+        logging.info('Initializing arrays for projection calculation {:.4f} seconds'.format(tend - tstart))
 
-        self._display_pts = np.ones((2, w * h))
-        self._display_pts[0, :], self._display_pts[1, :] = \
-            zip(*[(j, i) for i in np.arange(h) for j in np.arange(w)])
 
-        """ viewport points """
-        # https://github.com/Kitware/VTK/blob/52d45496877b00852a08a5b9819d109c2fd9bfab/Rendering/Core/vtkCoordinate.h#L26
+_topologies = {}
 
-        self._viewport_pts = np.ones((4, self._display_pts.shape[1]))
-        self._viewport_pts[0, :] = 2.0 * (self._display_pts[0, :] - w * self._viewport[0]) / \
-            (w * (self._viewport[2] - self._viewport[0])) - 1.0
-        self._viewport_pts[1, :] = 2.0 * (self._display_pts[1, :] - h * self._viewport[1]) / \
-            (h * (self._viewport[3] - self._viewport[1])) - 1.0
 
-        """ new world points (just initializing the container) """
+def _get_topology(w, h, viewport, dtype=np.float64):
+    """
+    Pixel coordinates and connectivity of a depth image, shared by all the instances.
+    :return: display points (2, w*h), viewport points (4, w*h) without the z values
+      and the triangles (2*(w-1)*(h-1), 3), all to be treated as read only
+    """
+    key = (w, h, tuple(viewport), np.dtype(dtype))
+    if key in _topologies:
+        return _topologies[key]
 
-        self._world_pts = np.ones(self._viewport_pts.shape)
+    """ display points (list of all pixel coordinates) """
 
-        """ cells (list of triangles created by connecting neighbors in depth image space ) """
+    display_pts = np.ones((2, w * h))
+    display_pts[0, :] = np.tile(np.arange(w), h)
+    display_pts[1, :] = np.repeat(np.arange(h), w)
 
-        # connectivity on the depth image is almost like a checkerboard pattern
-        # except with two triangles in every checkerboard square
-        nt = (2*w)*(h-1)  # number of triangles
-        cells = np.zeros((3, nt), dtype=np.int)
-        i = 0
-        while i < (nt/2):
-            if ((i+1) % w) != 0:  # if on the side of the image skip
-                cells[:, 2*i] = (i, i+1, w+i)
-                cells[:, 2*i+1] = (i+1, w+i+1, w+i)
-            i += 1
+    """ viewport points """
+    # https://github.com/Kitware/VTK/blob/52d45496877b00852a08a5b9819d109c2fd9bfab/Rendering/Core/vtkCoordinate.h#L26
 
-        # remove columns with zeros (the ones we skipped in the while loop)
-        index = np.where(cells.any(axis=0))[0]  # all columns that are non zero
-        cells = cells[:, index]
+    viewport_pts = np.ones((4, display_pts.shape[1]), dtype=dtype)
+    viewport_pts[0, :] = 2.0 * (display_pts[0, :] - w * viewport[0]) / \
+        (w * (viewport[2] - viewport[0])) - 1.0
+    viewport_pts[1, :] = 2.0 * (display_pts[1, :] - h * viewport[1]) / \
+        (h * (viewport[3] - viewport[1])) - 1.0
 
-        # turn our connectivity list into a vtk object (vtkCellArray)
-        for tpt in cells.T:
-            self._polys.InsertNextCell(3)
-            self._polys.InsertCellPoint(tpt[0])
-            self._polys.InsertCellPoint(tpt[1])
-            self._polys.InsertCellPoint(tpt[2])
-        self._polydata.SetPolys(self._polys)
+    """ cells (list of triangles created by connecting neighbors in depth image space ) """
 
-        # time me
-        tend = timer()
-        logging.info('Initializing arrays for projection calculation {:.4f} seconds'.format(tend - tstart))
+    # connectivity on the depth image is almost like a checkerboard pattern
+    # except with two triangles in every checkerboard square
+    idx = np.arange(w * h).reshape(h, w)
+    (p00, p01, p10, p11) = (idx[:-1, :-1], idx[:-1, 1:], idx[1:, :-1], idx[1:, 1:])
+    cells = np.empty((h - 1, w - 1, 2, 3), dtype=numpy_support.get_numpy_array_type(vtk.VTK_ID_TYPE))
+    cells[:, :, 0, 0], cells[:, :, 0, 1], cells[:, :, 0, 2] = p00, p01, p10
+    cells[:, :, 1, 0], cells[:, :, 1, 1], cells[:, :, 1, 2] = p01, p11, p10
+
+    _topologies[key] = (display_pts, viewport_pts, cells.reshape(-1, 3))
+    return _topologies[key]
 
+
+_plane_fits = {}
+
+
+def _get_plane_fit(s, dtype=np.float64):
+    """
+    Least squares plane fit of the (s+1) x (s+1) pixels of a block.
+    :return: design matrix (n, 3) of the pixel coordinates and its pseudo inverse (3, n)
+    """
+    key = (s, np.dtype(dtype))
+    if key not in _plane_fits:
+        v, u = np.mgrid[0:s + 1, 0:s + 1]
+        design = np.column_stack((u.reshape(-1), v.reshape(-1), np.ones((s + 1) ** 2)))
+        _plane_fits[key] = (design.astype(dtype), np.linalg.pinv(design).astype(dtype))
+    return _plane_fits[key]
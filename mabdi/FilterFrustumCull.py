@@ -0,0 +1,70 @@
+import vtk
+from vtk.util.vtkAlgorithm import VTKPythonAlgorithmBase
+
+from Utilities import get_boxes_in_frustum
+
+import numpy as np
+
+from timeit import default_timer as timer
+import logging
+
+
+class FilterFrustumCull(VTKPythonAlgorithmBase):
+    """
+    vtkAlgorithm with input vtkPolyData and output vtkPolyData
+    Input: The global mesh from a FilterWorldMesh created with a chunk_size
+    Output: Only the chunks of the global mesh that intersect the frustum of the
+    sensor of a FilterDepthImage
+
+    Used to feed the expected depth image so that its cost follows what is in view
+    instead of the size of the whole global mesh.
+    """
+
+    def __init__(self, world_mesh, filter_depth_image):
+        """
+        :param world_mesh: FilterWorldMesh with a chunk_size, the input should also be
+          connected to its output port.
+        :param filter_depth_image: FilterDepthImage whose camera defines the frustum
+        """
+
+        VTKPythonAlgorithmBase.__init__(self,
+                                        nInputPorts=1, inputType='vtkPolyData',
+                                        nOutputPorts=1, outputType='vtkPolyData')
+
+        self._world_mesh = world_mesh
+        self._camera = filter_depth_image.get_vtk_camera()
+        self._aspect = filter_depth_image.get_width_by_height_ratio()
+
+        # only re-execute when moving the camera changes the visible chunks
+        self._visible = None
+        self._camera.AddObserver('ModifiedEvent', self._camera_modified_callback)
+
+    def get_visible_chunks(self):
+        """
+        :return: indices of the chunks of the world mesh inside the frustum
+        """
+        return get_boxes_in_frustum(self._world_mesh.get_chunk_bounds(), self._camera, self._aspect)
+
+    def _camera_modified_callback(self, obj, env):
+        visible = self.get_visible_chunks()
+        if self._visible is None or not np.array_equal(visible, self._visible):
+            self.Modified()
+
+    def RequestData(self, request, inInfo, outInfo):
+        logging.info('')
+        start = timer()
+
+        self._visible = self.get_visible_chunks()
+
+        out = vtk.vtkPolyData.GetData(outInfo)
+        out.ShallowCopy(self._world_mesh.get_chunks_polydata(self._visible))
+
+        logging.info('Visible chunks {} of {}, number of cells {}'.format(
+            self._visible.size,
+            self._world_mesh.get_chunk_bounds().shape[0],
+            out.GetNumberOfCells()))
+
+        end = timer()
+        logging.info('Execution time {:.4f} seconds'.format(end - start))
+
+        return 1
@@ -1,11 +1,17 @@
 import vtk
 from vtk.util.vtkAlgorithm import VTKPythonAlgorithmBase
-from vtk.numpy_interface import dataset_adapter as dsa
+
+from MeshStore import MeshStore
+from ChunkFileStore import ChunkFileStore
+from ChunkDecimator import ChunkDecimator
+from Utilities import polydata_to_numpy, get_boxes_in_frustum
 
 import numpy as np
+from scipy import ndimage
+from vtk.util import numpy_support
 import matplotlib.pyplot as plt
 
-from itertools import cycle
+import functools
 
 from timeit import default_timer as timer
 import logging
@@ -16,11 +22,74 @@ class FilterWorldMesh(VTKPythonAlgorithmBase):
     vtkAlgorithm with input vtkPolyData and output vtkPolyData
     Input: Surface to be added to the global mesh
     Output: The global mesh
+
+    The global mesh is kept in a MeshStore, every new surface is appended to its
+    arrays and the output is a view of them, so the cost of a frame only depends on
+    the size of the new surface. Each frame outputs a new view: the output of the
+    previous frame shares the triangles with the store, so the triangles carved or
+    simplified away at the start of a frame turn degenerate in it as well and it is
+    marked modified (see MeshStore.remove_triangles()).
+
+    Out of core the chunks are kept in a ChunkFileStore instead and only the chunks
+    used recently (the ones near the sensor) stay in memory. The output is then only
+    part of the global mesh: a MeshStore holding a copy of the resident chunks, kept
+    up to date by appending the chunks that were read back or changed and removing
+    the ones that were spilled, so it costs the chunks a frame touches. This copy and
+    the triangles removed from it count against resident_budget_mb together with the
+    resident chunks, see _evict(). get_number_of_triangles() counts the
+    whole mesh and the whole mesh is in the files, see flush(),
+    get_chunk_file_store() and ChunkFileStore.open().
+
+    Chunks that have not changed for a few frames can be simplified by a
+    ChunkDecimator in a worker thread, the results are swapped in at the start of a
+    frame if the chunk has not changed in the meantime.
+
+    With a carving_depth_image the triangles that the actual sensor sees through are
+    removed at the start of every frame (space carving), so objects that left a
+    dynamic environment do not stay in the global mesh.
     """
-    def __init__(self, color=False):
+    def __init__(self, color=False, chunk_size=None, precision='float64', weld_tolerance=None,
+                 out_of_core_path=None, resident_budget_mb=256,
+                 decimation_target=None, decimation_settle_frames=3,
+                 carving_depth_image=None, carving_margin=0.05):
         """
         :param color: default=False
-          Color every new surface of the global mesh a different color.
+          Keep the frame every triangle was added in, as uint16 cell scalars of the
+          output (the frame counter wraps around at 65536). get_lookup_table() colors
+          every frame differently and get_frame_ids() tells which frame produced each
+          triangle.
+        :param chunk_size: default=None
+          Edge length of the cubes the world is partitioned into. Every triangle goes
+          to the chunk that contains its centroid and each chunk keeps its bounding
+          box, so a consumer can take only the chunks it needs (see FilterFrustumCull).
+          None keeps the mesh in one piece.
+        :param precision: default='float64'
+          'float64' or 'float32', type of the points of the world mesh.
+        :param weld_tolerance: default=None
+          Merge new points with the points of the global mesh that are within this
+          distance (on a grid) and drop triangles that become degenerate or already
+          exist, see MeshStore. The memory saved is logged every frame and totalled in
+          get_mesh_store().get_weld_stats(). None keeps every point.
+        :param out_of_core_path: default=None
+          Folder for the chunk files of the out of core mode, needs a chunk_size. None
+          keeps the whole mesh in memory.
+        :param resident_budget_mb: default=256
+          Memory the chunks in memory and the output made of them can take in the out
+          of core mode.
+        :param decimation_target: default=None
+          Number of triangles a chunk is simplified to in the background once it has
+          more than that and has not changed for decimation_settle_frames frames,
+          needs a chunk_size. None does not simplify.
+        :param decimation_settle_frames: default=3
+        :param carving_depth_image: default=None
+          FilterDepthImage of the actual sensor. A triangle is removed when all its
+          corners are in its latest depth image and the sensor sees more than
+          carving_margin beyond every one of them (the depth image is eroded by a few
+          pixels first so the edges of objects are not carved). Needs a chunk_size,
+          only the triangles of the chunks in the frustum are tested. None never
+          removes triangles.
+        :param carving_margin: default=0.05
+          In metres.
         :return:
         """
 
@@ -28,47 +97,503 @@ class FilterWorldMesh(VTKPythonAlgorithmBase):
                                         nInputPorts=1, inputType='vtkPolyData',
                                         nOutputPorts=1, outputType='vtkPolyData')
 
-        self._worldmesh = vtk.vtkAppendPolyData()
+        if precision not in ('float64', 'float32'):
+            raise ValueError('Unknown precision {}'.format(precision))
+        self._precision = precision
+
+        self._chunk_files = None
+        if out_of_core_path:
+            if not chunk_size:
+                raise ValueError('The out of core mode needs a chunk_size')
+            self._chunk_files = ChunkFileStore(out_of_core_path, chunk_size,
+                                               dtype=np.dtype(precision),
+                                               resident_budget_mb=resident_budget_mb,
+                                               weld_tolerance=weld_tolerance)
+            # the chunks are welded in their own stores
+            weld_tolerance = None
+        self._resident_budget = int(resident_budget_mb * 1024 * 1024)
+
+        # the global mesh, or out of core the resident chunks
+        self._store = MeshStore(dtype=np.dtype(precision), weld_tolerance=weld_tolerance)
+        self._resident_chunks = set()
+        self._changed_chunks = set()
 
-        # colormap for changing polydata on every iteration
-        # http://matplotlib.org/examples/color/colormaps_reference.html
+        # spatial chunks, each one is a list of triangles of the store
+        self._chunk_size = chunk_size
+        self._chunk_keys = []
+        self._chunk_index = {}
+        self._chunk_triangles = []
+        self._chunk_bounds = np.zeros((0, 6))
+
+        # background simplification of settled chunks
+        self._frame = 0
+        self._chunk_version = []
+        self._chunk_changed_frame = []
+        self._chunk_decimated_version = []
+        self._decimation_target = decimation_target
+        self._decimation_settle_frames = decimation_settle_frames
+        self._decimator = None
+        if decimation_target:
+            if not chunk_size:
+                raise ValueError('Decimation needs a chunk_size')
+            self._decimator = ChunkDecimator()
+
+        # space carving
+        if carving_depth_image is not None and not chunk_size:
+            # without chunks every triangle would be tested every frame
+            logging.warning('carving_depth_image ignored, it needs a chunk_size')
+            carving_depth_image = None
+        self._carving_depth_image = carving_depth_image
+        self._carving_margin = carving_margin
+        self._carving_frame = None
+        self._carving_tested = 0
+        self._carving_removed = 0
+
+        # frame ids of the cells, turned into colors by the lookup table
         self._color = color
-        if self._color:
-            gist_rainbow_r = plt.cm.get_cmap(name='gist_rainbow_r')
-            mycm = gist_rainbow_r(range(160, 260, 5))[:, 0:3]
-            self._colorcycle = cycle(mycm)
+        self._lookup_table = None
 
     def RequestData(self, request, inInfo, outInfo):
         logging.info('')
         start = timer()
 
+        self._frame += 1
+        if self._decimator is not None:
+            self._swap_decimated_chunks()
+        if self._carving_depth_image is not None:
+            self._carve()
+        self._compact_if_needed()
+
         # input polydata
-        # have to make a copy otherwise polys will not show up in the render
-        # even though GetNumberOfCells() says they should be there
-        tmp = vtk.vtkPolyData.GetData(inInfo[0])
-        inp = vtk.vtkPolyData()
-        inp.ShallowCopy(tmp)
+        inp = vtk.vtkPolyData.GetData(inInfo[0])
+        points, triangles = polydata_to_numpy(inp)
 
-        # change color of all cells
+        # frame id of all the new cells
+        colors = None
         if self._color:
-            ncells = inp.GetNumberOfCells()
-            c = self._colorcycle.next()
-            vtkarray = dsa.numpyTovtkDataArray(np.tile(c, (ncells, 1)))
-            inp.GetCellData().SetScalars(vtkarray)
+            colors = np.full((triangles.shape[0], 1), self._frame % 65536, dtype=np.uint16)
 
-        # add to world mesh
-        self._worldmesh.AddInputData(inp)
-        self._worldmesh.Update()
+        out = vtk.vtkPolyData.GetData(outInfo)
+        if self._chunk_files is not None:
+            # add to the chunks, spill to disk and output what is still in memory
+            self._add_to_chunk_files(points, triangles, colors)
+            self._evict()
+            out.ShallowCopy(self._store.get_polydata())
+            logging.info('Number of cells: in = {} total = {} in memory = {}'
+                         .format(triangles.shape[0],
+                                 self._chunk_files.get_number_of_triangles(),
+                                 self._store.get_number_of_triangles() -
+                                 self._store.get_number_of_removed_triangles()))
+        else:
+            # add to world mesh
+            (first, last) = self._store.append(points, triangles, colors)
+            if self._chunk_size:
+                self._add_to_chunks(first, last)
+            logging.info('Number of cells: in = {} total = {}'
+                         .format(triangles.shape[0], self.get_number_of_triangles()))
 
-        logging.info('Number of cells: in = {} total = {}'
-                     .format(inp.GetNumberOfCells(),
-                             self._worldmesh.GetOutput().GetNumberOfCells()))
+            # output world mesh
+            out.ShallowCopy(self._store.get_polydata())
 
-        # output world mesh
-        out = vtk.vtkPolyData.GetData(outInfo)
-        out.ShallowCopy(self._worldmesh.GetOutput())
+        if self._decimator is not None:
+            self._submit_settled_chunks()
 
         end = timer()
         logging.info('Execution time {:.4f} seconds'.format(end - start))
 
         return 1
+
+    def get_frame_ids(self):
+        """
+        :return: (ntri,) view of the frame every triangle of get_mesh_store() was added
+          in (removed triangles included), None without color
+        """
+        colors = self._store.get_colors()
+        return None if colors is None else colors[:, 0]
+
+    def get_lookup_table(self):
+        """
+        Lookup table for the frame ids of the output, e.g.
+          mapper.SetLookupTable(world_mesh.get_lookup_table())
+          mapper.UseLookupTableScalarRangeOn()
+        :return: vtkLookupTable giving each frame the next color of a cycle
+        """
+        if self._lookup_table is None:
+            # colormap for changing polydata on every iteration
+            # http://matplotlib.org/examples/color/colormaps_reference.html
+            gist_rainbow_r = plt.get_cmap('gist_rainbow_r')
+            mycm = gist_rainbow_r(range(160, 260, 5))
+            table = mycm[(np.arange(65536) - 1) % mycm.shape[0]]
+
+            self._lookup_table = vtk.vtkLookupTable()
+            self._lookup_table.SetNumberOfTableValues(table.shape[0])
+            self._lookup_table.SetTableRange(-0.5, table.shape[0] - 0.5)
+            self._lookup_table.SetTable(
+                numpy_support.numpy_to_vtk(np.round(table * 255.0).astype(np.uint8), deep=1))
+        return self._lookup_table
+
+    def get_mesh_store(self):
+        """
+        :return: the MeshStore holding the global mesh, out of core only the resident
+          chunks
+        """
+        return self._store
+
+    def get_number_of_triangles(self):
+        """
+        :return: number of triangles of the whole global mesh, out of core the output
+          only has the ones of the resident chunks
+        """
+        if self._chunk_files is not None:
+            return self._chunk_files.get_number_of_triangles()
+        return self._store.get_number_of_triangles() - self._store.get_number_of_removed_triangles()
+
+    def get_chunk_file_store(self):
+        """
+        :return: the ChunkFileStore of the out of core mode or None
+        """
+        return self._chunk_files
+
+    def flush(self):
+        """
+        Write the chunks of the out of core mode and their manifest to disk.
+        """
+        if self._chunk_files is not None:
+            self._chunk_files.flush()
+
+    def close(self):
+        """
+        Stop the thread of the decimator, the filter must not run afterwards.
+        """
+        if self._decimator is not None:
+            self._decimator.close()
+
+    def get_carving_stats(self):
+        """
+        :return: dictionary with
+          * 'tested' - number of triangle tests against the actual depth image
+          * 'removed' - number of triangles removed because they were seen through
+        """
+        return {'tested': self._carving_tested,
+                'removed': self._carving_removed}
+
+    def get_chunk_bounds(self):
+        """
+        :return: (nchunks, 6) array with the bounds (xmin, xmax, ymin, ymax, zmin, zmax)
+          of every chunk
+        """
+        if self._chunk_files is not None:
+            return self._chunk_files.get_chunk_bounds()
+        return self._chunk_bounds
+
+    def get_chunk_polydata(self, chunk_id):
+        """
+        :param chunk_id: index of the chunk, a row of get_chunk_bounds()
+        :return: vtkPolyData of the chunk
+        """
+        return self.get_chunks_polydata([chunk_id])
+
+    def get_chunks_polydata(self, chunk_ids):
+        """
+        :param chunk_ids: indices of chunks, rows of get_chunk_bounds()
+        :return: vtkPolyData with the triangles of all the chunks and only the points
+          they use
+        """
+        if self._chunk_files is not None:
+            # chunks that are needed are brought back into memory
+            self._chunk_files.touch(chunk_ids)
+            return self._chunk_files.get_polydata(chunk_ids)
+        ids = [self._get_chunk_triangles(c) for c in chunk_ids]
+        ids = np.concatenate(ids) if ids else np.zeros(0, dtype=np.int64)
+        return self._store.get_polydata(ids)
+
+    def _get_chunk_triangles(self, chunk_id):
+        """
+        :return: indices of the triangles of a chunk in the store
+        """
+        pieces = self._chunk_triangles[chunk_id]
+        if len(pieces) > 1:
+            pieces[:] = [np.concatenate(pieces)]
+        return pieces[0]
+
+    def _chunk_changed(self, c):
+        while len(self._chunk_version) <= c:
+            self._chunk_version.append(0)
+            self._chunk_changed_frame.append(0)
+            self._chunk_decimated_version.append(-1)
+        self._chunk_version[c] += 1
+        self._chunk_changed_frame[c] = self._frame
+        if self._chunk_files is not None:
+            self._changed_chunks.add(c)
+
+    def _submit_settled_chunks(self):
+        """
+        Hand settled chunks that are over the target to the decimator. The worker
+        gathers the triangles itself from the current arrays of the store (or of the
+        chunk): rows are only ever appended to them or turned degenerate, which
+        changes the version of the chunk, and growing or compacting allocates new
+        arrays, so the ones handed over stay valid.
+        """
+        for c in range(len(self._chunk_version)):
+            if self._decimator.is_pending(c) or \
+                    self._chunk_decimated_version[c] == self._chunk_version[c] or \
+                    self._frame - self._chunk_changed_frame[c] < self._decimation_settle_frames:
+                continue
+            if self._chunk_files is not None:
+                ntriangles = self._chunk_files.get_number_of_triangles([c])
+                (points, triangles, colors) = self._chunk_files.get_chunk_arrays(c, copy=False)
+                ids = None
+            else:
+                ids = self._get_chunk_triangles(c)
+                ntriangles = ids.shape[0]
+                (points, triangles, colors) = (self._store.get_points(), self._store.get_triangles(),
+                                               self._store.get_colors())
+            if ntriangles <= self._decimation_target:
+                self._chunk_decimated_version[c] = self._chunk_version[c]
+                continue
+            self._decimator.submit(c, self._chunk_version[c],
+                                   functools.partial(_gather_triangles, points, triangles, colors, ids),
+                                   self._decimation_target)
+
+    def _swap_decimated_chunks(self):
+        """
+        Replace chunks by their simplified version, unless they changed since they
+        were submitted.
+        """
+        for (c, version, points, triangles, colors) in self._decimator.get_results():
+            if version != self._chunk_version[c]:
+                continue
+            self._chunk_decimated_version[c] = version
+            if points is None:
+                continue
+            if self._chunk_files is not None:
+                self._chunk_files.replace(c, points, triangles, colors)
+                self._changed_chunks.add(c)
+            else:
+                self._store.remove_triangles(self._get_chunk_triangles(c))
+                (first, last) = self._store.append(points, triangles, colors)
+                self._chunk_triangles[c] = [np.arange(first, last)]
+            logging.info('Chunk {} simplified to {} triangles'.format(c, triangles.shape[0]))
+
+    def _compact_if_needed(self):
+        """
+        Drop the removed triangles once they are half of the store, like growing the
+        store this is amortized over the frames.
+        """
+        if 2 * self._store.get_number_of_removed_triangles() > self._store.get_number_of_triangles():
+            self._compact()
+
+    def _compact(self):
+        triangle_map = self._store.compact()
+        for c in range(len(self._chunk_triangles)):
+            if self._chunk_triangles[c]:
+                self._chunk_triangles[c] = [triangle_map[self._get_chunk_triangles(c)]]
+
+    def _evict(self):
+        """
+        Out of core, keep the resident chunks and the store within the budget. The
+        store holds a copy of the resident chunks and the triangles removed from it
+        until it is compacted, so the chunks are spilled until they take 3/8 of the
+        budget, which leaves a quarter for the removed triangles, and the store is
+        compacted when they take more.
+        """
+        self._chunk_files.evict(3 * self._resident_budget // 8)
+        self._update_resident_chunks()
+        if self._chunk_files.get_resident_nbytes() + self._store.get_nbytes() > self._resident_budget:
+            self._compact()
+
+    def _update_resident_chunks(self):
+        """
+        Out of core, make the store hold a copy of every resident chunk: the chunks
+        spilled since the last frame are removed from it and the chunks read back or
+        changed are appended (again).
+        """
+        resident = set(self._chunk_files.get_resident_chunks())
+        while len(self._chunk_triangles) < len(self._chunk_files.get_chunk_bounds()):
+            self._chunk_triangles.append([])
+
+        for c in sorted((self._resident_chunks - resident) | (self._resident_chunks & self._changed_chunks)):
+            self._store.remove_triangles(self._get_chunk_triangles(c))
+            self._chunk_triangles[c] = []
+        for c in sorted((resident - self._resident_chunks) | (resident & self._changed_chunks)):
+            (points, triangles, colors) = self._chunk_files.get_chunk_arrays(c, copy=False)
+            (first, last) = self._store.append(points, triangles, colors)
+            self._chunk_triangles[c] = [np.arange(first, last)]
+
+        self._resident_chunks = resident
+        self._changed_chunks.clear()
+
+    def _carve(self):
+        """
+        Remove the triangles the latest actual depth image sees through.
+        """
+        start = timer()
+
+        image = self._carving_depth_image.GetOutputDataObject(0)
+        if image.GetPointData().GetScalars() is None or not self._set_carving_frame(image):
+            return
+        (ntested, nremoved) = (0, 0)
+
+        chunks = get_boxes_in_frustum(self.get_chunk_bounds(),
+                                      self._carving_depth_image.get_vtk_camera(),
+                                      self._carving_depth_image.get_width_by_height_ratio())
+        for c in chunks:
+            if self._chunk_files is not None:
+                (points, triangles, colors) = self._chunk_files.get_chunk_arrays(c, copy=False)
+            else:
+                ids = self._get_chunk_triangles(c)
+                (points, triangles) = (self._store.get_points(), self._store.get_triangles()[ids])
+            seen_through = self._seen_through(points, triangles)
+            ntested += triangles.shape[0]
+            if not seen_through.any():
+                continue
+            nremoved += np.count_nonzero(seen_through)
+            keep = ~seen_through
+            if self._chunk_files is not None:
+                used, tri = np.unique(triangles[keep], return_inverse=True)
+                self._chunk_files.replace(c, np.array(points[used]), tri.reshape(-1, 3),
+                                          None if colors is None else np.array(colors[keep]))
+            else:
+                self._store.remove_triangles(ids[seen_through])
+                self._chunk_triangles[c] = [ids[keep]]
+            self._chunk_changed(c)
+
+        self._carving_tested += ntested
+        self._carving_removed += nremoved
+
+        end = timer()
+        logging.info('Carved {} of {} triangles in {:.4f} seconds'.format(nremoved, ntested, end - start))
+
+    def _set_carving_frame(self, image):
+        """
+        Keep what _seen_through() needs from a depth image of FilterDepthImage: the
+        transform from world to normalized viewport coordinates, the world to camera
+        transform and the metric depth of every pixel (inf where nothing was seen),
+        eroded so every pixel takes the closest depth around it.
+
+        :return: False if the depth image has no valid pose yet, the depth images
+          rendered before the first set_sensor_orientation() look along their view up
+        """
+        if getattr(image, 'camtoworld', None) is None:
+            return False
+        camtoworld = np.asarray(image.camtoworld, dtype=np.float64)
+        if abs(np.linalg.det(camtoworld[0:3, 0:3])) < 0.5:
+            logging.debug('Carving skipped, the depth image has no valid pose yet')
+            return False
+
+        (w, h) = (image.sizex, image.sizey)
+        (n, f) = image.clipping_range
+        depth = numpy_support.vtk_to_numpy(image.GetPointData().GetScalars()).reshape(h, w)
+        if getattr(image, 'depth_mode', 'zbuffer') == 'metric':
+            depth = np.where(depth > 0.0, depth, np.inf)
+        else:
+            with np.errstate(divide='ignore'):
+                depth = np.where(depth < 1.0, n * f / (f - depth * (f - n)), np.inf)
+        depth = ndimage.minimum_filter(depth, size=5, mode='nearest')
+
+        self._carving_frame = (np.linalg.inv(np.asarray(image.tmat, dtype=np.float64)),
+                               np.linalg.inv(camtoworld), depth, image.viewport, (n, f))
+        return True
+
+    def _seen_through(self, points, triangles):
+        """
+        :param points: (npts, 3) array
+        :param triangles: (ntri, 3) array of indices into points
+        :return: boolean array, True for the triangles in front of the latest actual
+          depth image by more than the carving margin at all their corners
+        """
+        (worldtoviewport, worldtocam, depth, vp, (n, f)) = self._carving_frame
+        (h, w) = depth.shape
+        if triangles.shape[0] == 0:
+            return np.zeros(0, dtype=bool)
+
+        corners = np.asarray(points[triangles.reshape(-1)], dtype=np.float64)
+        projected = np.dot(corners, worldtoviewport[0:3, 0:3].T) + worldtoviewport[0:3, 3]
+        projected /= (np.dot(corners, worldtoviewport[3, 0:3]) + worldtoviewport[3, 3])[:, None]
+        z = -(np.dot(corners, worldtocam[2, 0:3]) + worldtocam[2, 3])
+
+        # pixel of every corner, the inverse of the viewport points of FilterDepthImageToSurface
+        x = np.rint((projected[:, 0] + 1.0) * 0.5 * w * (vp[2] - vp[0]) + w * vp[0])
+        y = np.rint((projected[:, 1] + 1.0) * 0.5 * h * (vp[3] - vp[1]) + h * vp[1])
+        inside = (x >= 0) & (x < w) & (y >= 0) & (y < h) & (z > n) & (z < f)
+
+        seen_through = inside.copy()
+        seen_through[inside] = depth[y[inside].astype(np.intp), x[inside].astype(np.intp)] > \
+            z[inside] + self._carving_margin
+        return seen_through.reshape(-1, 3).all(axis=1)
+
+    def _chunk_keys_of(self, corners):
+        """
+        :param corners: (ntri, 3, 3) corners of the triangles
+        :return: the unique chunk keys and the index into them of every triangle
+        """
+        centroids = corners.mean(axis=1)
+        keys = np.floor(centroids / self._chunk_size).astype(np.int64)
+        ukeys, inverse = np.unique(keys, axis=0, return_inverse=True)
+        return ukeys, inverse.reshape(-1)
+
+    def _add_to_chunk_files(self, points, triangles, colors):
+        """
+        Split the incoming surface by chunk and add the pieces to the chunk files.
+        """
+        if triangles.shape[0] == 0:
+            return
+        ukeys, inverse = self._chunk_keys_of(points[triangles])
+        order = np.argsort(inverse, kind='mergesort')
+        splits = np.searchsorted(inverse[order], np.arange(1, len(ukeys)))
+
+        for key, sel in zip(map(tuple, ukeys), np.split(order, splits)):
+            # only keep the points used by the triangles of this chunk
+            used, tri = np.unique(triangles[sel], return_inverse=True)
+            c = self._chunk_files.add(key, points[used], tri.reshape(-1, 3),
+                                      None if colors is None else colors[sel])
+            self._chunk_changed(c)
+
+        logging.info('{} chunks touched, {}'.format(len(ukeys), self._chunk_files.get_stats()))
+
+    def _add_to_chunks(self, first, last):
+        """
+        Sort the new triangles first ... last-1 of the store into their chunks.
+        """
+        if last == first:
+            return
+        corners = self._store.get_points()[self._store.get_triangles()[first:last]]
+        ukeys, inverse = self._chunk_keys_of(corners)
+
+        # group the new triangles by chunk
+        order = np.argsort(inverse, kind='mergesort')
+        splits = np.searchsorted(inverse[order], np.arange(1, len(ukeys)))
+        cmin = corners.min(axis=1)
+        cmax = corners.max(axis=1)
+
+        for key, sel in zip(map(tuple, ukeys), np.split(order, splits)):
+            bounds = np.empty(6)
+            bounds[0::2] = cmin[sel].min(axis=0)
+            bounds[1::2] = cmax[sel].max(axis=0)
+
+            if key not in self._chunk_index:
+                self._chunk_index[key] = len(self._chunk_keys)
+                self._chunk_keys.append(key)
+                self._chunk_triangles.append([])
+                self._chunk_bounds = np.vstack((self._chunk_bounds, bounds))
+
+            c = self._chunk_index[key]
+            self._chunk_triangles[c].append(sel + first)
+            self._chunk_changed(c)
+            self._chunk_bounds[c, 0::2] = np.minimum(self._chunk_bounds[c, 0::2], bounds[0::2])
+            self._chunk_bounds[c, 1::2] = np.maximum(self._chunk_bounds[c, 1::2], bounds[1::2])
+
+        logging.info('{} chunks touched, {} chunks total'.format(len(ukeys), len(self._chunk_keys)))
+
+
+def _gather_triangles(points, triangles, colors, ids):
+    """
+    Called by the decimator thread.
+    :param ids: indices of the triangles to take, None takes all of them
+    :return: the points, triangles and colors (or None) of the triangles, with only
+      the points they use
+    """
+    if ids is None:
+        return points, triangles, colors
+    used, tri = np.unique(triangles[ids], return_inverse=True)
+    return points[used], tri.reshape(-1, 3), None if colors is None else colors[ids]
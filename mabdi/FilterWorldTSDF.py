@@ -0,0 +1,435 @@
+import vtk
+from vtk.util.vtkAlgorithm import VTKPythonAlgorithmBase
+from vtk.util import numpy_support
+
+from MeshStore import MeshStore, _SortedKeys
+from Utilities import get_ray_table, polydata_to_numpy
+
+import numpy as np
+
+from timeit import default_timer as timer
+import logging
+
+
+class FilterWorldTSDF(VTKPythonAlgorithmBase):
+    """
+    vtkAlgorithm with input vtkImageData and output vtkPolyData
+    Input: Classified depth image (see FilterClassifier)
+    Output: Surface of the world model
+
+    Alternative to FilterDepthImageToSurface + FilterWorldMesh. The depth images are
+    fused into a truncated signed distance field (TSDF) kept in blocks of
+    block_size^3 voxels. Blocks are only allocated along the measured surfaces (within
+    the truncation distance) and found through sorted keys of their integer coordinates,
+    so the memory follows the observed volume and not the length of the mission.
+
+    Every frame only the blocks near the new measurements are updated. A block is
+    meshed again with marching cubes (with the neighbors that share its faces) once its
+    field changed by more than remesh_tolerance since it was last meshed, measuring a
+    known surface again does not mesh it again. Of those only the blocks with a
+    surface within reach, a voxel behind a measured surface in them or in their
+    neighbors, are meshed, the others only lose the triangles they had.
+    The triangles of every block are kept in a MeshStore, the triangles of a block
+    that is meshed again are removed and the new ones appended, so the output is a
+    view of the store like in FilterWorldMesh.
+
+    A measurement weighs 1 in front of the surface and up to a voxel behind it, then
+    less and less down to 0 at the truncation distance behind it, so the voxels just
+    outside the edges of an object (behind the surface along rays that graze it) do
+    not grow the object.
+
+    Pixels without a measurement (nothing seen, or thrown away by FilterClassifier
+    because they are already known) leave the field untouched.
+    """
+
+    def __init__(self, voxel_size=0.025, block_size=8, truncation=None, max_weight=64,
+                 max_blocks=None, remesh_tolerance=None, precision='float64'):
+        """
+        :param voxel_size: default=0.025
+          Edge length of a voxel in metres. The number of triangles grows with the
+          inverse square of it, 0.025 gives about as many triangles as
+          FilterDepthImageToSurface + FilterWorldMesh on the table environment at
+          320x240 (0.01 gives 5 times as many).
+        :param block_size: default=8
+          Number of voxels along the edge of a block.
+        :param truncation: default=None
+          Distance in metres beyond which the signed distance is truncated, None is
+          4 voxels.
+        :param max_weight: default=64
+          Cap of the summed weight of the measurements averaged in a voxel, so the field
+          can still follow changes.
+        :param max_blocks: default=None
+          Memory budget as a number of blocks, measurements that need more blocks are
+          dropped (and logged). None allocates blocks as needed.
+        :param remesh_tolerance: default=None
+          Largest change of the signed distance in a block in metres, summed over the
+          frames since it was last meshed, after which it is meshed again. None is a
+          quarter of a voxel.
+        :param precision: default='float64'
+          'float64' or 'float32', type of the output points. The field itself is
+          always float32.
+        """
+
+        VTKPythonAlgorithmBase.__init__(self,
+                                        nInputPorts=1, inputType='vtkImageData',
+                                        nOutputPorts=1, outputType='vtkPolyData')
+
+        if precision not in ('float64', 'float32'):
+            raise ValueError('Unknown precision {}'.format(precision))
+
+        self._voxel_size = voxel_size
+        self._block_size = block_size
+        self._truncation = truncation if truncation else 4.0 * voxel_size
+        self._max_weight = max_weight
+        self._max_blocks = max_blocks
+        self._remesh_tolerance = remesh_tolerance if remesh_tolerance else 0.25 * voxel_size
+
+        # blocks, found by their integer coordinates
+        b = block_size
+        self._block_index = _SortedKeys()
+        self._block_keys = np.zeros((0, 3), dtype=np.int64)
+        self._nblocks = 0
+        self._tsdf = np.ones((0, b, b, b), dtype=np.float32)
+        self._weight = np.zeros((0, b, b, b), dtype=np.float32)
+        # blocks with a voxel behind a measured surface (a negative distance) and the
+        # change of their field since they were last meshed
+        self._block_surface = np.zeros(0, dtype=bool)
+        self._block_change = np.zeros(0, dtype=np.float32)
+        self._block_triangles = []
+
+        # voxel coordinates inside a block, (3, b, b, b)
+        self._voxel_coords = np.array(np.meshgrid(np.arange(b), np.arange(b), np.arange(b),
+                                                  indexing='ij'), dtype=np.float64)
+
+        self._store = MeshStore(dtype=np.dtype(precision))
+        self._stats = {'blocks': 0, 'updated': 0, 'meshed': 0, 'dropped': 0}
+
+    def RequestData(self, request, inInfo, outInfo):
+        logging.info('')
+        start = timer()
+
+        inp = vtk.vtkImageData.GetData(inInfo[0])
+        (w, h) = (inp.sizex, inp.sizey)
+        depth = self._metric_depth(inp)
+
+        # metric depth and world direction of the rays of the measured pixels
+        valid = np.flatnonzero(np.isfinite(depth))
+        rays = get_ray_table(w, h, inp.view_angle, inp.viewport)[:, valid]
+        camtoworld = np.asarray(inp.camtoworld, dtype=np.float64)
+        directions = np.dot(camtoworld[0:3, 0:3], rays)
+        origin = camtoworld[0:3, 3:4]
+
+        updated = self._allocate_blocks(origin, directions, depth[valid])
+        updated = self._integrate(updated, camtoworld, depth.reshape(h, w), inp.view_angle, inp.viewport)
+        meshed = self._mesh_blocks(updated)
+
+        out = vtk.vtkPolyData.GetData(outInfo)
+        out.ShallowCopy(self._store.get_polydata())
+
+        self._stats['blocks'] = self._nblocks
+        self._stats['updated'] += updated.size
+        self._stats['meshed'] += meshed.size
+        logging.info('Blocks: updated = {} meshed = {} total = {} ({:.1f} MB), number of cells = {}'
+                     .format(updated.size, meshed.size, self._nblocks, self.get_nbytes() / 1024.0 / 1024.0,
+                             self.get_number_of_triangles()))
+
+        end = timer()
+        logging.info('Execution time {:.4f} seconds'.format(end - start))
+
+        return 1
+
+    def get_mesh_store(self):
+        """
+        :return: the MeshStore holding the triangles of all the blocks
+        """
+        return self._store
+
+    def get_number_of_triangles(self):
+        """
+        :return: number of triangles of the mesh (the output also has removed ones)
+        """
+        return self._store.get_number_of_triangles() - self._store.get_number_of_removed_triangles()
+
+    def get_nbytes(self):
+        """
+        :return: memory taken by the field and the triangles
+        """
+        n = self._nblocks
+        return self._tsdf[:n].nbytes + self._weight[:n].nbytes + self._store.get_nbytes()
+
+    def get_stats(self):
+        """
+        :return: dictionary with
+          * 'blocks' - number of blocks allocated
+          * 'updated' - number of block updates that changed the block enough to mesh it
+          * 'meshed' - number of times a block was meshed
+          * 'dropped' - number of blocks not allocated because of max_blocks
+        """
+        return dict(self._stats)
+
+    def _metric_depth(self, inp):
+        """
+        :return: flat metric depth of every pixel of the input, inf where nothing was
+          measured
+        """
+        (n, f) = inp.clipping_range
+        d = numpy_support.vtk_to_numpy(inp.GetPointData().GetScalars()).astype(np.float64)
+        if getattr(inp, 'depth_mode', 'zbuffer') == 'metric':
+            return np.where(d > 0.0, d, np.inf)
+        with np.errstate(divide='ignore'):
+            return np.where(d < 1.0, n * f / (f - d * (f - n)), np.inf)
+
+    def _allocate_blocks(self, origin, directions, depth):
+        """
+        Allocate the blocks within the truncation distance of the measured points.
+        :param origin: (3, 1) position of the camera
+        :param directions: (3, npix) rays of the pixels, unit length along the optical axis
+        :param depth: (npix,) metric depth of the pixels
+        :return: indices of the blocks to update
+        """
+        if depth.size == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        # samples at most a block apart along the rays through the truncation band
+        block = self._block_size * self._voxel_size
+        nsamples = int(np.ceil(2.0 * self._truncation / block)) + 1
+        keys = []
+        for t in np.linspace(-self._truncation, self._truncation, nsamples):
+            pts = origin + directions * (depth + t)
+            keys.append(np.floor(pts.T / block).astype(np.int64))
+        keys = np.concatenate(keys)
+        (codes, first) = np.unique(_block_codes(keys), return_index=True)
+        keys = keys[first]
+
+        ids = self._block_index.find(codes)
+        new = np.flatnonzero(ids < 0)
+        if self._max_blocks is not None and self._nblocks + new.size > self._max_blocks:
+            nfree = max(0, self._max_blocks - self._nblocks)
+            self._stats['dropped'] += new.size - nfree
+            logging.warning('TSDF block budget reached, {} blocks dropped'.format(new.size - nfree))
+            new = new[:nfree]
+        if new.size:
+            first = self._nblocks
+            self._reserve(first + new.size)
+            self._block_keys[first:first + new.size] = keys[new]
+            ids[new] = np.arange(first, first + new.size)
+            self._block_index.add(codes[new], ids[new])
+            self._block_triangles.extend(np.zeros(0, dtype=np.int64) for _ in range(new.size))
+            self._nblocks += new.size
+
+        return ids[ids >= 0]
+
+    def _find_blocks(self, keys):
+        """
+        :param keys: (n, 3) integer coordinates of blocks
+        :return: index of every block, -1 if it is not allocated
+        """
+        return self._block_index.find(_block_codes(keys))
+
+    def _reserve(self, nblocks):
+        """
+        Grow the block arrays to hold nblocks, doubling the capacity like MeshStore.
+        """
+        capacity = self._tsdf.shape[0]
+        if nblocks <= capacity:
+            return
+        capacity = max(nblocks, 2 * capacity, 64)
+        if self._max_blocks is not None:
+            capacity = max(nblocks, min(capacity, self._max_blocks))
+
+        tsdf = np.ones((capacity,) + self._tsdf.shape[1:], dtype=self._tsdf.dtype)
+        tsdf[:self._nblocks] = self._tsdf[:self._nblocks]
+        weight = np.zeros((capacity,) + self._weight.shape[1:], dtype=self._weight.dtype)
+        weight[:self._nblocks] = self._weight[:self._nblocks]
+        keys = np.zeros((capacity, 3), dtype=np.int64)
+        keys[:self._nblocks] = self._block_keys[:self._nblocks]
+        surface = np.zeros(capacity, dtype=bool)
+        surface[:self._nblocks] = self._block_surface[:self._nblocks]
+        change = np.zeros(capacity, dtype=np.float32)
+        change[:self._nblocks] = self._block_change[:self._nblocks]
+        (self._tsdf, self._weight, self._block_keys) = (tsdf, weight, keys)
+        (self._block_surface, self._block_change) = (surface, change)
+
+    def _integrate(self, blocks, camtoworld, depth, view_angle, viewport):
+        """
+        Projective signed distance of every voxel of the blocks, averaged into the field.
+        :param depth: (h, w) metric depth, inf where nothing was measured
+        :return: the blocks to mesh again, their field changed by more than the
+          remesh tolerance or a voxel was observed for the first time
+        """
+        if blocks.size == 0:
+            return blocks
+        (h, w) = depth.shape
+        vp = viewport
+
+        # voxel positions in camera coordinates
+        corners = self._block_keys[blocks] * self._block_size
+        voxels = (corners[:, :, None, None, None] + self._voxel_coords) * self._voxel_size
+        worldtocam = np.linalg.inv(camtoworld)
+        cam = np.einsum('ij,njxyz->nixyz', worldtocam[0:3, 0:3], voxels) + \
+            worldtocam[0:3, 3][:, None, None, None]
+        z = -cam[:, 2]
+
+        # pixel of every voxel, the inverse of get_ray_table()
+        tan_half = np.tan(np.radians(view_angle) / 2.0)
+        aspect = (w * (vp[2] - vp[0])) / (h * (vp[3] - vp[1]))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            xv = cam[:, 0] / (z * tan_half * aspect)
+            yv = cam[:, 1] / (z * tan_half)
+        x = np.rint((xv + 1.0) * 0.5 * w * (vp[2] - vp[0]) + w * vp[0])
+        y = np.rint((yv + 1.0) * 0.5 * h * (vp[3] - vp[1]) + h * vp[1])
+        inside = (z > 0.0) & (x >= 0) & (x < w) & (y >= 0) & (y < h)
+
+        sdf = np.full(z.shape, -np.inf)
+        sdf[inside] = depth[y[inside].astype(np.intp), x[inside].astype(np.intp)] - z[inside]
+        # in front of the surface or less than the truncation behind it
+        update = np.isfinite(sdf) & (sdf > -self._truncation)
+        sdf = sdf[update]
+        # the weight drops from a voxel behind the surface down to 0 at the truncation
+        behind = min(self._voxel_size, 0.5 * self._truncation)
+        wnew = np.clip((sdf + self._truncation) / (self._truncation - behind), 0.0, 1.0)
+        sdf = np.clip(sdf / self._truncation, -1.0, 1.0)
+
+        tsdf = self._tsdf[blocks]
+        weight = self._weight[blocks]
+        wold = weight[update]
+        told = tsdf[update]
+        tsdf[update] = (told * wold + sdf * wnew) / (wold + wnew)
+        weight[update] = np.minimum(wold + wnew, self._max_weight)
+        self._tsdf[blocks] = tsdf
+        self._weight[blocks] = weight
+        n = blocks.size
+        self._block_surface[blocks] = (tsdf < 0.0).reshape(n, -1).any(axis=1)
+
+        # largest change of a voxel of every block, infinite for a new voxel
+        change = np.zeros(tsdf.shape, dtype=np.float32)
+        change[update] = np.where(wold > 0.0, np.abs(tsdf[update] - told), np.inf)
+        self._block_change[blocks] += change.reshape(n, -1).max(axis=1) * self._truncation
+        changed = blocks[self._block_change[blocks] > self._remesh_tolerance]
+        self._block_change[changed] = 0.0
+        return changed
+
+    def _mesh_blocks(self, updated):
+        """
+        Marching cubes on the updated blocks and the blocks before them on every axis
+        (they share the faces), all in one volume with the blocks side by side along x.
+        Blocks without a surface within reach of their cubes are not meshed, they only
+        lose their triangles.
+        :return: indices of the blocks meshed
+        """
+        if updated.size == 0:
+            return updated
+        b = self._block_size
+
+        # the updated blocks and their neighbors towards -x, -y, -z
+        keys = self._block_keys[updated]
+        offsets = np.array([[i, j, k] for i in (0, -1) for j in (0, -1) for k in (0, -1)])
+        keys = np.unique((keys[:, None, :] + offsets).reshape(-1, 3), axis=0)
+        ids = self._find_blocks(keys)
+        (keys, blocks) = (keys[ids >= 0], ids[ids >= 0])
+
+        # their neighbors towards +x, +y, +z, the first layer of those closes the cubes
+        # of the block so a surface in them can be within reach
+        neighbors = np.column_stack([self._find_blocks(keys - o) for o in offsets[1:]])
+        surface = self._block_surface[blocks] | \
+            (self._block_surface[neighbors] & (neighbors >= 0)).any(axis=1)
+
+        # the blocks without a surface within reach only lose their triangles
+        cleared = [c for c in blocks[~surface] if self._block_triangles[c].size]
+        if cleared:
+            self._store.remove_triangles(np.concatenate([self._block_triangles[c] for c in cleared]))
+            for c in cleared:
+                self._block_triangles[c] = np.zeros(0, dtype=np.int64)
+        (keys, blocks, neighbors) = (keys[surface], blocks[surface], neighbors[surface])
+        n = blocks.size
+        if n == 0:
+            return blocks
+
+        # samples of every block and of the faces, edges and corner of its neighbors
+        # towards +x, +y, +z, side by side along x with a layer of unobserved samples
+        # in between: (n, b+2, b+1, b+1)
+        volume = np.ones((n, b + 2, b + 1, b + 1), dtype=np.float32)
+        weight = np.zeros((n, b + 2, b + 1, b + 1), dtype=self._weight.dtype)
+        volume[:, :b, :b, :b] = self._tsdf[blocks]
+        weight[:, :b, :b, :b] = self._weight[blocks]
+        for (neighbor, (i, j, k)) in zip(neighbors.T, -offsets[1:]):
+            found = np.flatnonzero(neighbor >= 0)
+            # first layer of the neighbor along the axes it is shifted on
+            (src, dst) = zip(*[(slice(0, 1), slice(b, b + 1)) if o else (slice(0, b), slice(0, b))
+                               for o in (i, j, k)])
+            volume[(found,) + dst] = self._tsdf[(neighbor[found],) + src]
+            weight[(found,) + dst] = self._weight[(neighbor[found],) + src]
+        observed = weight > 0
+        volume[~observed] = 1.0
+
+        # a cube is only meshed if its 8 corners were observed, the cubes that touch
+        # the layer in between never are: (n, b+2, b, b)
+        cube_observed = np.zeros((n, b + 2, b, b), dtype=bool)
+        cube_observed[:, :b] = observed[:, :b, :b, :b]
+        for (i, j, k) in -offsets[1:]:
+            cube_observed[:, :b] &= observed[:, i:b + i, j:b + j, k:b + k]
+
+        volume = volume.transpose(3, 2, 0, 1).reshape(b + 1, b + 1, n * (b + 2))
+        cube_observed = cube_observed.transpose(3, 2, 0, 1).reshape(b, b, n * (b + 2))
+
+        image = vtk.vtkImageData()
+        image.SetDimensions(n * (b + 2), b + 1, b + 1)
+        image.GetPointData().SetScalars(numpy_support.numpy_to_vtk(volume.reshape(-1), deep=0))
+        contour = vtk.vtkFlyingEdges3D()
+        contour.SetInputData(image)
+        contour.SetValue(0, 0.0)
+        contour.ComputeNormalsOff()
+        contour.ComputeGradientsOff()
+        contour.ComputeScalarsOff()
+        contour.Update()
+        (points, triangles) = polydata_to_numpy(contour.GetOutput())
+        points = points.reshape(-1, 3)
+        triangles = triangles.reshape(-1, 3)
+
+        # drop the triangles of cubes with a corner that was never observed
+        # (a triangle in the plane of the last samples belongs to the cube below it)
+        centroids = points[triangles[:, 0]] + points[triangles[:, 1]]
+        centroids += points[triangles[:, 2]]
+        centroids /= 3.0
+        cube = centroids.astype(np.intp)
+        np.minimum(cube[:, 1:], b - 1, out=cube[:, 1:])
+        keep = cube_observed[cube[:, 2], cube[:, 1], cube[:, 0]]
+        (triangles, cube) = (triangles[keep], cube[keep])
+
+        # only the points used by the triangles, renumbered
+        used_mask = np.zeros(points.shape[0], dtype=bool)
+        used_mask[triangles] = True
+        renumber = np.cumsum(used_mask) - 1
+        (points, triangles) = (points[used_mask].astype(np.float64), renumber[triangles])
+
+        # back to world coordinates, every triangle belongs to the block of its cube
+        slot = cube[:, 0] // (b + 2)
+        point_slot = np.zeros(points.shape[0], dtype=np.intp)
+        point_slot[triangles] = slot[:, None]
+        points[:, 0] -= point_slot * (b + 2)
+        points = (points + keys[point_slot] * b) * self._voxel_size
+
+        order = np.argsort(slot, kind='mergesort')
+        (triangles, slot) = (triangles[order], slot[order])
+        self._store.remove_triangles(np.concatenate([self._block_triangles[c] for c in blocks]))
+        (first, last) = self._store.append(points, triangles)
+        bounds = np.searchsorted(slot, np.arange(n + 1))
+        for s, c in enumerate(blocks):
+            self._block_triangles[c] = np.arange(first + bounds[s], first + bounds[s + 1])
+
+        # drop the removed triangles once they are half of the store
+        if 2 * self._store.get_number_of_removed_triangles() > self._store.get_number_of_triangles():
+            triangle_map = self._store.compact()
+            for c in range(self._nblocks):
+                self._block_triangles[c] = triangle_map[self._block_triangles[c]]
+
+        return blocks
+
+
+def _block_codes(keys):
+    """
+    :param keys: (n, 3) integer coordinates of blocks, within +-2^20 on every axis
+    :return: (n,) int64 code of every block, the keys of _SortedKeys
+    """
+    q = keys + 2 ** 20
+    return (q[:, 0] << 42) | (q[:, 1] << 21) | q[:, 2]
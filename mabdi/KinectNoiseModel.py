@@ -0,0 +1,106 @@
+from Utilities import NoiseBank
+
+import functools
+
+import numpy as np
+
+from timeit import default_timer as timer
+import logging
+
+
+class KinectNoiseModel(object):
+    """
+    Depth dependent noise of the Kinect (see resources/kinect_error_model.pdf)
+
+    Axial noise is gaussian along the optical axis with a standard deviation that
+    grows quadratically with the metric depth z
+      sigma_z(z) = a + b (z - c)^2
+    Lateral noise moves every pixel by a gaussian offset of sigma_l pixels, which
+    mostly shows up on depth edges.
+
+    The gaussian samples and the shifted pixel indices are generated ahead of time by
+    a NoiseBank, so adding the noise is a lookup and a scale.
+    """
+
+    def __init__(self,
+                 depth_image_size=(640, 480),
+                 axial=(0.0012, 0.0019, 0.4),
+                 lateral=0.8,
+                 seed=None,
+                 nbanks=4):
+        """
+        :param depth_image_size: default=(640, 480)
+          Size of the depth image.
+        :param axial: default=(0.0012, 0.0019, 0.4)
+          Coefficients (a, b, c) of sigma_z(z) = a + b (z - c)^2 in metres.
+        :param lateral: default=0.8
+          Standard deviation of the lateral noise in pixels, 0 disables it.
+        :param seed: default=None
+          Seed of the random generator.
+        :param nbanks: default=4
+          Number of frames of noise kept ready by the background thread.
+        """
+        self._size = tuple(depth_image_size)
+        self._axial = axial
+        self._lateral = lateral
+        self._bank = NoiseBank(functools.partial(KinectNoiseModel._generate, self._size, lateral),
+                               seed=seed, nbanks=nbanks)
+
+    def close(self):
+        """
+        Stop the background thread, add_noise() must not be called after this.
+        """
+        self._bank.close()
+
+    def add_noise(self, depth, clipping_range):
+        """
+        Add noise in place.
+        :param depth: numpy array of z-buffer values with width*height elements,
+          1.0 where nothing was seen
+        :param clipping_range: (near, far) of the camera that produced the depth
+        """
+        start = timer()
+
+        (axial_samples, index) = self._bank.get()
+        (n, f) = clipping_range
+        (a, b, c) = self._axial
+
+        d = depth.reshape(-1)
+        if index is not None:
+            d[:] = d.take(index)
+        background = d >= 1.0
+
+        # metric depth along the optical axis
+        z = n * f / (f - d * (f - n))
+
+        # z += (a + b (z - c)^2) * gaussian
+        sigma = z - c
+        sigma *= sigma
+        sigma *= b
+        sigma += a
+        sigma *= axial_samples
+        z += sigma
+
+        # back to z-buffer values, d = f (z - n) / (z (f - n))
+        d[:] = f / (f - n) * (1.0 - n / z)
+        d[background] = 1.0
+
+        end = timer()
+        logging.debug('Kinect noise time {:.4f} seconds'.format(end - start))
+
+    @staticmethod
+    def _generate(size, lateral, rng):
+        """
+        One frame of noise: the axial gaussian samples and the flat index of the pixel
+        each pixel is moved to by the lateral noise. Called by the NoiseBank thread.
+        """
+        (w, h) = size
+        axial_samples = rng.standard_normal(w * h, dtype=np.float32)
+        if not lateral:
+            return axial_samples, None
+
+        offsets = rng.standard_normal((2, h, w), dtype=np.float32)
+        offsets *= lateral
+        x = np.clip(np.rint(offsets[0] + np.arange(w)), 0, w - 1).astype(np.intp)
+        y = np.clip(np.rint(offsets[1] + np.arange(h)[:, None]), 0, h - 1).astype(np.intp)
+        return axial_samples, (y * w + x).reshape(-1)
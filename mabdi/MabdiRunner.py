@@ -0,0 +1,191 @@
+import mabdi
+
+import os
+import json
+import time
+import traceback
+import multiprocessing
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+from collections import OrderedDict
+
+import logging
+from timeit import default_timer as timer
+
+
+class MabdiRunner(object):
+    """
+    Run MabdiSimulate for many configurations in a pool of processes
+
+    Every run is a (mabdi_param, sim_param, output) tuple as given to MabdiSimulate
+    and gets a process of its own, so its render windows (all offscreen) and VTK
+    state are gone when it finishes. Every run needs its own output['folder_name'],
+    a run that finished writes a completed.json to its folder and is skipped when
+    the runner is started again with resume. A run that raises or whose process
+    dies (a crash of VTK, os._exit) does not stop the others, it is reported in the
+    summary, which is written even if the runner is interrupted.
+
+    Scripts using it should only start the runner under if __name__ == '__main__'.
+    """
+
+    def __init__(self, runs, nprocesses=None, resume=True, output_dir='../output/'):
+        """
+        :param runs: list of (mabdi_param, sim_param, output)
+        :param nprocesses: default=None
+          Number of runs at the same time, None is the number of cpus.
+        :param resume: default=True
+          Skip the runs that have a completed.json in their folder.
+        :param output_dir: default='../output/'
+          Folder that the folders of the runs are made in.
+        """
+        self._runs = []
+        for i, run in enumerate(runs):
+            (mabdi_param, sim_param, output) = [dict(p) if p else {} for p in run]
+            if not output.get('folder_name'):
+                raise ValueError('Run {} needs an output folder_name'.format(i))
+            output['offscreen'] = True
+            output['output_dir'] = output_dir
+            self._runs.append((mabdi_param, sim_param, output))
+
+        folder_names = [output['folder_name'] for (_, _, output) in self._runs]
+        duplicates = set(f for f in folder_names if folder_names.count(f) > 1)
+        if duplicates:
+            raise ValueError('Runs share the output folder_name {}'.format(sorted(duplicates)))
+
+        self._nprocesses = nprocesses
+        self._resume = resume
+        self._output_dir = output_dir
+        self._results = []
+
+    def run(self):
+        """
+        :return: list of the results, see get_results
+        """
+        logging.info('')
+        start = timer()
+
+        self._results = []
+        todo = []
+        for i, run in enumerate(self._runs):
+            folder_name = run[2]['folder_name']
+            if self._resume and os.path.exists(_completed_file(folder_name, self._output_dir, create=False)):
+                self._results.append({'run': i, 'folder_name': folder_name, 'status': 'skipped',
+                                      'seconds': 0.0, 'error': None})
+            else:
+                todo.append((i, run))
+        logging.info('{} runs, {} skipped'.format(len(self._runs), len(self._runs) - len(todo)))
+
+        # a new process for every run, at most nprocesses at a time
+        nprocesses = self._nprocesses or multiprocessing.cpu_count()
+        results = multiprocessing.Queue()
+        running = OrderedDict()  # run index -> (process, folder_name, start time)
+        reported = set()
+        try:
+            while todo or running:
+                while todo and len(running) < nprocesses:
+                    (i, run) = todo.pop(0)
+                    process = multiprocessing.Process(target=_run_simulation, args=(i, run, results))
+                    process.start()
+                    running[i] = (process, run[2]['folder_name'], timer())
+
+                try:
+                    self._add_result(results.get(timeout=1.0), reported)
+                except Empty:
+                    pass
+
+                # a process that is gone without a result died without raising, e.g.
+                # a crash of vtk or os._exit, it must not stop the others
+                for i, (process, folder_name, started) in list(running.items()):
+                    if process.exitcode is None:
+                        continue
+                    while i not in reported:
+                        try:
+                            self._add_result(results.get_nowait(), reported)
+                        except Empty:
+                            self._add_result({'run': i, 'folder_name': folder_name, 'status': 'failed',
+                                              'seconds': timer() - started,
+                                              'error': 'exit code {}'.format(process.exitcode)}, reported)
+                    process.join()
+                    del running[i]
+        except BaseException:
+            for (process, _, _) in running.values():
+                process.terminate()
+            raise
+        finally:
+            for (process, _, _) in running.values():
+                process.join()
+
+            self._results.sort(key=lambda r: r['run'])
+            self._write_summary()
+
+        end = timer()
+        logging.info('Execution time {:.4f} seconds'.format(end - start))
+
+        return self._results
+
+    def _add_result(self, result, reported):
+        self._results.append(result)
+        reported.add(result['run'])
+        logging.info('Run {} {} {} in {:.1f} seconds ({} of {})'.format(
+            result['run'], result['folder_name'], result['status'], result['seconds'],
+            len(self._results), len(self._runs)))
+
+    def get_results(self):
+        """
+        :return: list with a dictionary per run with
+          * 'run' - index of the run
+          * 'folder_name' - output folder of the run
+          * 'status' - 'completed', 'skipped' or 'failed'
+          * 'seconds' - time the run took
+          * 'error' - traceback of a failed run or 'exit code N' if its process died,
+            else None
+        """
+        return self._results
+
+    def get_failures(self):
+        return [r for r in self._results if r['status'] == 'failed']
+
+    def _write_summary(self):
+        counts = {s: sum(r['status'] == s for r in self._results) for s in ('completed', 'skipped', 'failed')}
+        logging.info('{completed} completed, {skipped} skipped, {failed} failed'.format(**counts))
+        for r in self.get_failures():
+            logging.error('Run {} {} failed: {}'.format(r['run'], r['folder_name'],
+                                                       r['error'].strip().splitlines()[-1]))
+
+        summary_file = mabdi.get_file_prefix(None, self._output_dir, 'runner_summary.json') + 'runner_summary.json'
+        with open(summary_file, 'w') as f:
+            json.dump({'counts': counts, 'results': self._results}, f, indent=1)
+        logging.info('Summary written to {}'.format(summary_file))
+
+
+def _completed_file(folder_name, output_dir, create=True):
+    return mabdi.get_output_folder(folder_name, output_dir, create) + 'completed.json'
+
+
+def _run_simulation(i, run, results):
+    """
+    Run one MabdiSimulate in a process of its own and put its result in results.
+    """
+    (mabdi_param, sim_param, output) = run
+    folder_name = output['folder_name']
+    start = timer()
+    try:
+        sim = mabdi.MabdiSimulate(mabdi_param, sim_param, output)
+        sim.run()
+        file_prefix = sim._file_prefix
+        del sim
+    except Exception:
+        results.put({'run': i, 'folder_name': folder_name, 'status': 'failed',
+                     'seconds': timer() - start, 'error': traceback.format_exc()})
+        return
+
+    end = timer()
+    with open(_completed_file(folder_name, output['output_dir']), 'w') as f:
+        json.dump({'file_prefix': file_prefix,
+                   'seconds': end - start,
+                   'finished': time.strftime('%Y-%m-%d %H:%M:%S')}, f, indent=1)
+    results.put({'run': i, 'folder_name': folder_name, 'status': 'completed',
+                 'seconds': end - start, 'error': None})
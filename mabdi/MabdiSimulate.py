@@ -1,4 +1,6 @@
 import os
+import json
+import functools
 
 import vtk
 from vtk.util.colors import eggshell, slate_grey_light, red, yellow, salmon, blue, hot_pink
@@ -42,22 +44,76 @@ class MabdiSimulate(object):
 
         mabdi_param = {} if not mabdi_param else mabdi_param
         mabdi_param.setdefault('depth_image_size', (640, 480))
+        mabdi_param.setdefault('depth_mode', 'zbuffer')  # 'zbuffer' 'metric', see FilterDepthImage
+        mabdi_param.setdefault('metric_working_depth', 2.0)  # metres, where the metric defaults match the z-buffer ones
+        if mabdi_param['depth_mode'] == 'metric':
+            # the z-buffer defaults below in metres at the working depth, for the
+            # clipping range of FilterDepthImage. A z-buffer threshold in metres grows
+            # with the square of the depth, so these are a separate tuning: looser than
+            # the z-buffer ones closer than the working depth and stricter beyond it.
+            # Both modes classify the same pixels except the ones with a difference in
+            # between (see scripts/TestFilterClassifier.py), and on the table
+            # environment the metric mode makes about 18% more triangles.
+            clipping_range = (0.8, 4.0)
+            to_metres = functools.partial(mabdi.zbuffer_to_metric_difference,
+                                          depth=mabdi_param['metric_working_depth'],
+                                          clipping_range=clipping_range)
+            mabdi_param.setdefault('farplane_threshold', clipping_range[1])
+            mabdi_param.setdefault('convolution_threshold', to_metres(0.01))
+            mabdi_param.setdefault('classifier_threshold', to_metres(0.01))
+            mabdi_param.setdefault('surface_quadtree_tolerance', to_metres(0.0005))
         mabdi_param.setdefault('farplane_threshold', 1.0)  # see FilterDepthImageToSurface
         mabdi_param.setdefault('convolution_threshold', 0.01)  # see FilterDepthImageToSurface
         mabdi_param.setdefault('classifier_threshold', 0.01)  # see FilterClassifier
+        mabdi_param.setdefault('classifier_block_size', 16)  # None triangulates the whole image, see FilterClassifier
+        mabdi_param.setdefault('surface_quadtree_max_block_size', None)  # e.g. 32, see FilterDepthImageToSurface
+        mabdi_param.setdefault('surface_quadtree_tolerance', 0.0005)  # see FilterDepthImageToSurface
+        mabdi_param.setdefault('sensor_depth_backend', 'opengl')  # 'opengl' 'raycast', see FilterDepthImage
+        mabdi_param.setdefault('expected_depth_backend', 'opengl')  # 'opengl' 'raycast', see FilterDepthImage
+        mabdi_param.setdefault('depth_buffer_pool', 0)  # ring of reused depth buffers, see FilterDepthImage
+        mabdi_param.setdefault('sensor_precompute_path', False)  # render the whole path at once, static environments only
+        mabdi_param.setdefault('shared_render_context', False)  # one render window for both depth filters (opengl)
+        mabdi_param.setdefault('depth_cache_size_mb', 0)  # LRU cache of depth images, see FilterDepthImage
+        mabdi_param.setdefault('world_mesh_chunk_size', None)  # frustum cull the expected image, see FilterWorldMesh
+        mabdi_param.setdefault('precision', 'float64')  # 'float64' 'float32', numeric type of the mabdi filters
+        mabdi_param.setdefault('world_mesh_weld_tolerance', None)  # merge points, see FilterWorldMesh
+        mabdi_param.setdefault('world_mesh_out_of_core', False)  # chunks in files, needs world_mesh_chunk_size
+        mabdi_param.setdefault('world_mesh_resident_budget_mb', 256)  # see FilterWorldMesh
+        mabdi_param.setdefault('world_mesh_decimation_target', None)  # triangles per chunk, needs world_mesh_chunk_size
+        mabdi_param.setdefault('world_mesh_decimation_settle_frames', 3)  # see FilterWorldMesh
+        mabdi_param.setdefault('world_mesh_carving', False)  # remove what the sensor sees through, needs world_mesh_chunk_size
+        mabdi_param.setdefault('world_mesh_carving_margin', 0.05)  # metres, see FilterWorldMesh
+        mabdi_param.setdefault('world_model', 'mesh')  # 'mesh' 'tsdf', FilterWorldMesh or FilterWorldTSDF
+        mabdi_param.setdefault('tsdf_voxel_size', 0.025)  # metres, see FilterWorldTSDF
+        mabdi_param.setdefault('tsdf_block_size', 8)  # voxels, see FilterWorldTSDF
+        mabdi_param.setdefault('tsdf_truncation', None)  # metres, see FilterWorldTSDF
+        mabdi_param.setdefault('tsdf_max_blocks', None)  # memory budget, see FilterWorldTSDF
+        if mabdi_param['world_model'] not in ('mesh', 'tsdf'):
+            raise ValueError('Unknown world_model {}'.format(mabdi_param['world_model']))
+        if mabdi_param['world_model'] == 'tsdf' and mabdi_param['world_mesh_chunk_size']:
+            logging.warning('world_mesh_chunk_size ignored, it needs world_model mesh')
+            mabdi_param['world_mesh_chunk_size'] = None
+        self._mabdi_param = mabdi_param
 
         sim_param = {} if not sim_param else sim_param
-        sim_param.setdefault('environment_name', 'table')
+        sim_param.setdefault('environment_name', 'table')  # 'table' 'stanford_bunny' 'procedural' 'mesh_files'
         sim_param.setdefault('stanford_bunny_nbunnies', 1)
+        sim_param.setdefault('procedural_nobjects', 100)  # see SourceProcedural
+        sim_param.setdefault('procedural_floor_size', (10.0, 10.0))  # metres along x and z, see SourceProcedural
+        sim_param.setdefault('procedural_seed', 0)  # see SourceProcedural
+        sim_param.setdefault('procedural_object_mix', None)  # see SourceProcedural
+        sim_param.setdefault('mesh_files_manifest', None)  # .json file or dictionary, see SourceMeshFiles
         sim_param.setdefault('dynamic_environment', [(-1, -1)])  # values that won't do anything, (frame_number, object_id)
         sim_param.setdefault('dynamic_environment_init_state', None)
         sim_param.setdefault('path_name', 'helix_table_ub')
         sim_param.setdefault('path_nsteps', 20)
-        sim_param.setdefault('noise', False)  # you can also specify a number instead of a bool, default is 0.002
+        sim_param.setdefault('noise', False)  # a number instead of a bool (default is 0.002) or 'kinect'
+        sim_param.setdefault('noise_seed', None)
         sim_param.setdefault('interactive', False)
         self._sim_param = sim_param
 
         output = {} if not output else output
+        output.setdefault('output_dir', '../output/')  # folder_name is made in it
         output.setdefault('folder_name', None)
         output.setdefault('movie', False)
         output.setdefault('movie_fps', 3)
@@ -72,28 +128,110 @@ class MabdiSimulate(object):
         output.setdefault('postflight_fps', 3)
         output.setdefault('path_flight', 'helix_survey_ub')
         output.setdefault('save_global_mesh', False)
+        output.setdefault('offscreen', False)  # render the scenario window offscreen, e.g. for MabdiRunner
+        if output['offscreen'] and sim_param['interactive']:
+            logging.warning('interactive ignored, it needs offscreen False')
+            sim_param['interactive'] = False
         self._output = output
 
-        self._file_prefix = mabdi.get_file_prefix(output['folder_name'])
+        # the parameters of the run claim the file prefix
+        self._file_prefix = mabdi.get_file_prefix(output['folder_name'], output['output_dir'],
+                                                  'parameters.json')
+        with open(self._file_prefix + 'parameters.json', 'w') as f:
+            json.dump({'mabdi_param': mabdi_param, 'sim_param': sim_param, 'output': output},
+                      f, indent=1, sort_keys=True, default=str)
 
         """ Filters and sources (this block is basically the core of MABDI) """
 
-        if sim_param['environment_name'] is 'table':
+        if sim_param['environment_name'] == 'table':
             self.source = mabdi.SourceEnvironmentTable()
-        elif sim_param['environment_name'] is 'stanford_bunny':
+        elif sim_param['environment_name'] == 'stanford_bunny':
             self.source = mabdi.SourceStandfordBunny(sim_param['stanford_bunny_nbunnies'])
+        elif sim_param['environment_name'] == 'procedural':
+            self.source = mabdi.SourceProcedural(nobjects=sim_param['procedural_nobjects'],
+                                                 floor_size=sim_param['procedural_floor_size'],
+                                                 seed=sim_param['procedural_seed'],
+                                                 object_mix=sim_param['procedural_object_mix'])
+        elif sim_param['environment_name'] == 'mesh_files':
+            if not sim_param['mesh_files_manifest']:
+                raise ValueError('environment_name mesh_files needs mesh_files_manifest')
+            self.source = mabdi.SourceMeshFiles(sim_param['mesh_files_manifest'])
+        else:
+            raise ValueError('Unknown environment_name {}'.format(sim_param['environment_name']))
+        # both depth filters always render from the same pose, so they can share
+        # one offscreen render window and camera
+        self.render_context = None
+        if mabdi_param['shared_render_context']:
+            if (mabdi_param['sensor_depth_backend'], mabdi_param['expected_depth_backend']) == \
+                    ('opengl', 'opengl'):
+                self.render_context = mabdi.SharedRenderContext(
+                    nslots=2,
+                    depth_image_size=mabdi_param['depth_image_size'],
+                    offscreen=True)
+            else:
+                logging.warning('shared_render_context ignored, it needs the opengl backend')
+        # the shared context moves the sensor itself, the filters never look up a pose
+        if self.render_context and mabdi_param['depth_cache_size_mb']:
+            logging.warning('depth_cache_size_mb ignored, the render context is shared')
+            mabdi_param['depth_cache_size_mb'] = 0
         self.di = mabdi.FilterDepthImage(offscreen=True,
                                          name='sensor',
                                          noise=sim_param['noise'],
-                                         depth_image_size=mabdi_param['depth_image_size'])
+                                         depth_image_size=mabdi_param['depth_image_size'],
+                                         backend=mabdi_param['sensor_depth_backend'],
+                                         buffer_pool=mabdi_param['depth_buffer_pool'],
+                                         depth_mode=mabdi_param['depth_mode'],
+                                         render_context=self.render_context,
+                                         cache_size_mb=mabdi_param['depth_cache_size_mb'],
+                                         noise_seed=sim_param['noise_seed'],
+                                         precision=mabdi_param['precision'])
         self.sdi = mabdi.FilterDepthImage(offscreen=True,
                                           name='simulated sensor',
-                                          depth_image_size=mabdi_param['depth_image_size'])
-        self.classifier = mabdi.FilterClassifier()
+                                          depth_image_size=mabdi_param['depth_image_size'],
+                                          backend=mabdi_param['expected_depth_backend'],
+                                          buffer_pool=mabdi_param['depth_buffer_pool'],
+                                          depth_mode=mabdi_param['depth_mode'],
+                                          render_context=self.render_context,
+                                          cache_size_mb=mabdi_param['depth_cache_size_mb'],
+                                          noise_seed=sim_param['noise_seed'],
+                                          precision=mabdi_param['precision'])
+        self.classifier = mabdi.FilterClassifier(
+            param_classifier_threshold=mabdi_param['classifier_threshold'],
+            param_block_size=mabdi_param['classifier_block_size'],
+            precision=mabdi_param['precision'])
         self.surf = mabdi.FilterDepthImageToSurface(
             param_farplane_threshold=mabdi_param['farplane_threshold'],
-            param_convolution_threshold=mabdi_param['convolution_threshold'])
-        self.mesh = mabdi.FilterWorldMesh(color=True)
+            param_convolution_threshold=mabdi_param['convolution_threshold'],
+            param_quadtree_max_block_size=mabdi_param['surface_quadtree_max_block_size'],
+            param_quadtree_tolerance=mabdi_param['surface_quadtree_tolerance'],
+            precision=mabdi_param['precision'])
+        # the chunks of the world mesh can be kept in files next to the other output
+        self._chunk_path = None
+        if mabdi_param['world_mesh_out_of_core']:
+            if mabdi_param['world_mesh_chunk_size']:
+                self._chunk_path = self._file_prefix + 'world_mesh_chunks'
+            else:
+                logging.warning('world_mesh_out_of_core ignored, it needs world_mesh_chunk_size')
+        if mabdi_param['world_mesh_carving'] and not mabdi_param['world_mesh_chunk_size']:
+            logging.warning('world_mesh_carving ignored, it needs world_mesh_chunk_size')
+            mabdi_param['world_mesh_carving'] = False
+        if mabdi_param['world_model'] == 'tsdf':
+            self.mesh = mabdi.FilterWorldTSDF(voxel_size=mabdi_param['tsdf_voxel_size'],
+                                              block_size=mabdi_param['tsdf_block_size'],
+                                              truncation=mabdi_param['tsdf_truncation'],
+                                              max_blocks=mabdi_param['tsdf_max_blocks'],
+                                              precision=mabdi_param['precision'])
+        else:
+            self.mesh = mabdi.FilterWorldMesh(color=True,
+                                              chunk_size=mabdi_param['world_mesh_chunk_size'],
+                                              precision=mabdi_param['precision'],
+                                              weld_tolerance=mabdi_param['world_mesh_weld_tolerance'],
+                                              out_of_core_path=self._chunk_path,
+                                              resident_budget_mb=mabdi_param['world_mesh_resident_budget_mb'],
+                                              decimation_target=mabdi_param['world_mesh_decimation_target'],
+                                              decimation_settle_frames=mabdi_param['world_mesh_decimation_settle_frames'],
+                                              carving_depth_image=self.di if mabdi_param['world_mesh_carving'] else None,
+                                              carving_margin=mabdi_param['world_mesh_carving_margin'])
 
         self.di.set_polydata(self.source)
 
@@ -104,9 +242,19 @@ class MabdiSimulate(object):
 
         self.surf.SetInputConnection(self.classifier.GetOutputPort())
 
-        self.mesh.SetInputConnection(self.surf.GetOutputPort())
+        # the tsdf fuses the classified depth images itself
+        if mabdi_param['world_model'] == 'tsdf':
+            self.mesh.SetInputConnection(self.classifier.GetOutputPort())
+        else:
+            self.mesh.SetInputConnection(self.surf.GetOutputPort())
 
-        self.sdi.set_polydata(self.mesh)
+        # the simulated sensor only renders the chunks of the world mesh in its view
+        if mabdi_param['world_mesh_chunk_size']:
+            self.cull = mabdi.FilterFrustumCull(self.mesh, self.sdi)
+            self.cull.SetInputConnection(self.mesh.GetOutputPort())
+            self.sdi.set_polydata(self.cull)
+        else:
+            self.sdi.set_polydata(self.mesh)
 
         # get bounds of the source without the floor
         self.source.bounds, self.source.position, self.source.lookat = \
@@ -135,12 +283,17 @@ class MabdiSimulate(object):
 
         meshAo = mabdi.VTKPolyDataActorObjects(self.mesh)
         meshAo.actor.GetProperty().SetColor(salmon)
+        if mabdi_param['world_model'] == 'mesh':
+            meshAo.mapper.SetLookupTable(self.mesh.get_lookup_table())
+            meshAo.mapper.UseLookupTableScalarRangeOn()
         meshAo.actor.GetProperty().SetOpacity(0.5)
 
         """ Render objects """
 
         self.renWin = vtk.vtkRenderWindow()
         self.renWin.SetSize(640 * 2, 480 * 1)
+        if output['offscreen']:
+            self.renWin.SetOffScreenRendering(1)
         self.iren = vtk.vtkRenderWindowInteractor()
         self.iren.SetRenderWindow(self.renWin)
 
@@ -208,12 +361,25 @@ class MabdiSimulate(object):
         de = self._sim_param['dynamic_environment']  # dynamic environment
         defn, deobjn = zip(*de)  # frame number, objnumber
 
+        # the sensor sees the same environment along the whole path, so all the
+        # depth images can be rendered in one batch before the main loop
+        if self._mabdi_param['sensor_precompute_path']:
+            if self.render_context:
+                logging.warning('sensor_precompute_path ignored, the render context is shared')
+            elif max(defn) < 0:
+                self.di.precompute_poses(self.position, self.lookat)
+            else:
+                logging.warning('sensor_precompute_path ignored, the environment is dynamic')
+
         for i, (pos, lka) in enumerate(zip(self.position, self.lookat)):
             logging.debug('START MAIN LOOP')
             start = timer()
 
-            self.di.set_sensor_orientation(pos, lka)
-            self.sdi.set_sensor_orientation(pos, lka)
+            if self.render_context:
+                self.render_context.set_sensor_orientation(pos, lka)
+            else:
+                self.di.set_sensor_orientation(pos, lka)
+                self.sdi.set_sensor_orientation(pos, lka)
 
             if i in defn:
                 ind = defn.index(i)
@@ -251,18 +417,30 @@ class MabdiSimulate(object):
                                 fps=self._output['postflight_fps'])
             # mabdi.MovieNamesList.write_movie_list(self._file_prefix) # has a bug
 
+        # the chunk files can be opened again with ChunkFileStore.open()
+        if self._mabdi_param['world_model'] == 'mesh':
+            self.mesh.flush()
+
         if self._output['save_global_mesh']:
             plywriter = vtk.vtkPLYWriter()
             plywriter.SetFileName(self._file_prefix + 'global_mesh.ply')
-            plywriter.SetInputConnection(self.mesh.GetOutputPort())
+            if self._chunk_path:
+                plywriter.SetInputData(mabdi.ChunkFileStore.open(self._chunk_path).get_polydata())
+            else:
+                plywriter.SetInputConnection(self.mesh.GetOutputPort())
             plywriter.Write()
 
-        pp.save_plots()
+        if self._output['movie']:
+            pp.save_plots()
 
         """ Exit gracefully """
 
         self.di.kill_render_window()
         self.sdi.kill_render_window()
+        if self._mabdi_param['world_model'] == 'mesh':
+            self.mesh.close()
+        if self.render_context:
+            self.render_context.kill_render_window()
 
         self.iren.GetRenderWindow().Finalize()
         self.iren.TerminateApp()
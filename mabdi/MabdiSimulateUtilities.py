@@ -83,9 +83,12 @@ def find_bounds_and_observation_position_lookat(vtk_algorithm):
     """
     bounds = []
     if callable(vtk_algorithm.set_object_state):
+        # the output of the sources has the points of all the objects, get_bounds()
+        # only has the objects in the environment
+        get_bounds = getattr(vtk_algorithm, 'get_bounds', vtk_algorithm.GetOutputDataObject(0).GetBounds)
         vtk_algorithm.set_object_state(object_id='floor', state=False)
         vtk_algorithm.Update()
-        bounds = vtk_algorithm.GetOutputDataObject(0).GetBounds()
+        bounds = get_bounds()
         vtk_algorithm.set_object_state(object_id='floor', state=True)
         vtk_algorithm.Update()
     else:
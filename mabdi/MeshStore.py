@@ -0,0 +1,374 @@
+import vtk
+from vtk.util import numpy_support
+
+from Utilities import numpy_to_cell_array
+
+import numpy as np
+
+import logging
+
+
+class MeshStore(object):
+    """
+    Append only triangle mesh kept in growable numpy arrays
+
+    The point, triangle and color arrays have a capacity that is doubled when an
+    append does not fit, so appending a surface costs the size of the surface
+    (amortized) instead of the size of the whole mesh. get_polydata() wraps the
+    filled part of the arrays in a vtkPolyData without copying.
+
+    Triangles can be removed (see remove_triangles()), they are left in the arrays as
+    degenerate triangles until compact() is called. Removing writes to the triangle
+    array in place, so it also shows in the vtkPolyData already handed out that share
+    it, they are marked modified so the pipeline and the mappers see the change.
+
+    Optionally new points are welded to the points already in the store: points are
+    quantized to a grid with a cell size of weld_tolerance and points in the same
+    cell are merged (the first one is kept). Triangles that become degenerate or
+    that are already in the store are dropped. The quantized points and the
+    triangles are looked up in sorted arrays of keys, see _SortedKeys.
+    """
+
+    def __init__(self, dtype=np.float64, capacity=4096, weld_tolerance=None):
+        """
+        :param dtype: default=np.float64
+          Type of the points.
+        :param capacity: default=4096
+          Initial number of points and triangles that fit without growing.
+        :param weld_tolerance: default=None
+          Cell size of the grid used to merge points, None does not weld. The grid
+          spans +-2^20 cells on every axis around the origin.
+        """
+        self._id_type = numpy_support.get_numpy_array_type(vtk.VTK_ID_TYPE)
+        self._npoints = 0
+        self._ntriangles = 0
+        self._points = np.empty((capacity, 3), dtype=dtype)
+        self._triangles = np.empty((capacity, 3), dtype=self._id_type)
+        self._offsets = np.arange(0, 3 * capacity + 1, 3, dtype=self._id_type)
+        self._colors = None
+        self._nremoved = 0
+        # weak references to the cell arrays handed out that share self._triangles
+        self._shared_polys = []
+
+        self._weld_tolerance = weld_tolerance
+        self._point_keys = _SortedKeys()
+        self._triangle_keys = _SortedKeys()
+        self._weld_stats = {'points_merged': 0, 'triangles_dropped': 0, 'bytes_saved': 0}
+
+    def append(self, points, triangles, colors=None):
+        """
+        :param points: (npts, 3) array
+        :param triangles: (ntri, 3) array of indices into points
+        :param colors: default=None, (ntri, ncomponents) array of cell colors. Either
+          every append or none has colors.
+        :return: index of the first and one past the last of the new triangles
+        """
+        (p0, t0) = (self._npoints, self._ntriangles)
+        if self._weld_tolerance:
+            (points, triangles, colors) = self._weld(points, triangles, colors)
+        else:
+            triangles = triangles + p0
+        (npts, ntri) = (points.shape[0], triangles.shape[0])
+
+        self._points = self._reserve(self._points, p0 + npts)
+        if self._triangles.shape[0] < t0 + ntri:
+            # the polydata handed out keep the old triangles
+            self._triangles = self._reserve(self._triangles, t0 + ntri)
+            self._shared_polys = []
+        if self._offsets.shape[0] < self._triangles.shape[0] + 1:
+            self._offsets = np.arange(0, 3 * self._triangles.shape[0] + 1, 3, dtype=self._id_type)
+
+        self._points[p0:p0 + npts] = points
+        self._triangles[t0:t0 + ntri] = triangles
+        if colors is not None:
+            if self._colors is None:
+                self._colors = np.empty((self._triangles.shape[0], colors.shape[1]), dtype=colors.dtype)
+            self._colors = self._reserve(self._colors, t0 + ntri)
+            self._colors[t0:t0 + ntri] = colors
+
+        self._npoints += npts
+        self._ntriangles += ntri
+
+        return t0, t0 + ntri
+
+    def remove_triangles(self, triangle_ids):
+        """
+        Turn triangles into degenerate triangles (all corners on point 0), they stop
+        showing up in renders and are dropped by the next compact(). This is done in
+        place, the vtkPolyData of the whole store handed out since the triangles were
+        last reallocated share them, see them turn degenerate too and are marked
+        modified.
+        :param triangle_ids: indices of the triangles
+        """
+        self._triangles[triangle_ids] = 0
+        self._nremoved += len(triangle_ids)
+
+        self._shared_polys = [ref for ref in self._shared_polys if ref.Get() is not None]
+        for ref in self._shared_polys:
+            ref.Get().Modified()
+
+    def get_number_of_removed_triangles(self):
+        return self._nremoved
+
+    def compact(self):
+        """
+        Drop the removed triangles and the points no triangle uses. New arrays are
+        allocated so vtkPolyData from get_polydata() keep the old ones unchanged.
+        :return: (ntri,) array with the new index of every triangle, -1 if removed
+        """
+        triangles = self.get_triangles()
+        live = (triangles != 0).any(axis=1)
+        triangle_map = np.full(self._ntriangles, -1, dtype=np.int64)
+        triangle_map[live] = np.arange(np.count_nonzero(live))
+
+        used = np.zeros(self._npoints, dtype=bool)
+        used[triangles[live]] = True
+        point_map = np.full(self._npoints, -1, dtype=np.int64)
+        point_map[used] = np.arange(np.count_nonzero(used))
+
+        (npoints, ntriangles) = (np.count_nonzero(used), np.count_nonzero(live))
+        points = np.empty_like(self._points)
+        points[:npoints] = self._points[:self._npoints][used]
+        compacted = np.empty_like(self._triangles)
+        compacted[:ntriangles] = point_map[triangles[live]]
+        if self._colors is not None:
+            colors = np.empty_like(self._colors)
+            colors[:ntriangles] = self._colors[:self._ntriangles][live]
+            self._colors = colors
+        (self._points, self._triangles) = (points, compacted)
+        self._shared_polys = []
+        logging.info('MeshStore compacted from {} to {} triangles'.format(self._ntriangles, ntriangles))
+        (self._npoints, self._ntriangles, self._nremoved) = (npoints, ntriangles, 0)
+
+        # the points were renumbered so the keys of the triangles change
+        self._point_keys.remap(point_map)
+        if self._weld_tolerance:
+            self._triangle_keys = _SortedKeys()
+            self._triangle_keys.add(*np.unique(_triangle_keys(np.sort(self.get_triangles(), axis=1)),
+                                               return_index=True))
+
+        return triangle_map
+
+    def get_number_of_points(self):
+        return self._npoints
+
+    def get_number_of_triangles(self):
+        return self._ntriangles
+
+    def get_points(self):
+        """
+        :return: (npts, 3) view of the points
+        """
+        return self._points[:self._npoints]
+
+    def get_triangles(self):
+        """
+        :return: (ntri, 3) view of the triangles
+        """
+        return self._triangles[:self._ntriangles]
+
+    def get_colors(self):
+        """
+        :return: (ntri, ncomponents) view of the colors or None
+        """
+        return None if self._colors is None else self._colors[:self._ntriangles]
+
+    def get_weld_stats(self):
+        """
+        :return: dictionary with the totals since the store was created
+          * 'points_merged' - new points merged into existing ones
+          * 'triangles_dropped' - degenerate or duplicate triangles not stored
+          * 'bytes_saved' - memory of the points and triangles not stored
+        """
+        return dict(self._weld_stats)
+
+    def get_nbytes(self):
+        """
+        :return: bytes used by the filled part of the arrays
+        """
+        nbytes = self.get_points().nbytes + self.get_triangles().nbytes
+        if self._colors is not None:
+            nbytes += self.get_colors().nbytes
+        return nbytes
+
+    def get_polydata(self, triangle_ids=None):
+        """
+        vtkPolyData that uses the memory of the store. It stays valid after later
+        appends and compact() (they write past its end or into new arrays) but does
+        not see them, only remove_triangles() changes it (and marks it modified). Take
+        a copy to keep the mesh as it is.
+        :param triangle_ids: default=None
+          Only these triangles, they are copied with only the points they use so the
+          output is the size of the selection and not of the store.
+        :return: vtkPolyData
+        """
+        if triangle_ids is None:
+            (ntri, connectivity) = (self._ntriangles, self.get_triangles().reshape(-1))
+            vertices = self.get_points()
+            colors = self.get_colors()
+        else:
+            ntri = len(triangle_ids)
+            used, connectivity = np.unique(self._triangles[triangle_ids], return_inverse=True)
+            connectivity = connectivity.reshape(-1).astype(self._id_type, copy=False)
+            vertices = self._points[used]
+            colors = None if self._colors is None else self._colors[triangle_ids]
+
+        points = vtk.vtkPoints()
+        points.SetData(numpy_support.numpy_to_vtk(vertices, deep=0))
+
+        polys = vtk.vtkCellArray()
+        if hasattr(polys, 'GetConnectivityArray'):
+            # VTK >= 9 stores offsets and connectivity separately
+            polys.SetData(numpy_support.numpy_to_vtkIdTypeArray(self._offsets[:ntri + 1], deep=0),
+                          numpy_support.numpy_to_vtkIdTypeArray(connectivity, deep=0))
+        else:
+            polys = numpy_to_cell_array(connectivity.reshape(-1, 3))
+        if triangle_ids is None and hasattr(vtk, 'vtkWeakReference'):
+            # VTK >= 9.1, remove_triangles() marks it modified while it exists
+            ref = vtk.vtkWeakReference()
+            ref.Set(polys)
+            self._shared_polys = [r for r in self._shared_polys if r.Get() is not None] + [ref]
+
+        polydata = vtk.vtkPolyData()
+        polydata.SetPoints(points)
+        polydata.SetPolys(polys)
+        if colors is not None:
+            polydata.GetCellData().SetScalars(numpy_support.numpy_to_vtk(colors, deep=0))
+
+        return polydata
+
+    def _weld(self, points, triangles, colors):
+        """
+        :return: the points that are new, the triangles as indices into the store
+          after the append and their colors
+        """
+        p0 = self._npoints
+        ntri_in = triangles.shape[0]
+
+        # quantize, merge duplicates within the new points, then with the store
+        q = np.floor(points / self._weld_tolerance).astype(np.int64) + 2 ** 20
+        q = np.clip(q, 0, 2 ** 21 - 1)
+        keys = (q[:, 0] << 42) | (q[:, 1] << 21) | q[:, 2]
+        ukeys, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        ids = self._point_keys.find(ukeys)
+        new = ids < 0
+        ids[new] = p0 + np.arange(np.count_nonzero(new))
+        self._point_keys.add(ukeys[new], ids[new])
+        triangles = ids[inverse.reshape(-1)][triangles]
+        points = points[first[new]]
+
+        # drop degenerate triangles
+        keep = (triangles[:, 0] != triangles[:, 1]) & (triangles[:, 1] != triangles[:, 2]) & \
+               (triangles[:, 0] != triangles[:, 2])
+
+        # drop triangles already in the store or repeated in the new ones, the key is
+        # a hash of the sorted corners and a match in the store is checked
+        corners = np.sort(triangles, axis=1)
+        tkeys = _triangle_keys(corners)
+        found = self._triangle_keys.find(tkeys)
+        match = found >= 0
+        match[match] = (np.sort(self._triangles[found[match]], axis=1) == corners[match]).all(axis=1)
+        keep &= ~match
+        candidates = np.flatnonzero(keep)
+        keep[:] = False
+        keep[candidates[np.unique(tkeys[candidates], return_index=True)[1]]] = True
+
+        triangles = triangles[keep]
+        if colors is not None:
+            colors = colors[keep]
+        self._triangle_keys.add(tkeys[keep], self._ntriangles + np.arange(triangles.shape[0]))
+
+        # what was not stored
+        merged = keys.shape[0] - points.shape[0]
+        dropped = ntri_in - triangles.shape[0]
+        nbytes = merged * 3 * self._points.itemsize + dropped * 3 * self._triangles.itemsize
+        if colors is not None:
+            nbytes += dropped * colors.shape[1] * colors.itemsize
+        self._weld_stats['points_merged'] += merged
+        self._weld_stats['triangles_dropped'] += dropped
+        self._weld_stats['bytes_saved'] += nbytes
+        logging.info('Welding: {} points merged, {} triangles dropped, {:.2f} MB saved'.format(
+            merged, dropped, nbytes / 1024.0 / 1024.0))
+
+        return points, triangles, colors
+
+    def _reserve(self, array, n):
+        """
+        :return: array, or a copy with at least twice the capacity if n does not fit
+        """
+        if array.shape[0] >= n:
+            return array
+        capacity = max(n, 2 * array.shape[0])
+        grown = np.empty((capacity,) + array.shape[1:], dtype=array.dtype)
+        grown[:array.shape[0]] = array
+        logging.debug('MeshStore grown to {} rows'.format(capacity))
+        return grown
+
+
+def _triangle_keys(corners):
+    """
+    Hash of triangles.
+    :param corners: (ntri, 3) sorted point indices of every triangle
+    :return: (ntri,) int64 keys
+    """
+    corners = corners.astype(np.uint64)
+    keys = corners[:, 0] * np.uint64(0x9E3779B97F4A7C15) ^ \
+        corners[:, 1] * np.uint64(0xC2B2AE3D27D4EB4F) ^ \
+        corners[:, 2] * np.uint64(0x165667B19E3779F9)
+    return keys.view(np.int64)
+
+
+class _SortedKeys(object):
+    """
+    Map from int64 keys to ids kept as a few sorted runs, a new run is merged with the
+    previous one when it is at least half its size, so adding n keys costs
+    O(n log n) overall and a lookup is a binary search in every run.
+    """
+
+    def __init__(self):
+        self._runs = []
+
+    def find(self, keys):
+        """
+        :return: the id of every key, -1 if not found
+        """
+        ids = np.full(keys.shape[0], -1, dtype=np.int64)
+        for (run_keys, run_ids) in self._runs:
+            i = np.minimum(np.searchsorted(run_keys, keys), run_keys.shape[0] - 1)
+            hit = run_keys[i] == keys
+            ids[hit] = run_ids[i[hit]]
+        return ids
+
+    def remap(self, id_map):
+        """
+        :param id_map: new id of every id, -1 drops the key
+        """
+        runs = []
+        for (run_keys, run_ids) in self._runs:
+            ids = id_map[run_ids]
+            keep = ids >= 0
+            runs.append((run_keys[keep], ids[keep]))
+        self._runs = [r for r in runs if r[0].shape[0]]
+
+    def add(self, keys, ids):
+        """
+        Keys already in the map (of removed triangles or hash collisions) get the new
+        id so every key stays in one run only.
+        :param keys: keys without repetitions
+        """
+        new = np.ones(keys.shape[0], dtype=bool)
+        for (run_keys, run_ids) in self._runs:
+            i = np.minimum(np.searchsorted(run_keys, keys), run_keys.shape[0] - 1)
+            hit = run_keys[i] == keys
+            run_ids[i[hit]] = ids[hit]
+            new &= ~hit
+        (keys, ids) = (keys[new], ids[new])
+        if keys.shape[0] == 0:
+            return
+        order = np.argsort(keys)
+        self._runs.append((keys[order], ids[order]))
+        while len(self._runs) > 1 and 2 * self._runs[-1][0].shape[0] >= self._runs[-2][0].shape[0]:
+            (k1, i1), (k2, i2) = self._runs.pop(), self._runs.pop()
+            k = np.concatenate((k2, k1))
+            order = np.argsort(k, kind='mergesort')
+            self._runs.append((k[order], np.concatenate((i2, i1))[order]))
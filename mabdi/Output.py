@@ -184,8 +184,8 @@ class PostProcess(object):
             self._ims_d_images.append(ims)
 
         if self._movie['plots']:
-            self._global_mesh_nc.append(
-                self._global_mesh.GetOutputDataObject(0).GetNumberOfCells())
+            # the output may have removed triangles or only part of the mesh (out of core)
+            self._global_mesh_nc.append(self._global_mesh.get_number_of_triangles())
 
         end = timer()
         logging.info('PostProcess time {:.4f} seconds'.format(end - start))
@@ -340,6 +340,13 @@ def create_survey_movie(mabdi_simulate,
     # sourceAo.actor.GetProperty().SetOpacity(0.2)
 
     meshAo = mabdi.VTKPolyDataActorObjects(mabdi_simulate.mesh)
+    if mabdi_simulate._mabdi_param['world_model'] == 'mesh':
+        meshAo.mapper.SetLookupTable(mabdi_simulate.mesh.get_lookup_table())
+        meshAo.mapper.UseLookupTableScalarRangeOn()
+        # out of core the output only has the chunks in memory, show all of them
+        chunk_files = mabdi_simulate.mesh.get_chunk_file_store()
+        if chunk_files is not None:
+            meshAo.mapper.SetInputData(chunk_files.get_polydata())
     meshAo.actor.GetProperty().SetColor(salmon)
     meshAo.actor.GetProperty().SetColor(slate_grey_light)
     meshAo.actor.GetProperty().SetSpecularColor(1, 1, 1)
@@ -351,6 +358,8 @@ def create_survey_movie(mabdi_simulate,
 
     renWin = vtk.vtkRenderWindow()
     renWin.SetSize(640, 480)
+    if mabdi_simulate._output['offscreen']:
+        renWin.SetOffScreenRendering(1)
     iren = vtk.vtkRenderWindowInteractor()
     iren.SetRenderWindow(renWin)
 
@@ -0,0 +1,282 @@
+import vtk
+
+from Utilities import polydata_to_numpy
+
+import numpy as np
+
+from multiprocessing.pool import ThreadPool
+
+from timeit import default_timer as timer
+import logging
+
+
+class RayCastDepthBackend(object):
+    """
+    Create a depth image by ray casting a vtkPolyData on the CPU
+
+    Used by FilterDepthImage in place of rendering to a vtkRenderWindow and reading
+    the z-buffer, so no OpenGL context is needed. The triangles are sorted into a
+    bounding volume hierarchy (BVH) and all the pixels are traced at once with numpy,
+    split into tiles of rows that are handed to a thread pool.
+
+    The depth values use the same encoding as the z-buffer: 0.0 on the near clipping
+    plane, 1.0 on the far clipping plane and 1.0 where nothing was hit.
+    """
+
+    def __init__(self,
+                 depth_image_size=(640, 480),
+                 leaf_size=8,
+                 tile_rows=32,
+                 nthreads=None):
+        """
+        :param depth_image_size: default=(640, 480)
+          Size of the depth image.
+        :param leaf_size: default=8
+          Number of triangles in each leaf of the BVH.
+        :param tile_rows: default=32
+          Number of image rows traced by one task of the thread pool.
+        :param nthreads: default=None
+          Number of threads in the pool, None uses the number of cpus.
+        """
+
+        self._size = tuple(depth_image_size)
+        self._leaf_size = leaf_size
+        self._tile_rows = tile_rows
+        self._pool = ThreadPool(nthreads)
+
+        self._in_algorithm = None
+        self._in_polydata = None
+
+        # the triangles are triangulated from the input once and the BVH is only
+        # rebuilt when the input has been modified
+        self._triangle_filter = vtk.vtkTriangleFilter()
+        self._triangle_filter.PassVertsOff()
+        self._triangle_filter.PassLinesOff()
+        self._bvh_mtime = None
+        self._nleaves = 0
+
+    def close(self):
+        """
+        Stop the threads of the pool, the backend can not be used afterwards.
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def set_input_connection(self, in_polydata):
+        """
+        :param in_polydata: vtkAlgorithm that produces a vtkPolyData
+        """
+        self._in_algorithm = in_polydata
+        self._in_polydata = None
+
+    def set_input_data(self, polydata):
+        """
+        :param polydata: vtkPolyData
+        """
+        self._in_algorithm = None
+        self._in_polydata = polydata
+
+    def get_input_data(self):
+        """
+        Bring the input up to date and return it (the equivalent of what a
+        vtkPolyDataMapper does before rendering).
+        """
+        if self._in_algorithm is not None:
+            self._in_algorithm.Update()
+            return self._in_algorithm.GetOutputDataObject(0)
+        return self._in_polydata
+
+    def render(self, camera):
+        """
+        Trace a ray through the center of every pixel.
+        :param camera: vtkCamera that defines the pose and intrinsic parameters
+        :return: depth image as a float32 numpy array of shape (height, width)
+        """
+        start = timer()
+
+        self._update_bvh(self.get_input_data())
+
+        (w, h) = self._size
+        near, far = camera.GetClippingRange()
+
+        # direction of the rays in camera coordinates, scaled so the component along
+        # the optical axis is 1.0 so that the distance t is the depth in the camera
+        tan_half = np.tan(np.radians(camera.GetViewAngle()) / 2.0)
+        x = (2.0 * (np.arange(w) + 0.5) / w - 1.0) * tan_half * (float(w) / h)
+        y = (2.0 * (np.arange(h) + 0.5) / h - 1.0) * tan_half
+
+        # rotate into world coordinates, the rows of the view transform are the
+        # right, up and backward axes of the camera
+        view = camera.GetViewTransformMatrix()
+        rot = np.array([[view.GetElement(i, j) for j in range(3)] for i in range(3)])
+        origin = np.array(camera.GetPosition())
+
+        depth = np.ones((h, w), dtype=np.float32)
+        if self._nleaves == 0:
+            return depth
+
+        tiles = [(r, min(r + self._tile_rows, h)) for r in range(0, h, self._tile_rows)]
+
+        def trace_tile(rows):
+            yy, xx = np.meshgrid(y[rows[0]:rows[1]], x, indexing='ij')
+            dirs = np.empty(xx.shape + (3,))
+            dirs[..., 0], dirs[..., 1], dirs[..., 2] = xx, yy, -1.0
+            dirs = np.dot(dirs.reshape(-1, 3), rot)
+            t = self._trace(origin, dirs, near, far)
+            hit = t <= far
+            d = np.ones(t.shape)
+            d[hit] = far * (t[hit] - near) / (t[hit] * (far - near))
+            depth[rows[0]:rows[1], :] = d.reshape(rows[1] - rows[0], w)
+
+        self._pool.map(trace_tile, tiles)
+
+        end = timer()
+        logging.info('Ray casting time {:.4f} seconds'.format(end - start))
+
+        return depth
+
+    def _update_bvh(self, polydata):
+        """
+        Build a linear BVH: the triangles are sorted along a morton curve, grouped in
+        leaves of leaf_size and the bounding boxes of a complete binary tree are
+        reduced level by level. Node i has children 2i and 2i+1, the root is node 1.
+        """
+        mtime = (id(polydata), polydata.GetMTime())
+        if mtime == self._bvh_mtime:
+            return
+        self._bvh_mtime = mtime
+        start = timer()
+
+        self._triangle_filter.SetInputData(polydata)
+        self._triangle_filter.Update()
+        points, triangles = polydata_to_numpy(self._triangle_filter.GetOutput())
+        ntri = triangles.shape[0]
+        if ntri == 0:
+            self._nleaves = 0
+            return
+
+        points = points.astype(np.float64)
+        v0, v1, v2 = points[triangles[:, 0]], points[triangles[:, 1]], points[triangles[:, 2]]
+
+        # morton order of the centroids
+        centroids = (v0 + v1 + v2) / 3.0
+        cmin = centroids.min(axis=0)
+        extent = np.maximum(centroids.max(axis=0) - cmin, 1e-12)
+        q = ((centroids - cmin) / extent * 1023.0).astype(np.uint64)
+        code = np.zeros(ntri, dtype=np.uint64)
+        for bit in range(10):
+            for axis in range(3):
+                code |= ((q[:, axis] >> np.uint64(bit)) & np.uint64(1)) << np.uint64(3 * bit + axis)
+        order = np.argsort(code, kind='mergesort')
+
+        # pad to a power of two number of leaves, padding triangles are nan and
+        # therefore never intersect anything
+        nleaves = 1
+        while nleaves * self._leaf_size < ntri:
+            nleaves *= 2
+        ntotal = nleaves * self._leaf_size
+        tri = np.full((3, ntotal, 3), np.nan)
+        tri[0, :ntri], tri[1, :ntri], tri[2, :ntri] = v0[order], v1[order], v2[order]
+
+        self._v0 = tri[0]
+        self._e1 = tri[1] - tri[0]
+        self._e2 = tri[2] - tri[0]
+
+        # bounding boxes, leaves are nodes nleaves ... 2*nleaves-1
+        bmin = np.full((2 * nleaves, 3), np.nan)
+        bmax = np.full((2 * nleaves, 3), np.nan)
+        leaf = tri.reshape(3, nleaves, self._leaf_size, 3)
+        bmin[nleaves:] = np.fmin.reduce(np.fmin.reduce(leaf, axis=0), axis=1)
+        bmax[nleaves:] = np.fmax.reduce(np.fmax.reduce(leaf, axis=0), axis=1)
+        n = nleaves
+        while n > 1:
+            bmin[n // 2:n] = np.fmin(bmin[n:2 * n:2], bmin[n + 1:2 * n:2])
+            bmax[n // 2:n] = np.fmax(bmax[n:2 * n:2], bmax[n + 1:2 * n:2])
+            n //= 2
+        self._bmin, self._bmax = bmin, bmax
+        self._nleaves = nleaves
+
+        end = timer()
+        logging.info('BVH with {} triangles built in {:.4f} seconds'.format(ntri, end - start))
+
+    def _trace(self, origin, dirs, near, far):
+        """
+        Closest hit along every ray.
+        :return: distance t for each ray (depth along the optical axis), inf if missed
+        """
+        nrays = dirs.shape[0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inv_dirs = 1.0 / dirs
+        best = np.full(nrays, np.inf)
+
+        # descend the tree breadth first with a list of (ray, node) pairs
+        rays = np.arange(nrays)
+        nodes = np.ones(nrays, dtype=np.int64)
+        while rays.size:
+            tnear, tfar = self._slab(origin, inv_dirs[rays], nodes)
+            keep = (tnear <= tfar) & (tfar >= near) & (tnear <= far)
+            rays, nodes, tnear = rays[keep], nodes[keep], tnear[keep]
+            if nodes.size == 0 or nodes[0] >= self._nleaves:
+                break
+            rays = np.repeat(rays, 2)
+            nodes = np.repeat(2 * nodes, 2)
+            nodes[1::2] += 1
+
+        if rays.size == 0:
+            return best
+
+        # visit the leaves of each ray front to back, a leaf is skipped once
+        # something closer than its bounding box has been hit
+        order = np.lexsort((tnear, rays))
+        rays, leaves, tnear = rays[order], nodes[order] - self._nleaves, tnear[order]
+        first = np.r_[0, np.flatnonzero(np.diff(rays)) + 1]
+        rank = np.arange(rays.size) - np.repeat(first, np.diff(np.r_[first, rays.size]))
+        sort_rank = np.argsort(rank, kind='mergesort')
+        bounds = np.searchsorted(rank[sort_rank], np.arange(rank.max() + 2))
+        for r in range(rank.max() + 1):
+            sel = sort_rank[bounds[r]:bounds[r + 1]]
+            sel = sel[tnear[sel] <= best[rays[sel]]]
+            if sel.size == 0:
+                break
+            self._intersect_leaves(origin, dirs, rays[sel], leaves[sel], best, near, far)
+
+        return best
+
+    def _slab(self, origin, inv_dirs, nodes):
+        with np.errstate(invalid='ignore'):
+            t0 = (self._bmin[nodes] - origin) * inv_dirs
+            t1 = (self._bmax[nodes] - origin) * inv_dirs
+            tnear = np.fmax.reduce(np.minimum(t0, t1), axis=1)
+            tfar = np.fmin.reduce(np.maximum(t0, t1), axis=1)
+        return tnear, tfar
+
+    def _intersect_leaves(self, origin, dirs, rays, leaves, best, near, far):
+        """
+        Moller-Trumbore intersection of each ray with all the triangles of its leaf.
+        """
+        d = dirs[rays].T
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for k in range(self._leaf_size):
+                tri = leaves * self._leaf_size + k
+                e1, e2, s = self._e1[tri].T, self._e2[tri].T, (origin - self._v0[tri]).T
+                p = _cross(d, e2)
+                det = (e1 * p).sum(axis=0)
+                inv_det = 1.0 / det
+                u = (s * p).sum(axis=0) * inv_det
+                q = _cross(s, e1)
+                v = (d * q).sum(axis=0) * inv_det
+                t = (e2 * q).sum(axis=0) * inv_det
+                hit = (np.abs(det) > 1e-12) & (u >= 0.0) & (v >= 0.0) & (u + v <= 1.0) & \
+                      (t >= near) & (t <= far)
+                np.minimum.at(best, rays[hit], t[hit])
+
+
+def _cross(a, b):
+    """
+    Cross product of two arrays of vectors of shape (3, n)
+    """
+    return np.array((a[1] * b[2] - a[2] * b[1],
+                     a[2] * b[0] - a[0] * b[2],
+                     a[0] * b[1] - a[1] * b[0]))
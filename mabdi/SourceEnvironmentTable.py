@@ -4,6 +4,8 @@ from vtk.util import numpy_support
 from vtk.numpy_interface import dataset_adapter as dsa
 from vtk.numpy_interface import algorithms as alg
 
+from Utilities import ObjectGeometry
+
 import logging
 from timeit import default_timer as timer
 
@@ -24,91 +26,90 @@ class SourceEnvironmentTable(VTKPythonAlgorithmBase):
                          'left_cup': True,
                          'right_cup': True}
 
-        self._polydata = {'table': None,
-                          'left_cup': None,
-                          'right_cup': None}
-
         self._floor = True
-        self._floor_polydata = None
+
+        # the geometry of every object is only built once, changing the state of an
+        # object just changes which objects are taken from it
+        self._geometry = ObjectGeometry([('floor', self._create_floor()),
+                                         ('table', self._create_table()),
+                                         ('left_cup', self._create_cup(-.75 / 4)),
+                                         ('right_cup', self._create_cup(.75 / 4))])
 
     def RequestData(self, request, inInfo, outInfo):
         logging.info('')
         start = timer()
 
-        append = vtk.vtkAppendPolyData()
-
-        # floor
-        if self._floor:
-            self._floor_polydata = vtk.vtkCubeSource()
-            self._floor_polydata.SetCenter(0, .05, 0)
-            self._floor_polydata.SetXLength(10.0)
-            self._floor_polydata.SetYLength(0.1)
-            self._floor_polydata.SetZLength(10.0)
-            append.AddInputConnection(self._floor_polydata.GetOutputPort())
-
-        # table
-        if self._objects['table']:
-            table_leg_1 = vtk.vtkCubeSource()
-            table_leg_1.SetCenter((1.0 / 2) - (.1 / 2), .75 / 2, (-.75 / 2) + (.1 / 2))
-            table_leg_1.SetXLength(0.1)
-            table_leg_1.SetYLength(0.75)
-            table_leg_1.SetZLength(0.1)
-            table_leg_2 = vtk.vtkCubeSource()
-            table_leg_2.SetCenter((-1.0 / 2) + (.1 / 2), .75 / 2, (-.75 / 2) + (.1 / 2))
-            table_leg_2.SetXLength(0.1)
-            table_leg_2.SetYLength(0.75)
-            table_leg_2.SetZLength(0.1)
-            table_leg_3 = vtk.vtkCubeSource()
-            table_leg_3.SetCenter((-1.0 / 2) + (.1 / 2), .75 / 2, (.75 / 2) - (.1 / 2))
-            table_leg_3.SetXLength(0.1)
-            table_leg_3.SetYLength(0.75)
-            table_leg_3.SetZLength(0.1)
-            table_leg_4 = vtk.vtkCubeSource()
-            table_leg_4.SetCenter((1.0 / 2) - (.1 / 2), .75 / 2, (.75 / 2) - (.1 / 2))
-            table_leg_4.SetXLength(0.1)
-            table_leg_4.SetYLength(0.75)
-            table_leg_4.SetZLength(0.1)
-            table_top = vtk.vtkCubeSource()
-            table_top.SetCenter(0.0, .75 - (.1 / 2), 0.0)
-            table_top.SetXLength(1.0)
-            table_top.SetYLength(0.1)
-            table_top.SetZLength(0.75)
-            self._polydata['table'] = vtk.vtkAppendPolyData()
-            self._polydata['table'].AddInputConnection(table_leg_1.GetOutputPort())
-            self._polydata['table'].AddInputConnection(table_leg_2.GetOutputPort())
-            self._polydata['table'].AddInputConnection(table_leg_3.GetOutputPort())
-            self._polydata['table'].AddInputConnection(table_leg_4.GetOutputPort())
-            self._polydata['table'].AddInputConnection(table_top.GetOutputPort())
-            append.AddInputConnection(self._polydata['table'].GetOutputPort())
-
-        # left cup
-        if self._objects['left_cup']:
-            self._polydata['left_cup'] = vtk.vtkCylinderSource()
-            self._polydata['left_cup'].SetCenter(-.75 / 4, .75 + (.12 / 2), 0.0)
-            self._polydata['left_cup'].SetHeight(.12)
-            self._polydata['left_cup'].SetRadius(.06 / 2)
-            append.AddInputConnection(self._polydata['left_cup'].GetOutputPort())
-
-        # right cup
-        if self._objects['right_cup']:
-            self._polydata['right_cup'] = vtk.vtkCylinderSource()
-            self._polydata['right_cup'].SetCenter(.75 / 4, .75 + (.12 / 2), 0.0)
-            self._polydata['right_cup'].SetHeight(.12)
-            self._polydata['right_cup'].SetRadius(.06 / 2)
-            append.AddInputConnection(self._polydata['right_cup'].GetOutputPort())
-
-        append.Update()
+        names = self._get_names()
 
         # output
         info = outInfo.GetInformationObject(0)
         output = vtk.vtkPolyData.GetData(info)
-        output.ShallowCopy(append.GetOutput())
+        output.ShallowCopy(self._geometry.get_polydata(names))
 
         end = timer()
         logging.info('Execution time {:.4f} seconds'.format(end - start))
 
         return 1
 
+    @staticmethod
+    def _create_floor():
+        floor = vtk.vtkCubeSource()
+        floor.SetCenter(0, .05, 0)
+        floor.SetXLength(10.0)
+        floor.SetYLength(0.1)
+        floor.SetZLength(10.0)
+        floor.Update()
+        return floor.GetOutput()
+
+    @staticmethod
+    def _create_table():
+        append = vtk.vtkAppendPolyData()
+
+        # legs
+        for (x, z) in [(1, -1), (-1, -1), (-1, 1), (1, 1)]:
+            table_leg = vtk.vtkCubeSource()
+            table_leg.SetCenter(x * ((1.0 / 2) - (.1 / 2)), .75 / 2, z * ((.75 / 2) - (.1 / 2)))
+            table_leg.SetXLength(0.1)
+            table_leg.SetYLength(0.75)
+            table_leg.SetZLength(0.1)
+            append.AddInputConnection(table_leg.GetOutputPort())
+
+        # top
+        table_top = vtk.vtkCubeSource()
+        table_top.SetCenter(0.0, .75 - (.1 / 2), 0.0)
+        table_top.SetXLength(1.0)
+        table_top.SetYLength(0.1)
+        table_top.SetZLength(0.75)
+        append.AddInputConnection(table_top.GetOutputPort())
+
+        append.Update()
+        return append.GetOutput()
+
+    @staticmethod
+    def _create_cup(x):
+        cup = vtk.vtkCylinderSource()
+        cup.SetCenter(x, .75 + (.12 / 2), 0.0)
+        cup.SetHeight(.12)
+        cup.SetRadius(.06 / 2)
+        cup.Update()
+        return cup.GetOutput()
+
+    def _get_names(self):
+        """
+        :return: names of the objects in the environment
+        """
+        names = [name for (name, state) in self._objects.items() if state]
+        if self._floor:
+            names.append('floor')
+        return names
+
+    def get_bounds(self):
+        """
+        :return: bounds of the objects in the environment, unlike the bounds of the
+          output it leaves out the objects that are not (see ObjectGeometry)
+        """
+        return self._geometry.get_bounds(self._get_names())
+
     def set_object_state(self, object_id='default', state='default'):
         """
         Add or remove objects from the environment.
@@ -0,0 +1,194 @@
+import os
+import json
+
+import vtk
+from vtk.util.vtkAlgorithm import VTKPythonAlgorithmBase
+
+from Utilities import ObjectGeometry
+from Utilities import read_triangle_mesh
+from Utilities import polydata_to_numpy
+
+import numpy as np
+
+from collections import OrderedDict
+import logging
+from timeit import default_timer as timer
+
+
+class SourceMeshFiles(VTKPythonAlgorithmBase):
+    """
+    Custom vtk filter for creating and controlling an environment made of mesh files
+
+    The objects of the environment are listed in a manifest, a .json file or the
+    same as a dictionary:
+
+        {"floor": [10.0, 10.0],
+         "objects": [{"name": "pump",
+                      "file": "scans/pump.ply",
+                      "scale": 0.001,
+                      "rotate": [-90.0, 0.0, 0.0],
+                      "translate": [1.0, 0.0, 2.0],
+                      "active": true},
+                     ...]}
+
+    Files can be .ply, .obj, .stl or .vtp and relative paths are relative to the
+    manifest. Each object is scaled, rotated (degrees about x, y and z) and
+    translated in that order, or "matrix" gives its 4x4 transform instead. A
+    "floor" of the given size along x and z is added if it is in the manifest.
+
+    A file is only read when its object is first in the environment and is read
+    once per process (see read_triangle_mesh), so toggling objects never reads it
+    again.
+    """
+
+    def __init__(self, manifest):
+        """
+        :param manifest: .json file or dictionary, see the class description
+        """
+
+        VTKPythonAlgorithmBase.__init__(self,
+                                        nInputPorts=0,
+                                        nOutputPorts=1, outputType='vtkPolyData')
+
+        if isinstance(manifest, dict):
+            folder = os.getcwd()
+        else:
+            folder = os.path.dirname(os.path.abspath(manifest))
+            with open(manifest) as f:
+                manifest = json.load(f)
+
+        self.objects = OrderedDict()
+        self._files = {}
+        self._transforms = {}
+        for i, obj in enumerate(manifest.get('objects', [])):
+            if 'file' not in obj:
+                raise ValueError('Object {} of the manifest has no file'.format(i))
+            name = obj.get('name', 'object_' + str(i))
+            if name in self.objects or name == 'floor':
+                raise ValueError('Object name {} is not unique'.format(name))
+            self.objects[name] = obj.get('active', True)
+            self._files[name] = os.path.join(folder, os.path.expanduser(obj['file']))
+            if not os.path.isfile(self._files[name]):
+                raise ValueError('Mesh file {} of object {} not found'.format(self._files[name], name))
+            self._transforms[name] = self._get_transform(obj)
+        self._keys = list(self.objects.keys())
+
+        self._floor = True
+        self._floor_size = manifest.get('floor', None)
+
+        # points and triangles of the objects read so far
+        self._loaded = OrderedDict()
+        if self._floor_size:
+            floor = vtk.vtkCubeSource()
+            floor.SetCenter(0, .05, 0)
+            floor.SetXLength(self._floor_size[0])
+            floor.SetYLength(0.1)
+            floor.SetZLength(self._floor_size[1])
+            triangle_filter = vtk.vtkTriangleFilter()
+            triangle_filter.SetInputConnection(floor.GetOutputPort())
+            triangle_filter.Update()
+            self._loaded['floor'] = polydata_to_numpy(triangle_filter.GetOutput())
+        self._geometry = None
+
+    def RequestData(self, request, inInfo, outInfo):
+        logging.info('')
+        start = timer()
+
+        names = self._get_names()
+
+        # read the objects that are in the environment for the first time
+        for name in names:
+            if name not in self._loaded and name != 'floor':
+                (points, triangles) = read_triangle_mesh(self._files[name])
+                transform = self._transforms[name]
+                self._loaded[name] = (np.dot(points, transform[:3, :3].T) + transform[:3, 3], triangles)
+                self._geometry = None
+
+        if self._geometry is None:
+            npoints = np.array([p.shape[0] for (p, _) in self._loaded.values()], dtype=np.int64)
+            ntriangles = np.array([t.shape[0] for (_, t) in self._loaded.values()], dtype=np.int64)
+            point_offsets = np.repeat(np.cumsum(npoints) - npoints, ntriangles)
+            self._geometry = ObjectGeometry.from_triangles(
+                list(self._loaded.keys()),
+                np.concatenate([np.zeros((0, 3), dtype=np.float32)] +
+                               [p for (p, _) in self._loaded.values()]).astype(np.float32),
+                np.concatenate([np.zeros((0, 3), dtype=np.int64)] +
+                               [t for (_, t) in self._loaded.values()]) + point_offsets[:, None],
+                npoints, ntriangles)
+
+        # output
+        info = outInfo.GetInformationObject(0)
+        output = vtk.vtkPolyData.GetData(info)
+        output.ShallowCopy(self._geometry.get_polydata(names))
+
+        end = timer()
+        logging.info('Execution time {:.4f} seconds'.format(end - start))
+
+        return 1
+
+    @staticmethod
+    def _get_transform(obj):
+        """
+        :return: 4x4 transform of an object of the manifest
+        """
+        if 'matrix' in obj:
+            return np.array(obj['matrix'], dtype=np.float64).reshape(4, 4)
+
+        transform = vtk.vtkTransform()
+        transform.PostMultiply()
+        scale = obj.get('scale', 1.0)
+        scale = [scale] * 3 if np.isscalar(scale) else scale
+        transform.Scale(*scale)
+        rotate = obj.get('rotate', (0.0, 0.0, 0.0))
+        transform.RotateX(rotate[0])
+        transform.RotateY(rotate[1])
+        transform.RotateZ(rotate[2])
+        transform.Translate(*obj.get('translate', (0.0, 0.0, 0.0)))
+
+        matrix = transform.GetMatrix()
+        return np.array([[matrix.GetElement(i, j) for j in range(4)] for i in range(4)])
+
+    def _get_names(self):
+        """
+        :return: names of the objects in the environment
+        """
+        names = [key for key in self._keys if self.objects[key]]
+        if self._floor and self._floor_size:
+            names.append('floor')
+        return names
+
+    def get_bounds(self):
+        """
+        :return: bounds of the objects in the environment as of the last update,
+          unlike the bounds of the output it leaves out the objects that are not (see
+          ObjectGeometry)
+        """
+        if self._geometry is None:
+            return (1.0, -1.0, 1.0, -1.0, 1.0, -1.0)
+        return self._geometry.get_bounds(self._get_names())
+
+    def get_loaded_objects(self):
+        """
+        :return: names of the objects read so far
+        """
+        return [name for name in self._loaded if name != 'floor']
+
+    def set_object_state(self, object_id='default', state='default'):
+        """
+        Add or remove objects from the environment.
+        :param object_id: Name or index of object to change the state of.
+        :param state: Have the object in the environment?
+        """
+        if state == 'default' or object_id == 'default':
+            return 1
+
+        if object_id == 'floor':
+            self._floor = state
+        elif object_id in self.objects:
+            self.objects[object_id] = state
+        elif isinstance(object_id, (int, np.integer)) and 0 <= object_id < len(self._keys):
+            self.objects[self._keys[object_id]] = state
+        else:
+            return 1
+
+        self.Modified()
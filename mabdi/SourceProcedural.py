@@ -0,0 +1,259 @@
+import os
+
+import vtk
+from vtk.util.vtkAlgorithm import VTKPythonAlgorithmBase
+from vtk.util import numpy_support
+
+from Utilities import ObjectGeometry
+from Utilities import read_triangle_mesh
+from Utilities import polydata_to_numpy
+from Utilities import numpy_to_polydata
+
+import numpy as np
+
+from collections import OrderedDict
+import logging
+from timeit import default_timer as timer
+
+
+class SourceProcedural(VTKPythonAlgorithmBase):
+    """
+    Custom vtk filter for creating and controlling a procedurally generated environment
+
+    The environment is a floor with nobjects objects placed at random on it. The
+    objects are boxes, cylinders, spheres, bunnies and clutter (small boxes tipped
+    over at random), each with a random size and rotation. The same seed gives the
+    same environment. Every kind of object is created once and the objects are
+    transforms of it, so environments with many thousands of objects are cheap to
+    create.
+    """
+
+    _kinds = ('box', 'cylinder', 'sphere', 'bunny', 'clutter')
+
+    def __init__(self, nobjects=100, floor_size=(10.0, 10.0), seed=0,
+                 object_mix=None, object_size=(0.1, 0.6), clutter_size=(0.03, 0.1),
+                 bunny_triangles=2000):
+        """
+        :param nobjects: default=100
+          Number of objects on the floor.
+        :param floor_size: default=(10.0, 10.0)
+          Size of the floor along x and z, the objects are placed on all of it.
+        :param seed: default=0
+          Seed of the random generator.
+        :param object_mix: default=None
+          Dictionary of relative amounts of 'box', 'cylinder', 'sphere', 'bunny' and
+          'clutter', None is 3 boxes, 2 cylinders, 1 sphere, 1 bunny and 3 clutter.
+        :param object_size: default=(0.1, 0.6)
+          Range of the size of the objects.
+        :param clutter_size: default=(0.03, 0.1)
+          Range of the size of the clutter.
+        :param bunny_triangles: default=2000
+          The bunny is decimated to about this number of triangles, None keeps all of
+          them.
+        """
+
+        VTKPythonAlgorithmBase.__init__(self,
+                                        nInputPorts=0,
+                                        nOutputPorts=1, outputType='vtkPolyData')
+
+        start = timer()
+
+        object_mix = {'box': 3, 'cylinder': 2, 'sphere': 1, 'bunny': 1, 'clutter': 3} \
+            if object_mix is None else object_mix
+        if nobjects < 0:
+            raise ValueError('nobjects must not be negative')
+        if set(object_mix) - set(self._kinds):
+            raise ValueError('object_mix can only have {}'.format(self._kinds))
+
+        self._bunny_ply_file = os.path.join(os.path.dirname(__file__),
+                                            'stanford_bunny.ply')
+        self._bunny_triangles = bunny_triangles
+
+        rng = np.random.RandomState(seed)
+
+        # kind, position, size and rotation of every object
+        weights = np.array([object_mix.get(kind, 0) for kind in self._kinds], dtype=np.float64)
+        if weights.sum() <= 0:
+            raise ValueError('object_mix must have an amount larger than 0')
+        kinds = rng.choice(len(self._kinds), size=nobjects, p=weights / weights.sum())
+        positions = np.column_stack((rng.uniform(-floor_size[0] / 2.0, floor_size[0] / 2.0, nobjects),
+                                     np.zeros(nobjects),
+                                     rng.uniform(-floor_size[1] / 2.0, floor_size[1] / 2.0, nobjects)))
+        sizes = rng.uniform(object_size[0], object_size[1], nobjects)
+        clutter = kinds == self._kinds.index('clutter')
+        sizes[clutter] = rng.uniform(clutter_size[0], clutter_size[1], clutter.sum())
+        # boxes and cylinders are stretched along y
+        scales = np.repeat(sizes[:, None], 3, axis=1)
+        stretch = np.isin(kinds, [self._kinds.index('box'), self._kinds.index('cylinder')])
+        scales[stretch, 1] *= rng.uniform(0.5, 2.0, stretch.sum())
+        rotations = self._rotations_about_y(rng.uniform(0.0, 2.0 * np.pi, nobjects))
+        # clutter is also tipped over about its center and lifted to stand on y = 0
+        tip = rng.uniform(0.0, np.pi, clutter.sum())
+        rotations[clutter] = np.einsum('nij,njk->nik', rotations[clutter], self._rotations_about_x(tip))
+        positions[clutter, 1] = 0.5 * sizes[clutter] * (np.abs(np.cos(tip)) + np.abs(np.sin(tip)))
+
+        # the floor is the first object
+        floor = vtk.vtkCubeSource()
+        floor.SetCenter(0, .05, 0)
+        floor.SetXLength(floor_size[0])
+        floor.SetYLength(0.1)
+        floor.SetZLength(floor_size[1])
+        (floor_points, floor_triangles) = self._triangulate(floor)
+
+        # points and triangles of every object are written in place, in the types
+        # ObjectGeometry and vtk use so they are not copied again
+        templates = [self._create_template(kind) if (kinds == k).any() else None
+                     for k, kind in enumerate(self._kinds)]
+        npoints = np.array([floor_points.shape[0]] +
+                           [templates[k][0].shape[0] for k in kinds], dtype=np.int64)
+        ntriangles = np.array([floor_triangles.shape[0]] +
+                              [templates[k][1].shape[0] for k in kinds], dtype=np.int64)
+        first_point = np.cumsum(npoints) - npoints
+        first_triangle = np.cumsum(ntriangles) - ntriangles
+        points = np.empty((npoints.sum(), 3), dtype=np.float32)
+        triangles = np.empty((ntriangles.sum(), 3),
+                             dtype=numpy_support.get_numpy_array_type(vtk.VTK_ID_TYPE))
+        points[:npoints[0]] = floor_points
+        triangles[:ntriangles[0]] = floor_triangles
+
+        # transform the points of every kind of object in one go
+        for k, template in enumerate(templates):
+            if template is None:
+                continue
+            ind = np.flatnonzero(kinds == k)
+            (template_points, template_triangles) = template
+            matrices = rotations[ind] * scales[ind][:, None, :]
+            rows = first_point[ind + 1][:, None] + np.arange(template_points.shape[0])
+            points[rows] = np.einsum('nij,pj->npi', matrices, template_points) + positions[ind][:, None, :]
+            rows = first_triangle[ind + 1][:, None] + np.arange(template_triangles.shape[0])
+            triangles[rows] = template_triangles + first_point[ind + 1][:, None, None]
+
+        self.objects = OrderedDict((self._kinds[k] + '_' + str(i), True) for i, k in enumerate(kinds))
+        self._keys = list(self.objects.keys())
+        self._floor = True
+
+        self._geometry = ObjectGeometry.from_triangles(['floor'] + self._keys, points, triangles,
+                                                       npoints, ntriangles)
+
+        end = timer()
+        logging.info('{} objects created in {:.4f} seconds'.format(nobjects, end - start))
+
+    def RequestData(self, request, inInfo, outInfo):
+        logging.info('')
+        start = timer()
+
+        names = self._get_names()
+
+        # output
+        info = outInfo.GetInformationObject(0)
+        output = vtk.vtkPolyData.GetData(info)
+        output.ShallowCopy(self._geometry.get_polydata(names))
+
+        end = timer()
+        logging.info('Execution time {:.4f} seconds'.format(end - start))
+
+        return 1
+
+    def _create_template(self, kind):
+        """
+        :return: points and triangles of a kind of object of size 1, standing on y = 0
+          (except clutter)
+        """
+        if kind == 'box':
+            source = vtk.vtkCubeSource()
+            source.SetCenter(0.0, 0.5, 0.0)
+        elif kind == 'clutter':
+            # centered to be tipped over about its center
+            source = vtk.vtkCubeSource()
+        elif kind == 'cylinder':
+            source = vtk.vtkCylinderSource()
+            source.SetCenter(0.0, 0.5, 0.0)
+            source.SetRadius(0.5)
+            source.SetResolution(16)
+        elif kind == 'sphere':
+            source = vtk.vtkSphereSource()
+            source.SetCenter(0.0, 0.5, 0.0)
+            source.SetRadius(0.5)
+            source.SetThetaResolution(16)
+            source.SetPhiResolution(8)
+        elif kind == 'bunny':
+            (points, triangles) = read_triangle_mesh(self._bunny_ply_file)
+            bunny = numpy_to_polydata(points, triangles)
+            if self._bunny_triangles and self._bunny_triangles < triangles.shape[0]:
+                decimate = vtk.vtkQuadricDecimation()
+                decimate.SetInputData(bunny)
+                decimate.SetTargetReduction(1.0 - float(self._bunny_triangles) / triangles.shape[0])
+                decimate.Update()
+                bunny = decimate.GetOutput()
+            (points, triangles) = polydata_to_numpy(bunny)
+            # largest side of 1, centered on x and z
+            bounds = np.column_stack((points.min(axis=0), points.max(axis=0)))
+            points = (points - [bounds[0].mean(), bounds[1, 0], bounds[2].mean()]) / np.ptp(bounds, axis=1).max()
+            return points, triangles
+        return self._triangulate(source)
+
+    @staticmethod
+    def _triangulate(source):
+        triangle_filter = vtk.vtkTriangleFilter()
+        triangle_filter.SetInputConnection(source.GetOutputPort())
+        triangle_filter.Update()
+        (points, triangles) = polydata_to_numpy(triangle_filter.GetOutput())
+        return np.array(points), np.array(triangles)
+
+    @staticmethod
+    def _rotations_about_y(angles):
+        (c, s) = (np.cos(angles), np.sin(angles))
+        rotations = np.zeros((angles.shape[0], 3, 3))
+        rotations[:, 0, 0] = c
+        rotations[:, 0, 2] = s
+        rotations[:, 1, 1] = 1.0
+        rotations[:, 2, 0] = -s
+        rotations[:, 2, 2] = c
+        return rotations
+
+    @staticmethod
+    def _rotations_about_x(angles):
+        (c, s) = (np.cos(angles), np.sin(angles))
+        rotations = np.zeros((angles.shape[0], 3, 3))
+        rotations[:, 0, 0] = 1.0
+        rotations[:, 1, 1] = c
+        rotations[:, 1, 2] = -s
+        rotations[:, 2, 1] = s
+        rotations[:, 2, 2] = c
+        return rotations
+
+    def _get_names(self):
+        """
+        :return: names of the objects in the environment
+        """
+        names = [key for key in self._keys if self.objects[key]]
+        if self._floor:
+            names.append('floor')
+        return names
+
+    def get_bounds(self):
+        """
+        :return: bounds of the objects in the environment, unlike the bounds of the
+          output it leaves out the objects that are not (see ObjectGeometry)
+        """
+        return self._geometry.get_bounds(self._get_names())
+
+    def set_object_state(self, object_id='default', state='default'):
+        """
+        Add or remove objects from the environment.
+        :param object_id: Name or index of object to change the state of.
+        :param state: Have the object in the environment?
+        """
+        if state == 'default' or object_id == 'default':
+            return 1
+
+        if object_id == 'floor':
+            self._floor = state
+        elif object_id in self.objects:
+            self.objects[object_id] = state
+        elif isinstance(object_id, (int, np.integer)) and 0 <= object_id < len(self._keys):
+            self.objects[self._keys[object_id]] = state
+        else:
+            return 1
+
+        self.Modified()
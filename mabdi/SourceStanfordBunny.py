@@ -6,6 +6,13 @@ from vtk.util import numpy_support
 from vtk.numpy_interface import dataset_adapter as dsa
 from vtk.numpy_interface import algorithms as alg
 
+from Utilities import ObjectGeometry
+from Utilities import read_triangle_mesh
+from Utilities import numpy_to_polydata
+
+import numpy as np
+
+from collections import OrderedDict
 import logging
 from timeit import default_timer as timer
 
@@ -18,91 +25,102 @@ class SourceStandfordBunny(VTKPythonAlgorithmBase):
     """
 
     def __init__(self, nbunnies=1):
+        """
+        :param nbunnies: default=1
+          Number of bunnies, placed on a line for up to 3 and on a circle for more.
+        """
 
         VTKPythonAlgorithmBase.__init__(self,
                                         nInputPorts=0,
                                         nOutputPorts=1, outputType='vtkPolyData')
 
+        if nbunnies < 1:
+            raise ValueError('nbunnies must be at least 1')
+
         self._bunny_ply_file = os.path.join(os.path.dirname(__file__),
                                             'stanford_bunny.ply')
 
         self._nbunnies = nbunnies
 
-        dis = 1.5
-        ytrans = -0.2
-        if nbunnies is 1:
-            trans = [(0.0, ytrans, 0.0)]
-        elif nbunnies is 2:
-            trans = [(-dis, ytrans, 0.0),
-                     (dis, ytrans, 0.0)]
-        elif nbunnies is 3:
-            trans = [(-dis, ytrans, 0.0),
-                     (0.0, ytrans, 0.0),
-                     (dis, ytrans, 0.0)]
-        elif nbunnies is 4:
-            trans = [(-dis, ytrans, 0.0),
-                     (0.0, ytrans, dis),
-                     (dis, ytrans, 0.0),
-                     (0.0, ytrans, -dis)]
-
-        self.objects = {'bunny_' + str(x): True for x in range(nbunnies)}
-        self._polydata = {'bunny_'+str(x): vtk.vtkTransformPolyDataFilter() for x in range(nbunnies)}
-        self._keys = self.objects.keys()
-        for i, (key, tfilter) in enumerate(self._polydata.iteritems()):
-            reader = vtk.vtkPLYReader()
-            reader.SetFileName(self._bunny_ply_file)
-            transform = vtk.vtkTransform()
-            # transform.Scale(10.0, 10.0, 10.0)
-            transform.Translate(trans[i])
-            tfilter.SetInputConnection(reader.GetOutputPort())
-            tfilter.SetTransform(transform)
+        # the bunny is only parsed once and every bunny is a transform of it
+        (points, triangles) = read_triangle_mesh(self._bunny_ply_file)
+        transforms = np.tile(np.eye(4), (nbunnies, 1, 1))
+        transforms[:, :3, 3] = self._get_translations(nbunnies)
+        homogeneous = np.hstack((points, np.ones((points.shape[0], 1), dtype=points.dtype)))
+        instances = np.dot(transforms[:, :3, :], homogeneous.T).transpose(0, 2, 1).astype(points.dtype)
+
+        self.objects = OrderedDict(('bunny_' + str(x), True) for x in range(nbunnies))
+        self._keys = list(self.objects.keys())
 
         self._floor = True
-        self._floor_polydata = None
+        floor = vtk.vtkCubeSource()
+        floor.SetCenter(0, .05, 0)
+        floor.SetXLength(10.0)
+        floor.SetYLength(0.1)
+        floor.SetZLength(10.0)
+        floor.Update()
+
+        self._geometry = ObjectGeometry([('floor', floor.GetOutput())] +
+                                        [(key, numpy_to_polydata(instances[x], triangles))
+                                         for x, key in enumerate(self._keys)])
 
     def RequestData(self, request, inInfo, outInfo):
         logging.info('')
         start = timer()
 
-        append = vtk.vtkAppendPolyData()
-
-        # floor
-        if self._floor:
-            self._floor_polydata = vtk.vtkCubeSource()
-            self._floor_polydata.SetCenter(0, .05, 0)
-            self._floor_polydata.SetXLength(10.0)
-            self._floor_polydata.SetYLength(0.1)
-            self._floor_polydata.SetZLength(10.0)
-            append.AddInputConnection(self._floor_polydata.GetOutputPort())
-
-        # bunny
-        # reader = vtk.vtkPLYReader()
-        # reader.SetFileName(self._bunny_ply_file)
-        # transform = vtk.vtkTransform()
-        # transform.Scale(10.0, 10.0, 10.0)
-        # tf = vtk.vtkTransformPolyDataFilter()
-        # tf.SetInputConnection(reader.GetOutputPort())
-        # tf.SetTransform(transform)
-        for i, (key, tfilter) in enumerate(self._polydata.iteritems()):
-            if self.objects[key]:
-                append.AddInputConnection(tfilter.GetOutputPort())
-
-        append.Update()
+        names = self._get_names()
 
         # output
         info = outInfo.GetInformationObject(0)
         output = vtk.vtkPolyData.GetData(info)
-        output.ShallowCopy(append.GetOutput())
+        output.ShallowCopy(self._geometry.get_polydata(names))
 
         end = timer()
         logging.info('Execution time {:.4f} seconds'.format(end - start))
 
         return 1
 
+    @staticmethod
+    def _get_translations(nbunnies):
+        """
+        :return: (nbunnies, 3) array with the position of every bunny
+        """
+        dis = 1.5
+        ytrans = -0.2
+        if nbunnies == 1:
+            x = [0.0]
+            z = [0.0]
+        elif nbunnies <= 3:
+            x = np.linspace(-dis, dis, nbunnies)
+            z = np.zeros(nbunnies)
+        else:
+            # on a circle with neighbouring bunnies as far apart as with 4
+            radius = dis * np.sqrt(2.0) / (2.0 * np.sin(np.pi / nbunnies))
+            angle = np.pi - 2.0 * np.pi * np.arange(nbunnies) / nbunnies
+            x = radius * np.cos(angle)
+            z = radius * np.sin(angle)
+        return np.column_stack((x, np.full(nbunnies, ytrans), z))
+
+    def _get_names(self):
+        """
+        :return: names of the objects in the environment
+        """
+        names = [key for key in self._keys if self.objects[key]]
+        if self._floor:
+            names.append('floor')
+        return names
+
+    def get_bounds(self):
+        """
+        :return: bounds of the objects in the environment, unlike the bounds of the
+          output it leaves out the objects that are not (see ObjectGeometry)
+        """
+        return self._geometry.get_bounds(self._get_names())
+
     def set_object_state(self, object_id='default', state='default'):
         """
         Add or remove objects from the environment.
-        :param object_id: Name of object to change the state of.
+        :param object_id: Name or index of object to change the state of.
         :param state: Have the object in the environment?
         """
         if state == 'default' or object_id == 'default':
@@ -110,9 +128,11 @@ class SourceStandfordBunny(VTKPythonAlgorithmBase):
 
         if object_id == 'floor':
             self._floor = state
-            self.Modified()
-            return
+        elif object_id in self.objects:
+            self.objects[object_id] = state
+        elif isinstance(object_id, (int, np.integer)) and 0 <= object_id < self._nbunnies:
+            self.objects[self._keys[object_id]] = state
+        else:
+            return 1
 
-        keys = self.objects.keys()
-        self.objects[keys[object_id]] = state
         self.Modified()
@@ -2,6 +2,19 @@ import os
 import time
 
 import vtk
+from vtk.util import numpy_support
+
+import numpy as np
+
+import errno
+import hashlib
+import itertools
+import threading
+from collections import OrderedDict
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
 
 from timeit import default_timer as timer
 import logging
@@ -29,6 +42,560 @@ class VTKImageActorObjects(object):
         self.actor.SetMapper(self.mapper)
 
 
+class SharedRenderContext(object):
+    """
+    A single render window (and OpenGL context) shared by several FilterDepthImage.
+    Each filter renders with its own vtkRenderer in a slot of the window, the slots are
+    side by side, and all the renderers look through the same vtkCamera. Moving the
+    sensor is then one camera update and one render for all the filters.
+    """
+
+    def __init__(self, nslots=2, depth_image_size=(640, 480), offscreen=True):
+        """
+        :param nslots: default=2
+          Maximum number of filters that can share this context.
+        :param depth_image_size: default=(640, 480)
+          Size of the depth image of every filter.
+        :param offscreen: default=True
+          Create the render window offscreen.
+        """
+        self._nslots = nslots
+        self._size = tuple(depth_image_size)
+
+        self.camera = vtk.vtkCamera()
+
+        self.renWin = vtk.vtkRenderWindow()
+        self.renWin.SetSize(nslots * self._size[0], self._size[1])
+        if offscreen:
+            self.renWin.SetOffScreenRendering(1)
+        self.iren = vtk.vtkRenderWindowInteractor()
+        self.iren.SetRenderWindow(self.renWin)
+        self.iren.GetInteractorStyle().SetAutoAdjustCameraClippingRange(0)
+
+        self._renderers = []
+
+    def add_renderer(self):
+        """
+        Take the next free slot of the window.
+        :return: vtkRenderer of the slot, already using the shared camera
+        """
+        slot = len(self._renderers)
+        if slot >= self._nslots:
+            raise ValueError('All {} slots of the render context are taken'.format(self._nslots))
+
+        ren = vtk.vtkRenderer()
+        ren.SetViewport(float(slot) / self._nslots, 0.0,
+                        float(slot + 1) / self._nslots, 1.0)
+        ren.SetActiveCamera(self.camera)
+        self.renWin.AddRenderer(ren)
+        self._renderers.append(ren)
+
+        return ren
+
+    def get_depth_image_size(self):
+        return self._size
+
+    def set_sensor_orientation(self, in_position, in_lookat):
+        """
+        Move the shared camera and render all the filters at once.
+        :param in_position: Position of sensor in world coordinates.
+        :param in_lookat: Where the sensor is looking in world coordinates.
+        """
+        logging.info('position{} lookat{}'.format(in_position, in_lookat))
+
+        self.camera.SetPosition(in_position)
+        self.camera.SetFocalPoint(in_lookat)
+        self.iren.Render()
+
+    def kill_render_window(self):
+        """
+        Kill the shared render window. Only to be used when the user is sure none
+        of the filters will be run again.
+        """
+        self.renWin.Finalize()
+        self.iren.TerminateApp()
+        del self.renWin, self.iren
+
+
+""" NumPy helper functions """
+
+
+def polydata_to_numpy(polydata):
+    """
+    Get the points and triangles of a vtkPolyData as numpy arrays. The polys of
+    the vtkPolyData are assumed to be triangles (see vtkTriangleFilter).
+    :param polydata: vtkPolyData made up of triangles
+    :return: points (npts, 3) and triangles (ntri, 3)
+    """
+    if polydata.GetNumberOfPoints() == 0:
+        return np.zeros((0, 3)), np.zeros((0, 3), dtype=np.int64)
+
+    points = numpy_support.vtk_to_numpy(polydata.GetPoints().GetData())
+
+    polys = polydata.GetPolys()
+    if hasattr(polys, 'GetConnectivityArray'):
+        # VTK >= 9 stores offsets and connectivity separately
+        triangles = numpy_support.vtk_to_numpy(polys.GetConnectivityArray()).reshape(-1, 3)
+    else:
+        triangles = numpy_support.vtk_to_numpy(polys.GetData()).reshape(-1, 4)[:, 1:]
+
+    return points, triangles
+
+
+def numpy_to_polydata(points, triangles, cell_scalars=None):
+    """
+    Create a vtkPolyData made up of triangles from numpy arrays. The arrays are copied.
+    :param points: (npts, 3) array
+    :param triangles: (ntri, 3) array of point indices
+    :param cell_scalars: default=None, optional (ntri, ncomponents) array
+    :return: vtkPolyData
+    """
+    vtkpoints = vtk.vtkPoints()
+    vtkpoints.SetData(numpy_support.numpy_to_vtk(np.ascontiguousarray(points), deep=1))
+
+    polydata = vtk.vtkPolyData()
+    polydata.SetPoints(vtkpoints)
+    polydata.SetPolys(numpy_to_cell_array(triangles))
+
+    if cell_scalars is not None:
+        polydata.GetCellData().SetScalars(
+            numpy_support.numpy_to_vtk(np.ascontiguousarray(cell_scalars), deep=1))
+
+    return polydata
+
+
+def numpy_to_cell_array(triangles, deep=1):
+    """
+    Create a vtkCellArray of triangles in one call instead of one InsertNextCell per
+    triangle.
+    :param triangles: (ntri, 3) array of point indices
+    :param deep: default=1
+      With 0 the vtkCellArray uses the memory of the numpy arrays (VTK >= 9, the
+      triangles have to be of vtkIdType), they have to stay alive and unchanged.
+    :return: vtkCellArray
+    """
+    id_type = numpy_support.get_numpy_array_type(vtk.VTK_ID_TYPE)
+    ntri = triangles.shape[0]
+    polys = vtk.vtkCellArray()
+
+    if hasattr(polys, 'GetConnectivityArray'):
+        # VTK >= 9 stores offsets and connectivity separately
+        offsets = np.arange(0, 3 * ntri + 1, 3, dtype=id_type)
+        connectivity = np.ascontiguousarray(triangles, dtype=id_type).reshape(-1)
+        polys.SetData(numpy_support.numpy_to_vtkIdTypeArray(offsets, deep=deep),
+                      numpy_support.numpy_to_vtkIdTypeArray(connectivity, deep=deep))
+    else:
+        # legacy cell array layout, (3, id0, id1, id2) for every triangle
+        legacy = np.empty((ntri, 4), dtype=id_type)
+        legacy[:, 0] = 3
+        legacy[:, 1:] = triangles
+        polys.SetCells(ntri, numpy_support.numpy_to_vtkIdTypeArray(legacy.reshape(-1), deep=1))
+
+    return polys
+
+
+_ray_tables = {}
+
+
+def get_ray_table(width, height, view_angle, viewport=(0.0, 0.0, 1.0, 1.0), dtype=np.float64):
+    """
+    Direction of the ray through every pixel of a depth image, in camera coordinates
+    and scaled to unit length along the optical axis (z = -1), so a point with metric
+    depth z is simply z * ray. Pixels are in the same order and at the same display
+    coordinates as the z-buffer unprojection in FilterDepthImageToSurface. The tables
+    are cached for every resolution / field of view.
+    :param width: width of the depth image
+    :param height: height of the depth image
+    :param view_angle: vertical field of view in degrees (vtkCamera.GetViewAngle())
+    :param viewport: viewport of the renderer the depth image came from
+    :param dtype: default=np.float64
+    :return: numpy array (3, width * height)
+    """
+    key = (width, height, view_angle, tuple(viewport), np.dtype(dtype))
+    if key in _ray_tables:
+        return _ray_tables[key]
+
+    (w, h, vp) = (width, height, viewport)
+    xd, yd = np.meshgrid(np.arange(w), np.arange(h))
+
+    # normalized viewport coordinates
+    # https://github.com/Kitware/VTK/blob/52d45496877b00852a08a5b9819d109c2fd9bfab/Rendering/Core/vtkCoordinate.h#L26
+    xv = 2.0 * (xd.reshape(-1) - w * vp[0]) / (w * (vp[2] - vp[0])) - 1.0
+    yv = 2.0 * (yd.reshape(-1) - h * vp[1]) / (h * (vp[3] - vp[1])) - 1.0
+
+    tan_half = np.tan(np.radians(view_angle) / 2.0)
+    aspect = (w * (vp[2] - vp[0])) / (h * (vp[3] - vp[1]))
+    rays = np.vstack((xv * tan_half * aspect,
+                      yv * tan_half,
+                      -np.ones(w * h))).astype(dtype)
+
+    _ray_tables[key] = rays
+    return rays
+
+
+def zbuffer_to_metric_difference(difference, depth, clipping_range):
+    """
+    A z-buffer value is affine in the inverse of the metric depth, so a difference of
+    z-buffer values stands for a metric difference that grows with the square of the
+    depth. Used to turn the z-buffer thresholds of the filters into metres.
+    :param difference: difference of z-buffer values
+    :param depth: metric depth of the difference
+    :param clipping_range: (near, far) of the camera of the depth images
+    :return: the difference in metres at depth
+    """
+    (n, f) = clipping_range
+    return difference * depth ** 2 * (f - n) / (n * f)
+
+
+def get_boxes_in_frustum(bounds, camera, aspect):
+    """
+    :param bounds: (nboxes, 6) array of axis aligned boxes (xmin, xmax, ymin, ymax, zmin, zmax)
+    :param camera: vtkCamera
+    :param aspect: width / height of the view
+    :return: indices of the boxes that intersect the frustum of the camera
+    """
+    planes = [0.0] * 24
+    camera.GetFrustumPlanes(aspect, planes)
+    planes = np.array(planes).reshape(6, 4)
+
+    # a box is outside when its corner furthest along the (inward) normal of a
+    # plane is behind that plane
+    visible = np.ones(bounds.shape[0], dtype=bool)
+    for plane in planes:
+        corner = np.where(plane[0:3] >= 0.0, bounds[:, 1::2], bounds[:, 0::2])
+        visible &= np.dot(corner, plane[0:3]) + plane[3] >= 0.0
+
+    return np.flatnonzero(visible)
+
+
+""" Source helper classes """
+
+
+class ObjectGeometry(object):
+    """
+    Geometry of the objects of an environment, built once
+
+    The points of all the objects are kept once, one after the other, and every
+    object is a range of points and a range of polys. get_polydata() shares the
+    points (and point data) of all the objects without copying them and only
+    gathers the polys of the objects that are present, a slice for every run of
+    consecutive present objects. The result is kept for that set of objects (up to
+    cache_size_mb of polys), so adding and removing objects in a dynamic environment
+    does not build the geometry again and a set of objects seen before gives the
+    same vtkPolyData.
+
+    As the points of the objects that are not present are in every vtkPolyData, its
+    GetBounds() covers all the objects (mappers only use the points of the polys),
+    get_bounds() gives the bounds of the present ones.
+    """
+
+    def __init__(self, objects, cache_size_mb=64):
+        """
+        :param objects: list of (name, vtkPolyData) made up of polys only
+        :param cache_size_mb: default=64
+          Memory the polys of the sets of objects kept can take, the least recently
+          used set is dropped first.
+        """
+        start = timer()
+
+        self._cache = OrderedDict()
+        self._cache_size = int(cache_size_mb * 1024 * 1024)
+        self._cache_nbytes = 0
+
+        if not objects:
+            self._set_objects([], np.zeros((0, 3)), [], np.zeros(1, dtype=np.int64),
+                              np.zeros(0, dtype=np.int64), [], [])
+            return
+
+        append = vtk.vtkAppendPolyData()
+        for (_, polydata) in objects:
+            append.AddInputData(polydata)
+        append.Update()
+        polydata = append.GetOutput()
+
+        point_data = polydata.GetPointData()
+        arrays = []
+        for a in range(point_data.GetNumberOfArrays()):
+            array = point_data.GetArray(a)
+            arrays.append((array.GetName(), numpy_support.vtk_to_numpy(array),
+                           point_data.IsArrayAnAttribute(a)))
+
+        # offsets into the connectivity of every poly
+        polys = polydata.GetPolys()
+        if hasattr(polys, 'GetConnectivityArray'):
+            # VTK >= 9 stores offsets and connectivity separately
+            offsets = numpy_support.vtk_to_numpy(polys.GetOffsetsArray()).astype(np.int64)
+            connectivity = numpy_support.vtk_to_numpy(polys.GetConnectivityArray()).astype(np.int64)
+        else:
+            # legacy layout, (n, id0, ..., idn-1) for every poly
+            legacy = numpy_support.vtk_to_numpy(polys.GetData()).astype(np.int64)
+            offsets = np.zeros(polys.GetNumberOfCells() + 1, dtype=np.int64)
+            location = 0
+            for i in range(polys.GetNumberOfCells()):
+                offsets[i + 1] = offsets[i] + legacy[location]
+                location += legacy[location] + 1
+            keep = np.ones(legacy.shape[0], dtype=bool)
+            keep[offsets[:-1] + np.arange(polys.GetNumberOfCells())] = False
+            connectivity = legacy[keep]
+
+        # vtkAppendPolyData keeps the order of the inputs
+        self._set_objects([name for (name, _) in objects],
+                          numpy_support.vtk_to_numpy(polydata.GetPoints().GetData()), arrays,
+                          offsets, connectivity,
+                          [p.GetNumberOfPoints() for (_, p) in objects],
+                          [p.GetNumberOfPolys() for (_, p) in objects])
+
+        end = timer()
+        logging.debug('Object geometry built in {:.4f} seconds'.format(end - start))
+
+    @staticmethod
+    def from_triangles(names, points, triangles, npoints, ntriangles, cache_size_mb=64):
+        """
+        Build the geometry of many objects from arrays instead of one vtkPolyData each.
+        :param names: name of every object
+        :param points: (npts, 3) array, the points of every object one after the other,
+          used without a copy
+        :param triangles: (ntri, 3) array, the triangles of every object one after the
+          other, indexing all the points
+        :param npoints: number of points of every object
+        :param ntriangles: number of triangles of every object
+        :return: ObjectGeometry
+        """
+        geometry = ObjectGeometry([], cache_size_mb=cache_size_mb)
+        geometry._set_objects(list(names), points, [],
+                              np.arange(0, 3 * triangles.shape[0] + 1, 3, dtype=np.int64),
+                              triangles.reshape(-1), npoints, ntriangles)
+        return geometry
+
+    def _set_objects(self, names, points, arrays, offsets, connectivity, npoints, npolys):
+        id_type = numpy_support.get_numpy_array_type(vtk.VTK_ID_TYPE)
+        self._names = names
+        self._index = dict((name, i) for i, name in enumerate(names))
+        self._offsets = offsets.astype(id_type, copy=False)
+        self._connectivity = connectivity.astype(id_type, copy=False)
+        self._triangles_only = np.array_equal(self._offsets, np.arange(0, 3 * self._offsets.shape[0], 3))
+
+        # first point and first poly of every object and one past the last object
+        npoints = np.asarray(npoints, dtype=np.int64)
+        npolys = np.asarray(npolys, dtype=np.int64)
+        self._first_poly = np.concatenate(([0], np.cumsum(npolys)))
+
+        # the points and point data of every vtkPolyData
+        points = np.ascontiguousarray(points)
+        self._points = vtk.vtkPoints()
+        self._points.SetData(numpy_support.numpy_to_vtk(points, deep=0))
+        self._point_data = []
+        for (name, array, attribute) in arrays:
+            vtkarray = numpy_support.numpy_to_vtk(np.ascontiguousarray(array), deep=0)
+            vtkarray.SetName(name)
+            self._point_data.append((name, vtkarray, attribute))
+
+        # bounds of every object, nan if it has no points
+        self._bounds = np.full((len(names), 6), np.nan)
+        nonempty = npoints > 0
+        if nonempty.any():
+            first_point = (np.cumsum(npoints) - npoints)[nonempty]
+            self._bounds[nonempty, 0::2] = np.minimum.reduceat(points, first_point)
+            self._bounds[nonempty, 1::2] = np.maximum.reduceat(points, first_point)
+
+    def get_names(self):
+        return list(self._names)
+
+    def get_bounds(self, names):
+        """
+        :param names: the objects that are present
+        :return: (xmin, xmax, ymin, ymax, zmin, zmax) of these objects, like
+          vtkPolyData.GetBounds() (1, -1, 1, -1, 1, -1) when there are none
+        """
+        bounds = self._bounds[[self._index[name] for name in names if name in self._index]]
+        bounds = bounds[~np.isnan(bounds[:, 0])]
+        if bounds.shape[0] == 0:
+            return (1.0, -1.0, 1.0, -1.0, 1.0, -1.0)
+        return tuple(float(b) for b in np.column_stack((bounds[:, 0::2].min(axis=0),
+                                                        bounds[:, 1::2].max(axis=0))).ravel())
+
+    def get_polydata(self, names):
+        """
+        :param names: the objects that are present
+        :return: vtkPolyData with the polys of these objects and the points of all the
+          objects, do not modify it
+        """
+        key = frozenset(names)
+        if key in self._cache:
+            self._cache[key] = self._cache.pop(key)
+            return self._cache[key][0]
+
+        # runs of consecutive present objects and their range of polys
+        present = np.zeros(len(self._names) + 2, dtype=np.int8)
+        present[[self._index[name] + 1 for name in key if name in self._index]] = 1
+        edges = np.diff(present)
+        (first, last) = (self._first_poly[np.flatnonzero(edges == 1)],
+                         self._first_poly[np.flatnonzero(edges == -1)])
+
+        # one run is a view of the polys of all the objects
+        pieces = [self._connectivity[self._offsets[f]:self._offsets[l]] for f, l in zip(first, last)]
+        connectivity = pieces[0] if len(pieces) == 1 else \
+            np.concatenate(pieces) if pieces else self._connectivity[:0]
+        npolys = int((last - first).sum())
+        if self._triangles_only:
+            offsets = self._offsets[:npolys + 1]
+        elif len(pieces) == 1 and first[0] == 0:
+            offsets = self._offsets[:last[0] + 1]
+        else:
+            sizes = np.concatenate([np.diff(self._offsets[f:l + 1]) for f, l in zip(first, last)] +
+                                   [np.zeros(0, dtype=self._offsets.dtype)])
+            offsets = np.concatenate(([0], np.cumsum(sizes))).astype(self._offsets.dtype)
+        nbytes = sum(a.nbytes for a in (connectivity, offsets)
+                     if not np.shares_memory(a, self._connectivity) and not np.shares_memory(a, self._offsets))
+
+        polydata = vtk.vtkPolyData()
+        polydata.SetPoints(self._points)
+        for (name, vtkarray, attribute) in self._point_data:
+            polydata.GetPointData().AddArray(vtkarray)
+            if attribute >= 0:
+                polydata.GetPointData().SetActiveAttribute(name, attribute)
+
+        polys = vtk.vtkCellArray()
+        if hasattr(polys, 'GetConnectivityArray'):
+            polys.SetData(numpy_support.numpy_to_vtkIdTypeArray(offsets, deep=0),
+                          numpy_support.numpy_to_vtkIdTypeArray(connectivity, deep=0))
+        else:
+            legacy = np.insert(connectivity, offsets[:-1], np.diff(offsets))
+            polys.SetCells(offsets.shape[0] - 1, numpy_support.numpy_to_vtkIdTypeArray(legacy, deep=1))
+        polydata.SetPolys(polys)
+
+        # evict the least recently used, the newest set is always kept
+        self._cache[key] = (polydata, nbytes)
+        self._cache_nbytes += nbytes
+        while self._cache_nbytes > self._cache_size and len(self._cache) > 1:
+            (_, (_, old)) = self._cache.popitem(last=False)
+            self._cache_nbytes -= old
+        return polydata
+
+
+_meshes = {}
+
+
+def read_triangle_mesh(filename):
+    """
+    Points and triangles of a mesh file (.ply, .stl, .obj or .vtp), read once per
+    process. The first time a file is read the arrays are also saved to an .npz next
+    to it, named after the hash of the file, so other processes only load the .npz.
+    :param filename: mesh file
+    :return: points (npts, 3) and triangles (ntri, 3), shared and read-only
+    """
+    filename = os.path.abspath(filename)
+    stat = os.stat(filename)
+    key = (filename, stat.st_size, stat.st_mtime)
+    if key in _meshes:
+        return _meshes[key]
+
+    start = timer()
+
+    with open(filename, 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()[:16]
+    npz_file = '{}.{}.npz'.format(os.path.splitext(filename)[0], digest)
+
+    if os.path.exists(npz_file):
+        with np.load(npz_file) as npz:
+            (points, triangles) = (npz['points'], npz['triangles'])
+    else:
+        readers = {'.ply': vtk.vtkPLYReader,
+                   '.stl': vtk.vtkSTLReader,
+                   '.obj': vtk.vtkOBJReader,
+                   '.vtp': vtk.vtkXMLPolyDataReader}
+        extension = os.path.splitext(filename)[1].lower()
+        if extension not in readers:
+            raise ValueError('Can not read {}, the mesh file types are {}'.format(
+                filename, sorted(readers.keys())))
+        reader = readers[extension]()
+        reader.SetFileName(filename)
+        triangle_filter = vtk.vtkTriangleFilter()
+        triangle_filter.SetInputConnection(reader.GetOutputPort())
+        triangle_filter.PassVertsOff()
+        triangle_filter.PassLinesOff()
+        triangle_filter.Update()
+        (points, triangles) = polydata_to_numpy(triangle_filter.GetOutput())
+        (points, triangles) = (np.array(points), np.array(triangles))
+
+        # write to a temporary file first, processes reading the same mesh may race
+        try:
+            tmp_file = '{}.{}.npz'.format(npz_file[:-4], os.getpid())
+            np.savez(tmp_file, points=points, triangles=triangles)
+            os.rename(tmp_file, npz_file)
+        except (IOError, OSError) as e:
+            logging.warning('Mesh cache {} not written, {}'.format(npz_file, e))
+
+    points.flags.writeable = False
+    triangles.flags.writeable = False
+    _meshes[key] = (points, triangles)
+
+    end = timer()
+    logging.debug('{} read in {:.4f} seconds'.format(filename, end - start))
+
+    return _meshes[key]
+
+
+""" Noise helper classes """
+
+
+class NoiseBank(object):
+    """
+    Random samples drawn ahead of time by a background thread.
+
+    The thread keeps a queue of nbanks samples full so get() only waits when the
+    consumer is faster than the generator. There is a single producer so the
+    sequence of samples only depends on the seed. The thread does not hold the
+    bank, it stops on close() or when the bank is garbage collected.
+    """
+
+    def __init__(self, generate, seed=None, nbanks=4):
+        """
+        :param generate: function that takes a numpy Generator and returns a sample,
+          it is held by the thread so it must not hold the owner of the bank (a
+          function or a functools.partial, not a bound method)
+        :param seed: default=None
+          Seed of the numpy Generator.
+        :param nbanks: default=4
+          Number of samples kept ready.
+        """
+        self._queue = Queue(maxsize=nbanks)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=NoiseBank._fill,
+                                        args=(generate, np.random.default_rng(seed),
+                                              self._queue, self._stop))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __del__(self):
+        # no join, this can run while the interpreter shuts down
+        self._release()
+
+    def get(self):
+        """
+        :return: the next sample, owned by the caller
+        """
+        return self._queue.get()
+
+    def close(self):
+        """
+        Stop the thread, get() must not be called after this.
+        """
+        self._release()
+        self._thread.join()
+
+    def _release(self):
+        self._stop.set()
+        # free the slot the thread may be waiting for, it then sees the event
+        while not self._queue.empty():
+            self._queue.get_nowait()
+
+    @staticmethod
+    def _fill(generate, rng, queue, stop):
+        while not stop.is_set():
+            queue.put(generate(rng))
+
+
 """ Debug helper classes """
 
 
@@ -55,28 +622,52 @@ class DebugTimeVTKFilter(object):
 """ Mabdi Simulate related helper functions """
 
 
-def get_file_prefix(folder_name):
+def get_output_folder(folder_name, output_dir='../output/', create=True):
+    """
+    :param folder_name: folder in output_dir, None is output_dir itself
+    :param output_dir: default='../output/'
+    :param create: default=True
+      Create the folder if needed, False only builds the path.
+    :return: path of the folder ending with '/'
+    """
+    file_dir = output_dir + folder_name + '/' if folder_name else output_dir
+    if create and not os.path.exists(file_dir):
+        try:
+            os.makedirs(file_dir)
+        except OSError:
+            # created by another process in the meantime
+            if not os.path.isdir(file_dir):
+                raise
+    return file_dir
+
+
+def get_file_prefix(folder_name, output_dir='../output/', claim_file=None):
+    """
+    :param folder_name: folder in output_dir, None is output_dir itself
+    :param output_dir: default='../output/'
+    :param claim_file: default=None
+      Name of a file the caller writes next, it is created empty with the prefix so
+      runs started in the same second in the same folder get different prefixes.
+      None creates nothing and runs started in the same second share the prefix.
+    :return: prefix of the output files, the folder and the time
+    """
 
     # output folder
-    start_time = time.strftime('%m-%d_%H-%M-%S_')
-    output_dir = '../output/'
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-
-    if folder_name:
-        file_dir = output_dir + folder_name + '/'
-    else:
-        file_dir = output_dir
-
-    if not os.path.exists(file_dir):
-        os.makedirs(file_dir)
+    file_dir = get_output_folder(folder_name, output_dir)
 
+    start_time = time.strftime('%m-%d_%H-%M-%S_')
     file_prefix = file_dir + start_time
+    if claim_file is None:
+        return file_prefix
+
+    # the first to create the file of a prefix gets it
+    for n in itertools.count(1):
+        try:
+            os.close(os.open(file_prefix + claim_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            break
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            file_prefix = file_dir + start_time + str(n) + '_'
 
     return file_prefix
-
-
-
-
-
-
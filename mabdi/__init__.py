@@ -1,17 +1,33 @@
 
 from MabdiSimulate import MabdiSimulate
+from MabdiRunner import MabdiRunner
 
 from SourceEnvironmentTable import SourceEnvironmentTable
 from SourceStanfordBunny import SourceStandfordBunny
+from SourceProcedural import SourceProcedural
+from SourceMeshFiles import SourceMeshFiles
 from FilterDepthImage import FilterDepthImage
+from RayCastDepthBackend import RayCastDepthBackend
+from KinectNoiseModel import KinectNoiseModel
 from FilterClassifier import FilterClassifier
 from FilterDepthImageToSurface import FilterDepthImageToSurface
 from FilterWorldMesh import FilterWorldMesh
+from FilterWorldTSDF import FilterWorldTSDF
+from MeshStore import MeshStore
+from ChunkFileStore import ChunkFileStore
+from ChunkDecimator import ChunkDecimator
+from FilterFrustumCull import FilterFrustumCull
 
 from Utilities import VTKImageActorObjects
 from Utilities import VTKPolyDataActorObjects
+from Utilities import SharedRenderContext
+from Utilities import ObjectGeometry
+from Utilities import read_triangle_mesh
+from Utilities import NoiseBank
 from Utilities import DebugTimeVTKFilter
+from Utilities import get_output_folder
 from Utilities import get_file_prefix
+from Utilities import zbuffer_to_metric_difference
 from Output import PostProcess
 from Output import RenderWindowToAvi
 from Output import MovieNamesList
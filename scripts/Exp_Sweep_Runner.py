@@ -0,0 +1,40 @@
+import mabdi
+
+import logging
+
+logging.basicConfig(level=logging.INFO,
+                    format="%(levelname)s %(module)s @ %(funcName)s: %(message)s")
+
+# sweep over environment and noise, the runs are done in parallel and a run that
+# already completed is skipped when the script is started again
+
+""" parameters that apply to all """
+
+nsteps = 30
+
+g_mabdi_param = {'depth_image_size': (640, 480),
+                 'farplane_threshold': 0.99}
+g_sim_param = {'path_nsteps': nsteps,
+               'interactive': False}
+g_output = {'movie': False,
+            'save_global_mesh': True}
+
+""" runs """
+
+runs = []
+for environment_name, path_name in [('table', 'helix_table_ub'),
+                                    ('stanford_bunny', 'helix_bunny_ub')]:
+    for noise in [False, 0.001, 'kinect']:
+        mabdi_param, sim_param, output = g_mabdi_param.copy(), g_sim_param.copy(), g_output.copy()
+
+        sim_param['environment_name'] = environment_name
+        sim_param['path_name'] = path_name
+        sim_param['noise'] = noise
+
+        output['folder_name'] = 'sweep/env_{}_noise_{}_nsteps{}'.format(environment_name, noise, nsteps)
+
+        runs.append((mabdi_param, sim_param, output))
+
+if __name__ == '__main__':
+    runner = mabdi.MabdiRunner(runs, nprocesses=None, resume=True)
+    runner.run()
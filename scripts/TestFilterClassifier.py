@@ -0,0 +1,72 @@
+import vtk
+from vtk.util import numpy_support
+
+import mabdi
+
+import numpy as np
+
+import logging
+
+logging.basicConfig(level=logging.DEBUG,
+                    format="%(levelname)s %(module)s @ %(funcName)s: %(message)s")
+
+"""
+Script to test FilterClassifier
+    The actual sensor sees the table environment, the world mesh is the same
+    environment without the cups. The depth images are rendered offscreen in the
+    'zbuffer' and in the 'metric' depth mode (with the metric thresholds of
+    MabdiSimulate). Both modes have to classify the same pixels as new, except the
+    ones with a difference between the metric threshold and the z-buffer threshold in
+    metres at their depth (see MabdiSimulate).
+    Nothing is shown, an AssertionError tells what broke.
+"""
+
+""" Both depth modes classify the same pixels on a static scene """
+
+actual = mabdi.SourceEnvironmentTable()
+expected = mabdi.SourceEnvironmentTable()
+expected.set_object_state(object_id='left_cup', state=False)
+expected.set_object_state(object_id='right_cup', state=False)
+
+thresholds = {'zbuffer': 0.01,
+              'metric': mabdi.zbuffer_to_metric_difference(0.01, 2.0, (0.8, 4.0))}
+positions = np.array([[-1.0, 1.5, 1.5], [0.0, 1.2, 2.0], [1.0, 1.5, 1.5]])
+lookat = (0.0, 0.75, 0.0)
+
+novel = {}
+depths = []
+for mode in ('zbuffer', 'metric'):
+    di = mabdi.FilterDepthImage(offscreen=True, depth_image_size=(320, 240), depth_mode=mode)
+    di.set_polydata(actual)
+    sdi = mabdi.FilterDepthImage(offscreen=True, depth_image_size=(320, 240), depth_mode=mode)
+    sdi.set_polydata(expected)
+    classifier = mabdi.FilterClassifier(param_classifier_threshold=thresholds[mode])
+    classifier.AddInputConnection(0, di.GetOutputPort())
+    classifier.AddInputConnection(1, sdi.GetOutputPort())
+
+    novel[mode] = []
+    for position in positions:
+        di.set_sensor_orientation(position, lookat)
+        sdi.set_sensor_orientation(position, lookat)
+        di.Modified()
+        sdi.Modified()
+        classifier.Update()
+        out = numpy_support.vtk_to_numpy(classifier.GetOutputDataObject(0).GetPointData().GetScalars())
+        # the pixels left are the new ones, the others are set to the background value
+        novel[mode].append(out < 1.0 if mode == 'zbuffer' else out > 0.0)
+        if mode == 'metric':
+            depths.append([numpy_support.vtk_to_numpy(f.GetOutputDataObject(0).GetPointData().GetScalars())
+                           .astype(np.float64) for f in (di, sdi)])
+    di.kill_render_window()
+    sdi.kill_render_window()
+
+for (zbuffer, metric, (d1, d2)) in zip(novel['zbuffer'], novel['metric'], depths):
+    assert zbuffer.any()
+    differ = zbuffer != metric
+    assert np.count_nonzero(differ) <= 0.05 * np.count_nonzero(zbuffer), np.count_nonzero(differ)
+    # the difference of z-buffer values is the metric one at the geometric mean depth
+    zbuffer_threshold = mabdi.zbuffer_to_metric_difference(0.01, np.sqrt(d1[differ] * d2[differ]), (0.8, 4.0))
+    difference = np.abs(d1[differ] - d2[differ])
+    assert (difference >= np.minimum(zbuffer_threshold, thresholds['metric'])).all()
+    assert (difference < np.maximum(zbuffer_threshold, thresholds['metric'])).all()
+logging.info('both depth modes classify the same pixels ok')
@@ -0,0 +1,97 @@
+import vtk
+
+import mabdi
+from Utilities import polydata_to_numpy
+
+import numpy as np
+
+import logging
+
+logging.basicConfig(level=logging.DEBUG,
+                    format="%(levelname)s %(module)s @ %(funcName)s: %(message)s")
+
+"""
+Script to test FilterDepthImageToSurface
+    Projects a depth image (rendered offscreen) of a box on a floor, in both depth
+    modes and with and without the quadtree, and checks that the surface lies on the
+    scene without triangles bridging the silhouette of the box.
+    Nothing is shown, an AssertionError tells what broke.
+"""
+
+
+def distance_to_scene(points, bounds):
+    """
+    :return: distance of every point to the floor (y = 0) or the box, whichever is closer
+    """
+    outside = np.maximum(bounds[0::2] - points, points - bounds[1::2])
+    to_box = np.where(outside.max(axis=1) > 0.0,
+                      np.linalg.norm(np.maximum(outside, 0.0), axis=1), -outside.max(axis=1))
+    return np.minimum(np.abs(points[:, 1]), np.abs(to_box))
+
+
+def area(points, triangles):
+    (v0, v1, v2) = (points[triangles[:, 0]], points[triangles[:, 1]], points[triangles[:, 2]])
+    return 0.5 * np.linalg.norm(np.cross(v1 - v0, v2 - v0), axis=1).sum()
+
+
+""" Surface of a box on a floor """
+
+bounds = np.array([-0.25, 0.25, 0.0, 0.3, -0.25, 0.25])
+floor = vtk.vtkPlaneSource()
+floor.SetOrigin(-2.0, 0.0, -2.0)
+floor.SetPoint1(2.0, 0.0, -2.0)
+floor.SetPoint2(-2.0, 0.0, 2.0)
+box = vtk.vtkCubeSource()
+box.SetBounds(bounds)
+environment = vtk.vtkAppendPolyData()
+environment.AddInputConnection(floor.GetOutputPort())
+environment.AddInputConnection(box.GetOutputPort())
+
+# the metric thresholds of MabdiSimulate
+params = {'zbuffer': {},
+          'metric': {'param_farplane_threshold': 4.0,
+                     'param_convolution_threshold': mabdi.zbuffer_to_metric_difference(0.01, 2.0, (0.8, 4.0)),
+                     'param_quadtree_tolerance': mabdi.zbuffer_to_metric_difference(0.0005, 2.0, (0.8, 4.0))}}
+for mode in ('zbuffer', 'metric'):
+    di = mabdi.FilterDepthImage(offscreen=True, depth_image_size=(160, 120), depth_mode=mode)
+    di.set_polydata(environment)
+    di.set_sensor_orientation((0.3, 1.2, 1.5), (0.0, 0.0, 0.0))
+    di.Modified()
+
+    surfaces = []
+    for block_size in (None, 32):
+        surface = mabdi.FilterDepthImageToSurface(param_quadtree_max_block_size=block_size, **params[mode])
+        surface.SetInputConnection(di.GetOutputPort())
+        surface.Update()
+        (points, triangles) = polydata_to_numpy(surface.GetOutputDataObject(0))
+        surfaces.append((points, triangles))
+
+        # the points are on the scene and so are the triangles, a triangle from the
+        # top of the box to the floor behind it would be far from both
+        assert distance_to_scene(points, bounds).max() < 0.005, (mode, block_size)
+        assert distance_to_scene(points[triangles].mean(axis=1), bounds).max() < 0.01, (mode, block_size)
+
+    # the quadtree covers the same surface with far fewer triangles
+    (full, quadtree) = surfaces
+    assert quadtree[1].shape[0] < 0.1 * full[1].shape[0]
+    assert abs(area(*quadtree) - area(*full)) < 1e-3 * area(*full)
+    di.kill_render_window()
+logging.info('surface of a box on a floor ok')
+
+
+""" Shared topology """
+
+# instances of the same resolution use the same pixel grid and triangles
+di = mabdi.FilterDepthImage(offscreen=True, depth_image_size=(160, 120))
+di.set_polydata(environment)
+di.set_sensor_orientation((0.3, 1.2, 1.5), (0.0, 0.0, 0.0))
+first = mabdi.FilterDepthImageToSurface()
+first.SetInputConnection(di.GetOutputPort())
+first.Update()
+second = mabdi.FilterDepthImageToSurface()
+second.SetInputConnection(di.GetOutputPort())
+second.Update()
+assert first._triangles is second._triangles
+assert first._triangles.shape == (2 * 159 * 119, 3)
+di.kill_render_window()
+logging.info('shared topology ok')
@@ -0,0 +1,151 @@
+import vtk
+
+import mabdi
+from Utilities import numpy_to_polydata
+
+import numpy as np
+
+import gc
+import shutil
+import tempfile
+import threading
+import time
+
+import logging
+
+logging.basicConfig(level=logging.DEBUG,
+                    format="%(levelname)s %(module)s @ %(funcName)s: %(message)s")
+
+"""
+Script to test FilterWorldMesh
+    Feeds the filter surfaces without rendering anything and checks that the out of
+    core mode keeps the resident chunks and its output within the memory budget, that
+    the thread of the decimator stops and that carving removes an object that left.
+    Only the carving depth image is rendered (offscreen).
+    Nothing is shown, an AssertionError tells what broke.
+"""
+
+
+def grid_surface(nx, ny, origin=(0.0, 0.0, 0.0), spacing=0.02):
+    """
+    :return: vtkPolyData of a flat grid of nx by ny points in the xz plane
+    """
+    (x, z) = np.meshgrid(np.arange(nx) * spacing, np.arange(ny) * spacing)
+    points = np.column_stack((x.ravel(), np.zeros(x.size), z.ravel())) + origin
+    i = np.arange((ny - 1) * nx).reshape(ny - 1, nx)[:, :-1].ravel()
+    triangles = np.vstack((np.column_stack((i, i + 1, i + nx)),
+                           np.column_stack((i + 1, i + nx + 1, i + nx))))
+    return numpy_to_polydata(points, triangles)
+
+
+""" Out of core memory budget """
+
+path = tempfile.mkdtemp()
+try:
+    budget_mb = 2
+    surface = vtk.vtkTrivialProducer()
+    world_mesh = mabdi.FilterWorldMesh(chunk_size=0.5, out_of_core_path=path,
+                                       resident_budget_mb=budget_mb)
+    world_mesh.SetInputConnection(surface.GetOutputPort())
+    # a sensor moving along x, every frame sees a new patch and part of the last one
+    for frame in range(60):
+        surface.SetOutput(grid_surface(50, 50, origin=(0.25 * frame, 0.0, 0.0)))
+        world_mesh.Update()
+
+        chunk_files = world_mesh.get_chunk_file_store()
+        store = world_mesh.get_mesh_store()
+        nbytes = chunk_files.get_resident_nbytes() + store.get_nbytes()
+        assert nbytes <= budget_mb * 1024 * 1024, (frame, nbytes)
+
+        # the output is the resident chunks
+        resident = chunk_files.get_resident_chunks()
+        output = world_mesh.GetOutputDataObject(0)
+        assert output.GetNumberOfCells() - store.get_number_of_removed_triangles() == \
+            chunk_files.get_number_of_triangles(resident)
+
+    assert chunk_files.get_stats()['spilled'] > 0
+    assert world_mesh.get_number_of_triangles() == 60 * 2 * 49 * 49
+finally:
+    shutil.rmtree(path)
+logging.info('out of core memory budget ok')
+
+
+""" Decimator thread """
+
+nthreads = threading.active_count()
+surface = vtk.vtkTrivialProducer()
+world_mesh = mabdi.FilterWorldMesh(chunk_size=0.5, decimation_target=100, decimation_settle_frames=1)
+world_mesh.SetInputConnection(surface.GetOutputPort())
+for frame in range(5):
+    surface.SetOutput(grid_surface(20, 20, origin=(0.5 * frame, 0.0, 0.0)))
+    world_mesh.Update()
+assert threading.active_count() == nthreads + 1
+world_mesh.close()
+assert threading.active_count() == nthreads
+
+# without close() the thread stops when the decimator is collected
+decimator = mabdi.ChunkDecimator()
+assert threading.active_count() == nthreads + 1
+del decimator
+gc.collect()
+time.sleep(0.1)
+assert threading.active_count() == nthreads
+logging.info('decimator thread ok')
+
+
+""" Carving an object that left the environment """
+
+# a floor with a box on it, the box is taken away after the first frame
+floor = vtk.vtkPlaneSource()
+floor.SetOrigin(-1.0, 0.0, -1.0)
+floor.SetPoint1(2.0, 0.0, -1.0)
+floor.SetPoint2(-1.0, 0.0, 2.0)
+box = vtk.vtkCubeSource()
+box.SetBounds(0.2, 0.7, 0.0, 0.3, 0.2, 0.7)
+environment = vtk.vtkAppendPolyData()
+environment.AddInputConnection(floor.GetOutputPort())
+environment.AddInputConnection(box.GetOutputPort())
+environment.Update()
+scene = vtk.vtkTrivialProducer()
+scene.SetOutput(environment.GetOutput())
+
+di = mabdi.FilterDepthImage(offscreen=True, depth_image_size=(160, 120))
+di.set_polydata(scene)
+
+# the world mesh already holds the floor and the top of the box
+surface = vtk.vtkTrivialProducer()
+world_mesh = mabdi.FilterWorldMesh(chunk_size=0.5, carving_depth_image=di)
+world_mesh.SetInputConnection(surface.GetOutputPort())
+floor_grid = grid_surface(41, 41, origin=(-0.1, 0.0, -0.1), spacing=0.025)
+box_top = grid_surface(21, 21, origin=(0.2, 0.3, 0.2), spacing=0.025)
+nfloor = floor_grid.GetNumberOfCells()
+nbox = box_top.GetNumberOfCells()
+merged = vtk.vtkAppendPolyData()
+merged.AddInputData(floor_grid)
+merged.AddInputData(box_top)
+merged.Update()
+surface.SetOutput(merged.GetOutput())
+world_mesh.Update()  # the depth image has no pose yet, carving is skipped
+assert world_mesh.get_carving_stats()['tested'] == 0
+assert world_mesh.get_number_of_triangles() == nfloor + nbox
+
+di.set_sensor_orientation((0.45, 1.2, -1.2), (0.45, 0.0, 0.45))
+di.Modified()
+di.Update()
+surface.SetOutput(vtk.vtkPolyData())
+world_mesh.Update()
+assert world_mesh.get_carving_stats()['removed'] == 0
+assert world_mesh.get_number_of_triangles() == nfloor + nbox
+
+# the sensor now sees the floor through where the top of the box was
+scene.SetOutput(floor.GetOutput())
+di.set_sensor_orientation((0.45, 1.2, -1.2), (0.45, 0.0, 0.45))
+di.Modified()
+di.Update()
+surface.Modified()
+world_mesh.Update()
+stats = world_mesh.get_carving_stats()
+assert 0.9 * nbox <= stats['removed'] <= nbox, stats
+assert world_mesh.get_number_of_triangles() == nfloor + nbox - stats['removed']
+di.kill_render_window()
+logging.info('carving ok')
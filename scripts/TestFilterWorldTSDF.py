@@ -0,0 +1,68 @@
+import vtk
+from vtk.util import numpy_support
+
+import mabdi
+
+import numpy as np
+
+import logging
+
+logging.basicConfig(level=logging.DEBUG,
+                    format="%(levelname)s %(module)s @ %(funcName)s: %(message)s")
+
+"""
+Script to test FilterWorldTSDF
+    Fuses depth images of a box seen from all around (rendered offscreen) and checks
+    that the surface is closed and close to the faces of the box.
+    Nothing is shown, an AssertionError tells what broke.
+"""
+
+""" Closed surface of a box """
+
+voxel_size = 0.02
+bounds = np.array([-0.15, 0.15, -0.1, 0.1, -0.125, 0.125])
+box = vtk.vtkCubeSource()
+box.SetBounds(bounds)
+
+di = mabdi.FilterDepthImage(offscreen=True, depth_image_size=(320, 240))
+di.set_polydata(box)
+
+tsdf = mabdi.FilterWorldTSDF(voxel_size=voxel_size)
+tsdf.SetInputConnection(di.GetOutputPort())
+
+# from the 8 corners of a cube around the box, every face is seen by 4 of them
+for position in np.array(np.meshgrid([-1, 1], [-1, 1], [-1, 1])).reshape(3, -1).T * 0.6:
+    di.set_sensor_orientation(position, (0.0, 0.0, 0.0))
+    di.Modified()
+    tsdf.Update()
+
+# welded the surface has no boundary edges, the points shared by blocks are computed in
+# every block and only match up to rounding (the removed triangles turn into lines and
+# vertices)
+clean = vtk.vtkCleanPolyData()
+clean.SetInputData(tsdf.GetOutputDataObject(0))
+clean.ToleranceIsAbsoluteOn()
+clean.SetAbsoluteTolerance(1e-6)
+clean.Update()
+surface = clean.GetOutput()
+assert surface.GetNumberOfPolys() == tsdf.get_number_of_triangles()
+edges = vtk.vtkFeatureEdges()
+edges.SetInputData(surface)
+edges.BoundaryEdgesOn()
+edges.FeatureEdgesOff()
+edges.ManifoldEdgesOff()
+edges.NonManifoldEdgesOff()
+edges.Update()
+assert edges.GetOutput().GetNumberOfCells() == 0, edges.GetOutput().GetNumberOfCells()
+
+# the faces are within a few millimetres of the box, the edges and corners are rounded
+# off by less than a voxel and a half
+points = numpy_support.vtk_to_numpy(surface.GetPoints().GetData())
+outside = np.maximum(bounds[0::2] - points, points - bounds[1::2])
+distance = np.where(outside.max(axis=1) > 0.0,
+                    np.linalg.norm(np.maximum(outside, 0.0), axis=1), -outside.max(axis=1))
+assert np.median(np.abs(distance)) < 0.1 * voxel_size, np.median(np.abs(distance))
+assert np.abs(distance).max() < 1.5 * voxel_size, np.abs(distance).max()
+assert tsdf.get_stats()['dropped'] == 0
+di.kill_render_window()
+logging.info('closed surface of a box ok')
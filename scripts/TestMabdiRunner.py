@@ -0,0 +1,61 @@
+import mabdi
+
+import os
+import shutil
+import tempfile
+
+import logging
+
+logging.basicConfig(level=logging.INFO,
+                    format="%(levelname)s %(module)s @ %(funcName)s: %(message)s")
+
+"""
+Script to test MabdiRunner
+    Runs a queue of small offscreen simulations in which one run fails, then starts
+    the runner again on the same queue with the failing run fixed and checks that
+    only the runs that did not complete are done again.
+    Nothing is shown, an AssertionError tells what broke.
+"""
+
+""" Resuming a partially completed queue """
+
+
+def make_runs(environment_names):
+    runs = []
+    for i, environment_name in enumerate(environment_names):
+        mabdi_param = {'depth_image_size': (64, 48)}
+        sim_param = {'environment_name': environment_name,
+                     'path_nsteps': 3}
+        output = {'folder_name': 'run{}'.format(i)}
+        runs.append((mabdi_param, sim_param, output))
+    return runs
+
+
+if __name__ == '__main__':
+    output_dir = tempfile.mkdtemp() + '/'
+    try:
+        # the second run has an unknown environment and fails
+        runner = mabdi.MabdiRunner(make_runs(['table', 'no_such_environment', 'table']),
+                                   nprocesses=2, output_dir=output_dir)
+        results = runner.run()
+        assert [r['status'] for r in results] == ['completed', 'failed', 'completed']
+        assert 'Unknown environment_name' in results[1]['error']
+        completed = [os.path.join(output_dir, 'run{}'.format(i), 'completed.json') for i in range(3)]
+        assert os.path.exists(completed[0]) and not os.path.exists(completed[1])
+        mtimes = [os.path.getmtime(completed[i]) for i in (0, 2)]
+
+        # started again only the failed run is done, the others are left as they are
+        runner = mabdi.MabdiRunner(make_runs(['table', 'table', 'table']),
+                                   nprocesses=2, output_dir=output_dir)
+        results = runner.run()
+        assert [r['status'] for r in results] == ['skipped', 'completed', 'skipped']
+        assert os.path.exists(completed[1])
+        assert [os.path.getmtime(completed[i]) for i in (0, 2)] == mtimes
+        assert len([f for f in os.listdir(output_dir) if f.endswith('runner_summary.json')]) == 2
+
+        # without resume everything is done again
+        runner = mabdi.MabdiRunner(make_runs(['table']), resume=False, output_dir=output_dir)
+        assert [r['status'] for r in runner.run()] == ['completed']
+    finally:
+        shutil.rmtree(output_dir)
+    logging.info('resuming a partially completed queue ok')
@@ -0,0 +1,220 @@
+import vtk
+from vtk.util import numpy_support
+
+import mabdi
+from MeshStore import _SortedKeys
+
+import numpy as np
+
+import shutil
+import tempfile
+
+import logging
+
+logging.basicConfig(level=logging.DEBUG,
+                    format="%(levelname)s %(module)s @ %(funcName)s: %(message)s")
+
+"""
+Script to test MeshStore and ChunkFileStore
+    Checks that appending, removing and compacting keep the triangles pointing at
+    the right points, that welding merges points and drops duplicate triangles,
+    that chunks spilled to disk or flushed come back unchanged and that the keys
+    of the welded store follow the points when they are renumbered and stay unique
+    when removed triangles are added again. Nothing is shown, an AssertionError
+    tells what broke.
+"""
+
+
+def grid_surface(nx, ny, origin=(0.0, 0.0, 0.0), spacing=0.1):
+    """
+    :return: points and triangles of a flat grid of nx by ny points
+    """
+    (x, y) = np.meshgrid(np.arange(nx) * spacing, np.arange(ny) * spacing)
+    points = np.column_stack((x.ravel(), y.ravel(), np.zeros(x.size))) + origin
+    i = np.arange((ny - 1) * nx).reshape(ny - 1, nx)[:, :-1].ravel()
+    triangles = np.vstack((np.column_stack((i, i + 1, i + nx)),
+                           np.column_stack((i + 1, i + nx + 1, i + nx))))
+    return points, triangles
+
+
+def corners(points, triangles):
+    """
+    :return: (ntri, 9) corners of the triangles, sorted to compare meshes
+    """
+    c = points[triangles].reshape(-1, 9)
+    return c[np.lexsort(c.T[::-1])]
+
+
+def polydata_corners(polydata):
+    points = numpy_support.vtk_to_numpy(polydata.GetPoints().GetData())
+    triangles = numpy_support.vtk_to_numpy(polydata.GetPolys().GetConnectivityArray())
+    return corners(points, triangles.reshape(-1, 3))
+
+
+""" Append, remove and compact """
+
+(p1, t1) = grid_surface(5, 4)
+(p2, t2) = grid_surface(3, 3, origin=(1.0, 0.0, 0.0))
+store = mabdi.MeshStore(capacity=4)
+store.append(p1, t1, colors=np.full((t1.shape[0], 1), 1, dtype=np.uint16))
+(first, last) = store.append(p2, t2, colors=np.full((t2.shape[0], 1), 2, dtype=np.uint16))
+assert (first, last) == (t1.shape[0], t1.shape[0] + t2.shape[0])
+assert np.array_equal(corners(store.get_points(), store.get_triangles()),
+                      corners(np.vstack((p1, p2)), np.vstack((t1, t2 + p1.shape[0]))))
+
+# remove every other triangle of the first surface and all of the second
+removed = np.concatenate((np.arange(0, t1.shape[0], 2), np.arange(first, last)))
+kept = np.setdiff1d(np.arange(last), removed)
+expected = store.get_points()[store.get_triangles()[kept]]
+expected_colors = store.get_colors()[kept]
+store.remove_triangles(removed)
+assert store.get_number_of_removed_triangles() == removed.shape[0]
+
+# the culled output only has the points of the chosen triangles
+culled = store.get_polydata(kept[:3])
+assert culled.GetNumberOfCells() == 3
+assert culled.GetNumberOfPoints() == np.unique(store.get_triangles()[kept[:3]]).shape[0]
+assert np.array_equal(polydata_corners(culled), corners(store.get_points(), store.get_triangles()[kept[:3]]))
+
+triangle_map = store.compact()
+assert store.get_number_of_triangles() == kept.shape[0]
+assert store.get_number_of_removed_triangles() == 0
+assert np.array_equal(triangle_map[removed], np.full(removed.shape[0], -1))
+assert np.array_equal(triangle_map[kept], np.arange(kept.shape[0]))
+assert np.array_equal(store.get_points()[store.get_triangles()], expected)
+assert np.array_equal(store.get_colors(), expected_colors)
+# no point is left unused
+assert np.unique(store.get_triangles()).shape[0] == store.get_number_of_points()
+logging.info('append, remove and compact ok')
+
+
+""" Weld """
+
+(p, t) = grid_surface(6, 6)
+welded = mabdi.MeshStore(weld_tolerance=0.001)
+welded.append(p, t)
+assert welded.get_number_of_points() == p.shape[0]
+
+# the same surface moved by less than the tolerance adds nothing
+welded.append(p + 0.0001, t)
+assert welded.get_number_of_points() == p.shape[0]
+assert welded.get_number_of_triangles() == t.shape[0]
+stats = welded.get_weld_stats()
+assert stats['points_merged'] == p.shape[0]
+assert stats['triangles_dropped'] == t.shape[0]
+
+# a neighbor sharing an edge only adds the points that are new
+(pn, tn) = grid_surface(6, 6, origin=(0.5, 0.0, 0.0))
+welded.append(pn, tn)
+assert welded.get_number_of_points() == 6 * 11
+assert welded.get_number_of_triangles() == 2 * t.shape[0]
+
+# triangles repeated within one append and degenerate ones are dropped
+before = welded.get_number_of_triangles()
+(pd, td) = grid_surface(2, 2, origin=(5.0, 5.0, 5.0))
+welded.append(pd, np.vstack((td, td[:, ::-1], [[0, 0, 1]])))
+assert welded.get_number_of_triangles() == before + 2
+logging.info('weld ok')
+
+
+""" Tombstones and the keys of the welded store """
+
+# an earlier output shares the triangles: removing shows in it, compacting does not
+earlier = welded.get_polydata()
+shallow = vtk.vtkPolyData()
+shallow.ShallowCopy(earlier)
+(mtime, shallow_mtime) = (earlier.GetMTime(), shallow.GetMTime())
+connectivity = numpy_support.vtk_to_numpy(earlier.GetPolys().GetConnectivityArray()).reshape(-1, 3)
+welded.remove_triangles(np.arange(t.shape[0]))
+assert not connectivity[:t.shape[0]].any()
+# and they are marked modified, also through a shallow copy
+assert earlier.GetMTime() > mtime and shallow.GetMTime() > shallow_mtime
+before = connectivity.copy()
+welded.compact()
+assert np.array_equal(connectivity, before)
+
+# the keys follow the points renumbered by compact()
+npoints = welded.get_number_of_points()
+(pn_again, tn_again) = grid_surface(6, 6, origin=(0.5, 0.0, 0.0))
+welded.append(pn_again, tn_again)
+assert welded.get_number_of_points() == npoints
+assert welded.get_number_of_triangles() == tn.shape[0] + 2
+
+# the first surface is gone, adding it again only reuses the shared edge
+welded.append(p, t)
+assert welded.get_number_of_points() == npoints + 5 * 6
+
+# removed triangles added again are stored once, their keys stay unique
+(pr, tr) = grid_surface(4, 4, origin=(0.0, 3.0, 0.0))
+removing = mabdi.MeshStore(weld_tolerance=0.001)
+(first, last) = removing.append(pr, tr)
+removing.remove_triangles(np.arange(first, last))
+for i in range(3):
+    removing.append(pr, tr)
+    assert removing.get_number_of_triangles() == 2 * tr.shape[0], i
+run_keys = np.concatenate([k for (k, ids) in removing._triangle_keys._runs])
+assert np.unique(run_keys).shape[0] == run_keys.shape[0]
+removing.compact()
+assert np.array_equal(corners(removing.get_points(), removing.get_triangles()), corners(pr, tr))
+
+keys = _SortedKeys()
+keys.add(np.array([40, 10, 30]), np.array([0, 1, 2]))
+keys.add(np.array([20]), np.array([3]))
+assert np.array_equal(keys.find(np.array([10, 20, 30, 40, 50])), [1, 3, 2, 0, -1])
+keys.remap(np.array([-1, 0, 5, 1]))
+assert np.array_equal(keys.find(np.array([10, 20, 30, 40])), [0, 1, 5, -1])
+# a key already in the map gets the new id
+keys.add(np.array([20, 40]), np.array([7, 8]))
+assert np.array_equal(keys.find(np.array([10, 20, 30, 40])), [0, 7, 5, 8])
+logging.info('tombstones and key remapping ok')
+
+
+""" Spill and reload """
+
+path = tempfile.mkdtemp()
+try:
+    chunks = mabdi.ChunkFileStore(path, chunk_size=1.0, resident_budget_mb=0)
+    surfaces = {}
+    for i in range(4):
+        (p, t) = grid_surface(4, 4, origin=(i, 0.0, 0.0))
+        colors = np.full((t.shape[0], 1), i, dtype=np.uint16)
+        c = chunks.add((i, 0, 0), p, t, colors)
+        surfaces[c] = (p, t, colors)
+        chunks.evict()
+    # a budget of 0 keeps only the most recently used chunk
+    assert chunks.get_resident_chunks() == [3]
+    assert chunks.get_stats()['spilled'] == 3
+
+    for c, (p, t, colors) in surfaces.items():
+        (points, triangles, chunk_colors) = chunks.get_chunk_arrays(c)
+        assert np.array_equal(points[triangles], p[t])
+        assert np.array_equal(chunk_colors, colors)
+
+    # reading back makes a chunk resident and evicts another
+    chunks.touch([0])
+    chunks.evict()
+    assert chunks.get_resident_chunks() == [0]
+    assert chunks.get_stats()['loaded'] == 1
+
+    # a resident chunk that grew and a spilled chunk that was replaced are written
+    # by flush()
+    (p, t) = grid_surface(3, 3, origin=(0.0, 0.5, 0.0))
+    chunks.add((0, 0, 0), p, t, np.full((t.shape[0], 1), 7, dtype=np.uint16))
+    (p, t) = grid_surface(2, 2, origin=(2.0, 0.0, 0.0))
+    chunks.replace(2, p, t, np.full((t.shape[0], 1), 8, dtype=np.uint16))
+
+    # the manifest opens the same mesh without reading the chunks
+    chunks.flush()
+    opened = mabdi.ChunkFileStore.open(path)
+    assert opened.get_resident_chunks() == []
+    for c in range(4):
+        assert opened.get_number_of_triangles([c]) == chunks.get_number_of_triangles([c])
+        for (a, b) in zip(opened.get_chunk_arrays(c), chunks.get_chunk_arrays(c)):
+            assert np.array_equal(a, b)
+    assert opened.get_number_of_triangles() == chunks.get_number_of_triangles()
+    assert np.array_equal(opened.get_chunk_bounds(), chunks.get_chunk_bounds())
+    assert np.array_equal(polydata_corners(opened.get_polydata()),
+                          polydata_corners(chunks.get_polydata()))
+finally:
+    shutil.rmtree(path)
+logging.info('spill and reload ok')
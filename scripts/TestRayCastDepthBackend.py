@@ -0,0 +1,90 @@
+import vtk
+from vtk.util import numpy_support
+
+import mabdi
+
+import numpy as np
+
+import logging
+
+logging.basicConfig(level=logging.DEBUG,
+                    format="%(levelname)s %(module)s @ %(funcName)s: %(message)s")
+
+"""
+Script to test RayCastDepthBackend
+    Checks that the ray cast depth of a tilted plane is the exact depth at the center
+    of every pixel and that, on the table environment, it matches the z-buffer of the
+    OpenGL backend (rendered offscreen) up to the sub-pixel offsets of the rasterizer.
+    Nothing is shown, an AssertionError tells what broke.
+"""
+
+""" Exact depth of a plane """
+
+(w, h) = (160, 120)
+floor = vtk.vtkPlaneSource()
+floor.SetOrigin(-10.0, 0.0, -10.0)
+floor.SetPoint1(10.0, 0.0, -10.0)
+floor.SetPoint2(-10.0, 0.0, 10.0)
+floor.SetResolution(40, 40)
+
+camera = vtk.vtkCamera()
+camera.SetPosition(0.0, 1.0, 2.0)
+camera.SetFocalPoint(0.0, 0.0, 0.0)
+camera.SetViewUp(0.0, 1.0, 0.0)
+camera.SetClippingRange(0.8, 4.0)
+
+backend = mabdi.RayCastDepthBackend(depth_image_size=(w, h))
+backend.set_input_connection(floor)
+zbuffer = backend.render(camera).astype(np.float64)
+(near, far) = camera.GetClippingRange()
+depth = near * far / (far - zbuffer * (far - near))
+
+# the ray through the center of every pixel, in world coordinates, meets the floor at
+tan_half = np.tan(np.radians(camera.GetViewAngle()) / 2.0)
+x = (2.0 * (np.arange(w) + 0.5) / w - 1.0) * tan_half * (float(w) / h)
+y = (2.0 * (np.arange(h) + 0.5) / h - 1.0) * tan_half
+(yy, xx) = np.meshgrid(y, x, indexing='ij')
+view = camera.GetViewTransformMatrix()
+rot = np.array([[view.GetElement(i, j) for j in range(3)] for i in range(3)])
+dirs = np.dot(np.dstack((xx, yy, -np.ones(xx.shape))).reshape(-1, 3), rot).reshape(h, w, 3)
+expected = np.where(dirs[..., 1] < 0.0, -camera.GetPosition()[1] / np.minimum(dirs[..., 1], -1e-9), np.inf)
+
+hit = zbuffer < 1.0
+assert np.array_equal(hit, expected < far)
+assert np.abs(depth[hit] - expected[hit]).max() < 1e-4, np.abs(depth[hit] - expected[hit]).max()
+backend.close()
+logging.info('exact depth of a plane ok')
+
+
+""" Ray casting against OpenGL on the table environment """
+
+source = mabdi.SourceEnvironmentTable()
+positions = np.array([[0.0, 1.5, 2.0], [1.0, 1.2, 1.5], [-1.5, 1.5, 1.0]])
+lookat = (0.0, 0.75, 0.0)
+
+depths = {}
+for name in ('opengl', 'raycast'):
+    di = mabdi.FilterDepthImage(offscreen=True, depth_image_size=(w, h), backend=name, depth_mode='metric')
+    di.set_polydata(source)
+    depths[name] = []
+    for position in positions:
+        di.set_sensor_orientation(position, lookat)
+        di.Modified()
+        di.Update()
+        scalars = di.GetOutputDataObject(0).GetPointData().GetScalars()
+        depths[name].append(numpy_support.vtk_to_numpy(scalars).astype(np.float64).reshape(h, w))
+    di.kill_render_window()
+
+# the rasterizer samples the pixels a fraction of a pixel away from their centers,
+# which moves silhouettes and the depth on surfaces seen at a grazing angle by up
+# to a pixel: the OpenGL depth has to lie within the ray cast depths of the 3x3
+# neighborhood of the pixel (0.0 where nothing was seen)
+for (opengl, raycast) in zip(depths['opengl'], depths['raycast']):
+    padded = np.pad(raycast, 1, mode='edge')
+    neighborhood = np.array([padded[1 + dy:1 + dy + h, 1 + dx:1 + dx + w]
+                             for dy in (-1, 0, 1) for dx in (-1, 0, 1)])
+    outside = (opengl < neighborhood.min(axis=0) - 0.01) | (opengl > neighborhood.max(axis=0) + 0.01)
+    seen = (opengl > 0.0) | (raycast > 0.0)
+    assert np.count_nonzero(seen) > 0.25 * w * h
+    assert np.count_nonzero(outside) <= 0.02 * np.count_nonzero(seen), np.count_nonzero(outside)
+logging.info('ray casting against opengl ok')
@@ -0,0 +1,89 @@
+import vtk
+
+import mabdi
+
+import numpy as np
+
+import os
+import json
+import shutil
+import tempfile
+
+import logging
+
+logging.basicConfig(level=logging.DEBUG,
+                    format="%(levelname)s %(module)s @ %(funcName)s: %(message)s")
+
+"""
+Script to test SourceMeshFiles
+    Writes a mesh file and a manifest to a temporary folder and checks that the
+    objects are placed as the manifest says, that a file is only read once its
+    object is in the environment and that a broken manifest is refused.
+    Nothing is shown, an AssertionError tells what broke.
+"""
+
+""" Manifest """
+
+path = tempfile.mkdtemp()
+try:
+    # a unit cube standing on y = 0
+    cube = vtk.vtkCubeSource()
+    cube.SetCenter(0.0, 0.5, 0.0)
+    triangles = vtk.vtkTriangleFilter()
+    triangles.SetInputConnection(cube.GetOutputPort())
+    os.mkdir(os.path.join(path, 'scans'))
+    writer = vtk.vtkPLYWriter()
+    writer.SetInputConnection(triangles.GetOutputPort())
+    writer.SetFileName(os.path.join(path, 'scans', 'cube.ply'))
+    writer.Write()
+
+    manifest = {'floor': [4.0, 4.0],
+                'objects': [{'name': 'small', 'file': 'scans/cube.ply', 'scale': 0.5,
+                             'translate': [1.0, 0.0, -1.0]},
+                            {'name': 'turned', 'file': 'scans/cube.ply', 'scale': [0.2, 0.4, 0.8],
+                             'rotate': [0.0, 90.0, 0.0], 'active': False},
+                            {'name': 'moved', 'file': 'scans/cube.ply',
+                             'matrix': [1, 0, 0, 0, 0, 1, 0, 2, 0, 0, 1, 0, 0, 0, 0, 1]}]}
+    manifest_file = os.path.join(path, 'manifest.json')
+    with open(manifest_file, 'w') as f:
+        json.dump(manifest, f)
+
+    # the file is relative to the manifest, the inactive object is not read
+    source = mabdi.SourceMeshFiles(manifest_file)
+    source.set_object_state(object_id='moved', state=False)
+    source.Update()
+    assert source.get_loaded_objects() == ['small']
+    assert np.allclose(source._geometry.get_bounds(['small']), (0.75, 1.25, 0.0, 0.5, -1.25, -0.75))
+    assert np.allclose(source.get_bounds(), (-2.0, 2.0, 0.0, 0.5, -2.0, 2.0))
+    assert source.GetOutputDataObject(0).GetNumberOfCells() == 2 * 12
+
+    # scaled then rotated about y, and a matrix
+    source.set_object_state(object_id='turned', state=True)
+    source.set_object_state(object_id=2, state=True)
+    source.Update()
+    assert source.get_loaded_objects() == ['small', 'turned', 'moved']
+    assert np.allclose(source._geometry.get_bounds(['turned']), (-0.4, 0.4, 0.0, 0.4, -0.1, 0.1))
+    assert np.allclose(source._geometry.get_bounds(['moved']), (-0.5, 0.5, 2.0, 3.0, -0.5, 0.5))
+    assert source.GetOutputDataObject(0).GetNumberOfCells() == 4 * 12
+
+    # an object taken out stays loaded
+    source.set_object_state(object_id='small', state=False)
+    source.Update()
+    assert source.GetOutputDataObject(0).GetNumberOfCells() == 3 * 12
+    assert source.get_loaded_objects() == ['small', 'turned', 'moved']
+
+    # broken manifests, a dictionary has its files relative to the working directory
+    cube_file = os.path.join(path, 'scans', 'cube.ply')
+    for objects in ([{'name': 'missing', 'file': 'scans/cube.ply'}],
+                    [{'name': 'floor', 'file': cube_file}],
+                    [{'file': cube_file}, {'name': 'object_0', 'file': cube_file}],
+                    [{'name': 'no_file'}]):
+        try:
+            mabdi.SourceMeshFiles({'objects': objects})
+        except ValueError:
+            pass
+        else:
+            assert False, objects
+finally:
+    shutil.rmtree(path)
+logging.info('manifest ok')
@@ -0,0 +1,68 @@
+from vtk.util import numpy_support
+
+import mabdi
+
+import numpy as np
+
+import logging
+
+logging.basicConfig(level=logging.DEBUG,
+                    format="%(levelname)s %(module)s @ %(funcName)s: %(message)s")
+
+"""
+Script to test SourceProcedural
+    Checks that the seed decides the environment, that the objects stand on the
+    floor within its size and that objects can be taken out and put back.
+    Nothing is shown, an AssertionError tells what broke.
+"""
+
+
+def output_points(source):
+    source.Update()
+    return numpy_support.vtk_to_numpy(source.GetOutputDataObject(0).GetPoints().GetData())
+
+
+""" Seed """
+
+first = output_points(mabdi.SourceProcedural(nobjects=50, seed=1))
+assert np.array_equal(first, output_points(mabdi.SourceProcedural(nobjects=50, seed=1)))
+second = output_points(mabdi.SourceProcedural(nobjects=50, seed=2))
+assert first.shape != second.shape or not np.array_equal(first, second)
+logging.info('seed ok')
+
+
+""" Objects on the floor """
+
+floor_size = (4.0, 6.0)
+source = mabdi.SourceProcedural(nobjects=200, floor_size=floor_size, seed=0)
+assert len(source.objects) == 200
+kinds = set(name.rsplit('_', 1)[0] for name in source.objects)
+assert kinds == set(mabdi.SourceProcedural._kinds), kinds
+for name in source.objects:
+    bounds = source._geometry.get_bounds([name])
+    # standing on y = 0 (the lowest vertex of a sphere is a little above it),
+    # centered on the floor (objects may stick out of its edges)
+    assert -1e-5 < bounds[2] < 0.02 * (bounds[3] - bounds[2]), (name, bounds)
+    assert abs(bounds[0] + bounds[1]) / 2.0 <= floor_size[0] / 2.0
+    assert abs(bounds[4] + bounds[5]) / 2.0 <= floor_size[1] / 2.0
+
+only_boxes = mabdi.SourceProcedural(nobjects=20, object_mix={'box': 1})
+assert all(name.startswith('box_') for name in only_boxes.objects)
+logging.info('objects on the floor ok')
+
+
+""" Taking objects out """
+
+source.Update()
+ncells = source.GetOutputDataObject(0).GetNumberOfCells()
+name = list(source.objects)[0]
+ntriangles = source._geometry.get_polydata([name, 'floor']).GetNumberOfCells()
+source.set_object_state(object_id=name, state=False)
+source.set_object_state(object_id='floor', state=False)
+source.Update()
+assert source.GetOutputDataObject(0).GetNumberOfCells() == ncells - ntriangles
+source.set_object_state(object_id=0, state=True)
+source.set_object_state(object_id='floor', state=True)
+source.Update()
+assert source.GetOutputDataObject(0).GetNumberOfCells() == ncells
+logging.info('taking objects out ok')